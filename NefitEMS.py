@@ -34,22 +34,63 @@
 # Modify in the script below the Domoticz URLs, to only contain the stuff you want
 # to log, and change the URL to match your own Domoticz URL and the idx-es to match
 # those that you got when you added the dummy sensors.
-# Extending with additional message types to parse is as simple as adding a parse 
-# function for the message type, and add it to the MessageParseDispatcher dictionary.
+# Extending with additional message types to parse is as simple as adding an entry
+# for the message type to the MessageSchema table.
 #
 #################################################################################
 
 #################################################################################
 #Imports
 #################################################################################
-import serial
-import termios
-import numpy
+import collections
+import binascii
+import struct
 import time
+import os
+import mmap
+import argparse
 import datetime
-import urllib2
-import ssl
-import httplib
+import urlparse
+import socket
+import threading
+import bisect
+import heapq
+import select
+import errno
+import re
+import signal
+import marshal
+import json
+import random
+import importlib
+
+#################################################################################
+# Lazy imports, the modules that are slow to import (numpy above all, on a Pi)
+# or that only the script itself needs (the serial port, HTTP(S), the bus
+# workers) are imported the first time they are used. So importing NefitEMS as a
+# library is fast, and has no side effects. The first attribute access imports
+# the module and replaces the LazyModule in the globals by it.
+#################################################################################
+class LazyModule(object):
+   __slots__ = ('LazyName',)
+
+   def __init__(self, Name):
+      self.LazyName = Name
+
+   def __getattr__(self, Attribute):
+      Module = importlib.import_module(self.LazyName)
+      globals()[self.LazyName] = Module
+      return(getattr(Module, Attribute))
+
+serial = LazyModule('serial')
+termios = LazyModule('termios')
+numpy = LazyModule('numpy')
+urllib2 = LazyModule('urllib2')
+ssl = LazyModule('ssl')
+httplib = LazyModule('httplib')
+ctypes = LazyModule('ctypes')
+multiprocessing = LazyModule('multiprocessing')
+BaseHTTPServer = LazyModule('BaseHTTPServer')
 
 #################################################################################
 #Some definitions To use
@@ -57,6 +98,18 @@ import httplib
 
 DomoticzHost="https://192.168.225.86:443/"
 
+#Serial port the EMS interface is connected to.
+EMSPort="/dev/serial0"
+
+#Longest frame we accept without a BREAK, EMS telegrams are at most 32 bytes.
+EMSMaxFrameLength = 128
+EMSMaxTelegramLength = 32
+
+#Bus IDs of the devices that send telegrams: the boiler (UBA), the BC10, a service
+#key (our own ID in active mode) and the RC thermostats. Used to recognise the
+#start of a telegram when recovering frames that lost the BREAK in between.
+EMSKnownDevices = (0x08, 0x09, 0x0b, 0x10, 0x17, 0x18)
+
 #Domoticz URLs to push data
 RoomTemperatureURL=DomoticzHost+"json.htm?type=command&param=udevice&idx=69&nvalue=0&svalue="
 FlowTemperatureURL=DomoticzHost+"json.htm?type=command&param=udevice&idx=70&nvalue=0&svalue="
@@ -76,9 +129,63 @@ HotWaterFlowURL=DomoticzHost+"json.htm?type=command&param=udevice&idx=89&nvalue=
 SystemEfficiencyURL=DomoticzHost+"json.htm?type=command&param=udevice&idx=90&nvalue=0&svalue="
 SystemStatusURL=DomoticzHost+"json.htm?type=command&param=udevice&idx=91&nvalue=0&svalue="
 
-#Creating a context to indicate to urllib2 that I don't want SSL verification
-#because my domoticz setup does not have a valid CERT certificate.
-UnverifiedContext = ssl._create_unverified_context()
+#Change suppression per Domoticz sensor, a value is only pushed when it differs more than
+#the deadband from the last value pushed, or when the sensor has been silent for
+#DomoticzHeartbeat seconds. The deadband is (Absolute, Relative), a value passes when
+#it differs more than both Absolute and Relative*LastValue. Sensors that are not in
+#the dictionary are pushed on every change, text values as well.
+DomoticzHeartbeat = 300
+DeadbandDictionary = {
+   FlowTemperatureURL : (0.25, 0.0),
+   ReturnFlowTemperatureURL : (0.25, 0.0),
+   BurnerTemperatureURL : (0.25, 0.0),
+   DeltaTURL : (0.35, 0.0),
+   IonizationCurrentURL : (0.15, 0.05),
+   SystemEfficiencyURL : (0.25, 0.0),
+   HotWaterFlowURL : (0.15, 0.0),
+   RuntimeHeatingURL : (0.3, 0.0),
+   RuntimeHotWaterURL : (0.3, 0.0),
+}
+
+#Interval in seconds for printing the statistics in the main loop.
+StatisticsInterval = 600
+
+#Active mode, our bus ID, the read requests to send when polled:
+#(Destination, Type, Offset, Length, Interval in seconds), and the maximum share
+#of the bus time we may use for them.
+ActivePollID = 0x0b
+ActivePollRequests = [
+   (0x08, 0x18, 0, 25, 2.0),
+]
+ActivePollBusShare = 0.05
+
+#9600 baud, 8 data bits, 1 start and 1 stop bit.
+EMSLineRate = 960.0
+
+#Spool for the Domoticz updates that failed: the maximum size of the spool file
+#and the maximum number of spooled updates per second sent when catching up.
+DomoticzSpoolMaxBytes = 16*1024*1024
+DomoticzSpoolRate = 10.0
+
+#Derived metrics: the window in seconds over which they are calculated, the nominal
+#(maximum) power of the boiler in kW, of which the burner modulation is a percentage,
+#and the lower calorific value of the gas in kWh/m3 (8.79 for Groningen gas).
+DerivedWindow = 300
+BoilerNominalPower = 24.0
+GasCalorificValue = 8.79
+
+#Multi bus: a bus worker that exits (its serial port failed) is restarted after
+#BusRestartInterval seconds.
+BusRestartInterval = 10.0
+
+#Port of the built-in metrics endpoint (http://<host>:9101/metrics, and the catalogue
+#of unknown telegrams on /catalogue), 0 disables it.
+MetricsPort = 9101
+
+#Creating a context to indicate to the publisher that I don't want SSL verification
+#because my domoticz setup does not have a valid CERT certificate. It is created
+#when the first HTTPS connection is made, see UnverifiedSSLContext().
+UnverifiedContext = None
 
 #Status dictionary, easy way to translate the status code into a human readable message
 # ToDo: add the error status messages as well, will need dictionary of dictionaries for that, 
@@ -197,6 +304,108 @@ EfficiencyDictionary = {
 
 
 
+#################################################################################
+# Metrics, cheap counters and latency histograms for the hot path, exposed in the
+# Prometheus text format by a small HTTP server on its own thread.
+# Count() and Observe() are a dictionary update and a bisect, without locking: 
+# a rare lost increment between threads is acceptable for statistics. Counters
+# that already exist elsewhere (framer, reader, publisher, ...) are registered
+# as functions, which are only called when the metrics are read.
+#################################################################################
+MetricsBuckets = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+class EMSMetrics(object):
+   def __init__(self, Buckets=MetricsBuckets):
+      self.Buckets = Buckets
+      self.Counters = collections.defaultdict(int)
+      self.Histograms = dict()
+      self.Registered = []
+
+   def Count(self, Name, Value=1, Label=''):
+      self.Counters[(Name, Label)] += Value
+
+   def Observe(self, Name, Label, Seconds):
+      Histogram = self.Histograms.get((Name, Label))
+      if Histogram is None:
+         Histogram = self.Histograms[(Name, Label)] = [0]*(len(self.Buckets)+1)+[0.0]
+      Histogram[bisect.bisect_left(self.Buckets, Seconds)] += 1
+      Histogram[-1] += Seconds
+
+   def Register(self, Name, Type, Function, Label=''):
+      self.Registered.append((Name, Type, Function, Label))
+
+   # Counters can be python 2 longs, their repr() ends in an L.
+   @staticmethod
+   def Number(Value):
+      if isinstance(Value, (int, long)):
+         return(str(Value))
+      return(repr(float(Value)))
+
+   # The samples of a metric have to be in one group, and with --bus the metrics
+   # are registered per bus, so the samples are grouped by name first.
+   def Render(self):
+      Families = collections.OrderedDict()
+      def Sample(Name, Type, Label, Value):
+         Family = Families.get(Name)
+         if Family is None:
+            Family = Families[Name] = ['# TYPE '+Name+' '+Type]
+         Family.append(Name+('{'+Label+'}' if Label else '')+' '+self.Number(Value))
+      for (Name, Label), Value in sorted(self.Counters.items()):
+         Sample(Name, 'counter', Label, Value)
+      for Name, Type, Function, Label in self.Registered:
+         Sample(Name, Type, Label, Function())
+      Lines = [Line for Family in Families.values() for Line in Family]
+      for (Name, Label), Histogram in sorted(self.Histograms.items()):
+         if Name not in Families:
+            Families[Name] = None
+            Lines.append('# TYPE '+Name+' histogram')
+         Separator = ',' if Label else ''
+         Total = 0
+         for Bound, Count in zip(self.Buckets+('+Inf',), Histogram[:-1]):
+            Total += Count
+            Lines.append(Name+'_bucket{'+Label+Separator+'le="'+str(Bound)+'"} '+str(Total))
+         Lines.append(Name+'_sum'+('{'+Label+'}' if Label else '')+' '+self.Number(Histogram[-1]))
+         Lines.append(Name+'_count'+('{'+Label+'}' if Label else '')+' '+str(Total))
+      return('\n'.join(Lines)+'\n')
+
+Metrics = EMSMetrics()
+
+# The pages of the metrics server: (Body, Content-Type), or None.
+def MetricsPage(Path):
+   if Path == '/metrics':
+      return((Metrics.Render(), 'text/plain; version=0.0.4'))
+   if Path == '/catalogue':
+      Entries = Catalogue.Dump()
+      for Bus, BusCatalogue in BusCatalogues.items():
+         Entries += BusCatalogue.Dump(Bus)
+      return((json.dumps(Entries, indent=1, sort_keys=True)+'\n', 'application/json'))
+   return(None)
+
+# The handler is defined here, so BaseHTTPServer is only imported when the
+# metrics server is started.
+def StartMetricsServer(Port=MetricsPort, Address=''):
+   class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+      def do_GET(self):
+         Page = MetricsPage(self.path.split('?')[0])
+         if Page is None:
+            self.send_error(404)
+            return
+         Body, ContentType = Page
+         self.send_response(200)
+         self.send_header('Content-Type', ContentType)
+         self.send_header('Content-Length', str(len(Body)))
+         self.end_headers()
+         self.wfile.write(Body)
+
+      def log_message(self, *Arguments):
+         pass
+
+   Server = BaseHTTPServer.HTTPServer((Address, Port), MetricsHandler)
+   Thread = threading.Thread(target=Server.serve_forever, name='MetricsServer')
+   Thread.daemon = True
+   Thread.start()
+   return(Server)
+
 #################################################################################
 # Our Communication Functions
 # The EMS protocol has a nasty feature to seperate messages, they make the
@@ -205,270 +414,1865 @@ EfficiencyDictionary = {
 # framing error detect feature in termios. 
 # It will replace this "BREAK" seen as parity or frame error with 3 bytes:
 # 0xff 0x00 0x00. This will be used as our message seperator!
+# A pseudo terminal (like the one of NefitEMSSimulator.py) can't carry a BREAK,
+# the simulator writes the marked stream itself, so ParityMark should be off then.
 #################################################################################
-def StartEMS():
-   MyEMS = serial.Serial ("/dev/serial0", 9600) 
-   attr= termios.tcgetattr(MyEMS.fd)
-   attr[0]|= termios.PARMRK
-   termios.tcsetattr(MyEMS.fd, termios.TCSANOW, attr )
+def StartEMS(Port=EMSPort, ParityMark=True):
+   MyEMS = serial.Serial (Port, 9600) 
+   if ParityMark:
+      attr= termios.tcgetattr(MyEMS.fd)
+      attr[0]|= termios.PARMRK
+      termios.tcsetattr(MyEMS.fd, termios.TCSANOW, attr )
    return(MyEMS)
 
 def StopEMS(MyEMS):
    MyEMS.close()        
 
+#################################################################################
+# Capture and Replay of the raw bus traffic.
+# The capture file holds the raw serial stream, as read from the port, so the
+# BREAK markers (0xff 0x00 0x00) and the escaped 0xff 0xff are kept. It starts
+# with EMSCaptureMagic, followed by blocks of: a header with the time the block
+# was read (float64 seconds) and its length (uint16), and then the data itself.
+# The replay reads such a capture file (or a plain raw dump without header, as
+# one block) through mmap and behaves like the serial port, so it can be used
+# wherever StartEMS() returns a port. It replays as fast as possible, or with
+# Realtime at the recorded speed. At the end of the capture it raises EOFError.
+#################################################################################
+EMSCaptureMagic = b'EMSCAP01'
+EMSCaptureBlock = struct.Struct('<dH')
+
+class EMSCaptureWriter(object):
+   def __init__(self, FileName, FlushInterval=5.0):
+      self.File = open(FileName, 'ab')
+      if self.File.tell() == 0:
+         self.File.write(EMSCaptureMagic)
+      self.FlushInterval = FlushInterval
+      self.LastFlush = time.time()
+
+   def Write(self, Data, Timestamp=None):
+      if Timestamp is None:
+         Timestamp = time.time()
+      # Blocks are limited to 64k by the uint16 length.
+      for Start in range(0, len(Data), 0xffff):
+         Block = Data[Start:Start+0xffff]
+         self.File.write(EMSCaptureBlock.pack(Timestamp, len(Block)))
+         self.File.write(Block)
+      if (Timestamp-self.LastFlush) > self.FlushInterval:
+         self.File.flush()
+         self.LastFlush = Timestamp
+
+   def Close(self):
+      self.File.close()
+
+class EMSReplay(object):
+   def __init__(self, FileName, Realtime=False):
+      self.File = open(FileName, 'rb')
+      self.Realtime = Realtime
+      self.Map = None
+      self.Size = os.fstat(self.File.fileno()).st_size
+      if self.Size:
+         self.Map = mmap.mmap(self.File.fileno(), 0, access=mmap.ACCESS_READ)
+      if self.Map is not None and self.Map[:len(EMSCaptureMagic)] == EMSCaptureMagic:
+         self.Position = len(EMSCaptureMagic)
+         self.Raw = False
+      else:
+         self.Position = 0
+         self.Raw = True
+      self.BlockEnd = self.Position
+      self.BlockTime = None
+      self.FirstBlockTime = None
+      self.StartTime = None
+
+   def NextBlock(self):
+      if self.Raw:
+         self.BlockEnd = self.Size
+         return(self.Position < self.Size)
+      if self.Position+EMSCaptureBlock.size > self.Size:
+         return(False)
+      self.BlockTime, Length = EMSCaptureBlock.unpack_from(self.Map, self.Position)
+      self.Position += EMSCaptureBlock.size
+      self.BlockEnd = min(self.Position+Length, self.Size)
+      if self.FirstBlockTime is None:
+         self.FirstBlockTime = self.BlockTime
+         self.StartTime = time.time()
+      return(True)
+
+   def Due(self):
+      return(self.StartTime+(self.BlockTime-self.FirstBlockTime)-time.time())
+
+   @property
+   def in_waiting(self):
+      if self.Position == self.BlockEnd:
+         if self.Realtime and not self.Raw and self.Position+EMSCaptureBlock.size <= self.Size:
+            BlockTime = EMSCaptureBlock.unpack_from(self.Map, self.Position)[0]
+            if self.FirstBlockTime is not None and (self.StartTime+(BlockTime-self.FirstBlockTime)) > time.time():
+               return(0)
+         if not self.NextBlock():
+            return(0)
+      return(self.BlockEnd-self.Position)
+
+   def read(self, Size=1):
+      if self.Position == self.BlockEnd:
+         if not self.NextBlock():
+            raise EOFError('End of capture')
+         if self.Realtime and not self.Raw and self.Due() > 0:
+            time.sleep(self.Due())
+      Data = self.Map[self.Position:min(self.Position+Size, self.BlockEnd)]
+      self.Position += len(Data)
+      return(Data)
+
+   def flushInput(self):
+      pass
+
+   def Report(self):
+      return('Bytes replayed='+str(self.Position)+' of '+str(self.Size))
+
+   def close(self):
+      if self.Map is not None:
+         self.Map.close()
+      self.File.close()
+
 #################################################################################
 # Some helper functions to calculate and check the CRC value of the message
+# The CRC is calculated byte by byte: crc = Step(crc) ^ Byte, where Step() is the
+# shift/xor-with-12 of the EMS polynomial. Step() only depends on the previous crc,
+# so it is precomputed once for all 256 values into NefitEMSCRCTable.
 #################################################################################
 
+def NefitEMSCRCStep(crc):
+   d = 0
+   if ( crc & 0x80 ):
+      crc ^= 12
+      d = 1
+   return (((crc << 1) & 0xfe) | d)
+
+NefitEMSCRCTable = [NefitEMSCRCStep(crc) for crc in range(256)]
+
 def CalculateNefitEMSCRC(SerialBuffer):
   # First remove the last byte of the buffer, crc is calculated over the part of the message
   # before that.
-  StrippedBuffer=SerialBuffer[:-1]
+  Table = NefitEMSCRCTable
   crc = 0x0
-  d = 0x0
-  for Entry in StrippedBuffer:
-    d = 0;
-    if ( crc & 0x80 ):
-       crc ^= 12
-       d = 1
-    crc  = (crc << 1) & 0xfe
-    crc |= d
-    crc ^= int(Entry,16)
+  for Entry in bytearray(SerialBuffer[:-1]):
+    crc = Table[crc] ^ Entry
   return (crc)
 
+#################################################################################
+# Batch CRC validation, used when replaying captured logs with lots of frames.
+# Step() is linear (a rotate and a conditional xor), so the CRC of a message with 
+# data bytes b0..bm-1 is the xor of Step^(m-1-i)(bi) over all bytes. With a table
+# of the powers of Step() we can calculate the CRC of all frames of the same 
+# length in one go as numpy array operations, instead of a python loop per byte.
+# The power table is only build the first time it is needed.
+#################################################################################
+NefitEMSCRCPowerTable = None
+
+def BuildNefitEMSCRCPowerTable(MaxLength=EMSMaxFrameLength):
+   Table = numpy.zeros((MaxLength, 256), dtype=numpy.uint8)
+   Table[0] = numpy.arange(256)
+   Step = numpy.array(NefitEMSCRCTable, dtype=numpy.uint8)
+   for Power in range(1, MaxLength):
+      Table[Power] = Step[Table[Power-1]]
+   return (Table)
+
+def CRCOKBatch(Frames):
+   global NefitEMSCRCPowerTable
+   if NefitEMSCRCPowerTable is None:
+      NefitEMSCRCPowerTable = BuildNefitEMSCRCPowerTable()
+   OK = numpy.zeros(len(Frames), dtype=bool)
+   FramesByLength = dict()
+   for Index, Frame in enumerate(Frames):
+      FramesByLength.setdefault(len(Frame), []).append(Index)
+   for Length, Indices in FramesByLength.items():
+      if Length < 2 or Length > NefitEMSCRCPowerTable.shape[0]:
+         continue
+      Data = numpy.frombuffer(b''.join([Frames[Index] for Index in Indices]), dtype=numpy.uint8).reshape(len(Indices), Length)
+      Powers = numpy.arange(Length-2, -1, -1)
+      CRC = numpy.bitwise_xor.reduce(NefitEMSCRCPowerTable[Powers, Data[:, :-1]], axis=1)
+      OK[Indices] = (CRC == Data[:, -1])
+   return (OK)
+
 def CRCOK(SerialBuffer):
    CRC = CalculateNefitEMSCRC(SerialBuffer)
-   BufferLength = len(SerialBuffer)
-   OK = (CRC==int(SerialBuffer[(BufferLength-1)],16))
+   Expected = ord(SerialBuffer[-1:])
+   OK = (CRC==Expected)
    if not OK:
-      print('CRC not OK, Expected='+SerialBuffer[(BufferLength-1)]+', Calculated='+CRC.__str__()+', Message='+SerialBuffer.__str__())
+      Metrics.Count('nefitems_crc_failures_total')
    return (OK)
 
+#################################################################################
+# Frame recovery, when a BREAK gets corrupted two telegrams (or a telegram and
+# the poll byte after it) end up in one frame and its CRC fails. Instead of
+# throwing both away we search the frame for telegrams: a start with a known
+# header (a device in EMSKnownDevices sending to a device or broadcast, a type
+# in the MessageSchema), and an end where the CRC matches and the next telegram
+# (a known sender and receiver) or the end of the frame follows. The CRC is
+# rolled along from the start, so every start costs one table lookup per byte.
+# A CRC matches by chance once in 256 bytes, so the length has to fit the
+# message too: a read request has a single data byte, a telegram at offset 0 is
+# the whole message and a telegram at an offset is a part that fits in it.
+#################################################################################
+def KnownHeader(Data, Pos, Types=None):
+   if Pos+4 > len(Data):
+      return(False)
+   Receiver = Data[Pos+1] & 0x7f
+   return(Data[Pos] in EMSKnownDevices and (Receiver == 0 or Receiver in EMSKnownDevices) and (Types is None or Data[Pos+2] in Types))
+
+def TelegramFits(Data, Pos, Length):
+   Schema = MessageSchema.get(Data[Pos+2])
+   if Schema is None:
+      return(True)
+   Size = Schema['Size']
+   Offset = Data[Pos+3]
+   if Data[Pos+1] & 0x80:
+      return(Length == 6)
+   if Offset == 0:
+      return(Length == Size)
+   return(Length > 5 and Offset+Length <= Size)
+
+# A frame with a valid CRC can still be two telegrams whose BREAK got lost, when
+# the CRC matches by chance. Devices also send parts of a message, at offset 0
+# too, so outside of the recovery a frame of a known type only has to end within
+# the message. One that runs past it is recovered like a frame with a bad CRC.
+def TelegramInMessage(Data, Pos, Length):
+   Schema = MessageSchema.get(Data[Pos+2])
+   return(Schema is None or Data[Pos+3]+Length <= Schema['Size'])
+
+def FrameFits(Frame):
+   return(len(Frame) < 4 or TelegramInMessage(bytearray(Frame[:4]), 0, len(Frame)))
+
+# The check of a frame from the framer, a frame that fails it goes to Resync().
+def FrameOK(Frame):
+   return(CRCOK(Frame) and FrameFits(Frame))
+
+def RecoverFrames(SerialBuffer):
+   Data = bytearray(SerialBuffer)
+   Table = NefitEMSCRCTable
+   Frames = []
+   Start = 0
+   while Start <= len(Data)-5:
+      if KnownHeader(Data, Start, MessageSchema):
+         crc = 0
+         for End in range(Start, min(len(Data), Start+EMSMaxTelegramLength)):
+            if End-Start >= 5 and crc == Data[End] and TelegramFits(Data, Start, End-Start+1):
+               Rest = len(Data)-End-1
+               if Rest == 0 or (Rest == 1 and Data[End+1] & 0x80) or KnownHeader(Data, End+1):
+                  Frames.append(bytes(Data[Start:End+1]))
+                  Start = End
+                  break
+            crc = Table[crc] ^ Data[End]
+      Start += 1
+   return(Frames)
+
+#################################################################################
+# The EMS Framer, turns the PARMRK byte stream of the serial port into frames.
+# Instead of reading and inspecting the stream byte by byte, the framer is fed
+# with whatever chunk the serial port has waiting. It searches the chunk for the
+# 0xff marks and copies the data in between in one go. After a 0xff mark PARMRK
+# can give us 3 different sequences:
+#   0xff 0xff      : an actual 0xff data byte, unescaped to a single 0xff.
+#   0xff 0x00 0x00 : the BREAK, our message seperator.
+#   0xff 0x00 X    : byte X received with a parity/framing error, X is kept.
+# A mark that is split over 2 chunks is kept pending until the next chunk.
+# Split() unescapes a chunk and gives the bounds of the frames in it, Feed()
+# puts the complete frames as bytes in the Frames deque. Frames of 4 bytes or
+# less (the poll bytes of the bus master) are dropped, and a frame that grows
+# beyond MaxFrameLength without a BREAK is thrown away as garbage.
+# For the active mode, OnPoll is called with every single byte frame (a poll)
+# right away, and NextMessage calls OnFrame with every frame with a valid CRC.
+# A frame with a bad CRC is handed back to Resync(), which puts the telegrams
+# that RecoverFrames() finds in it (Recover()) in front of the Frames deque.
+# When FrameEnds is a list, the position in the stream right after the closing
+# BREAK of every frame is added to it, for the batch decoder.
+#################################################################################
+class EMSFramer(object):
+   def __init__(self, MaxFrameLength=EMSMaxFrameLength):
+      self.Frames = collections.deque()
+      self.MaxFrameLength = MaxFrameLength
+      self.Current = bytearray()
+      self.Pending = bytearray()
+      self.Breaks = 0
+      self.Overruns = 0
+      self.Recovered = 0
+      self.Lost = 0
+      self.Position = 0
+      self.FrameEnds = None
+      self.OnPoll = None
+      self.OnFrame = None
+
+   # Unescapes a chunk of the stream into a buffer, after the part of a frame
+   # left from the previous chunk, and returns the buffer and the (Start, End) of
+   # the frames that ended in this chunk. The buffer is never changed after it
+   # had frames, so the frames can be handed out as views on it.
+   def Split(self, Data):
+      Base = self.Position-len(self.Pending)
+      self.Position += len(Data)
+      if self.Pending:
+         Buffer = self.Pending + Data
+         self.Pending = bytearray()
+      else:
+         Buffer = bytearray(Data)
+      Current = self.Current
+      Bounds = []
+      Start = 0
+      Length = len(Buffer)
+      Pos = 0
+      while Pos < Length:
+         Mark = Buffer.find(b'\xff', Pos)
+         if Mark < 0:
+            Current += Buffer[Pos:]
+            break
+         Current += Buffer[Pos:Mark]
+         if Mark + 1 >= Length:
+            self.Pending = Buffer[Mark:]
+            break
+         Next = Buffer[Mark + 1]
+         if Next == 0xff:
+            Current.append(0xff)
+            Pos = Mark + 2
+         elif Next != 0x00:
+            # A lone 0xff can't be produced by PARMRK, keep it as data.
+            Current.append(0xff)
+            Pos = Mark + 1
+         elif Mark + 2 >= Length:
+            self.Pending = Buffer[Mark:]
+            break
+         elif Buffer[Mark + 2] == 0x00:
+            #Complete Break Received
+            self.Breaks += 1
+            if len(Current)-Start > 4:
+               Bounds.append((Start, len(Current)))
+               if self.FrameEnds is not None:
+                  self.FrameEnds.append(Base+Mark+3)
+            elif len(Current)-Start == 1 and self.OnPoll is not None:
+               self.OnPoll(Current[Start])
+            Start = len(Current)
+            Pos = Mark + 3
+         else:
+            Current.append(Buffer[Mark + 2])
+            Pos = Mark + 3
+      if len(Current)-Start > self.MaxFrameLength:
+         self.Overruns += 1
+         self.Current = bytearray()
+      elif Start:
+         self.Current = Current[Start:]
+      return(Current, Bounds)
+
+   def Feed(self, Data):
+      Buffer, Bounds = self.Split(Data)
+      if Bounds:
+         View = memoryview(Buffer)
+         for Start, End in Bounds:
+            self.Frames.append(View[Start:End].tobytes())
+      return(len(self.Frames))
+
+   # The telegrams in a frame with a bad CRC, counted as recovered, the frame as
+   # lost when not all of it could be recovered.
+   def Recover(self, Message):
+      Frames = RecoverFrames(Message)
+      self.Recovered += len(Frames)
+      # Whatever is left, apart from a poll byte, was (part of) a telegram.
+      if len(Message)-sum(len(Frame) for Frame in Frames) > 1:
+         self.Lost += 1
+      return(Frames)
+
+   def Resync(self, Message):
+      Frames = self.Recover(Message)
+      if not Frames:
+         if CalculateNefitEMSCRC(Message) != ord(Message[-1:]):
+            print('CRC not OK, Message='+binascii.hexlify(Message))
+         else:
+            print('Beyond the message size, Message='+binascii.hexlify(Message))
+      self.Frames.extendleft(reversed(Frames))
+      return(len(Frames))
+
+#################################################################################
+# The EMS Reader, drains the serial port continuously on its own thread into a
+# bounded ring buffer, so the UART buffer can't overflow while we are busy
+# decoding or publishing. It behaves like the serial port (read() and in_waiting)
+# so NextMessage can read from it as if it was the port itself.
+# When the consumer falls behind and the ring buffer is full, the oldest bytes
+# are dropped (the framer will resync on the next BREAK) and counted.
+# When reading the port fails (the adapter is unplugged) the reader stops, and
+# once the buffer is drained read() raises the error of the port.
+# OnData, when set, is called with every chunk on the reader thread before it
+# goes in the ring buffer, the active mode answers its polls from there.
+#################################################################################
+class EMSRingBuffer(object):
+   def __init__(self, Size=65536):
+      self.Buffer = bytearray(Size)
+      self.Size = Size
+      self.Head = 0
+      self.Tail = 0
+      self.Condition = threading.Condition()
+      self.Overflows = 0
+      self.DroppedBytes = 0
+
+   def Available(self):
+      return(self.Head-self.Tail)
+
+   def Write(self, Data):
+      Length = len(Data)
+      if Length > self.Size:
+         Data = Data[-self.Size:]
+         self.DroppedBytes += Length-self.Size
+         Length = self.Size
+      with self.Condition:
+         Free = self.Size-(self.Head-self.Tail)
+         if Length > Free:
+            self.Overflows += 1
+            self.DroppedBytes += Length-Free
+            self.Tail += Length-Free
+         Start = self.Head % self.Size
+         First = min(Length, self.Size-Start)
+         self.Buffer[Start:Start+First] = Data[:First]
+         self.Buffer[:Length-First] = Data[First:]
+         self.Head += Length
+         self.Condition.notify()
+
+   def Read(self, Size, Timeout=None):
+      with self.Condition:
+         if self.Head == self.Tail:
+            self.Condition.wait(Timeout)
+         Length = min(Size, self.Head-self.Tail)
+         Start = self.Tail % self.Size
+         First = min(Length, self.Size-Start)
+         Data = bytes(self.Buffer[Start:Start+First]+self.Buffer[:Length-First])
+         self.Tail += Length
+      return(Data)
+
+class EMSReader(object):
+   def __init__(self, MyEMS, RingSize=65536, Capture=None):
+      self.MyEMS = MyEMS
+      self.Capture = Capture
+      self.Ring = EMSRingBuffer(RingSize)
+      self.Thread = None
+      self.Running = False
+      self.Error = None
+      self.BytesRead = 0
+      self.OnData = None
+
+   def Start(self):
+      self.Running = True
+      self.Thread = threading.Thread(target=self.Run, name='EMSReader')
+      self.Thread.daemon = True
+      self.Thread.start()
+
+   def Stop(self):
+      self.Running = False
+
+   def Run(self):
+      try:
+         while self.Running:
+            Data = self.MyEMS.read(max(1, self.MyEMS.in_waiting))
+            self.BytesRead += len(Data)
+            if self.OnData is not None:
+               self.OnData(Data)
+            if self.Capture is not None:
+               self.Capture.Write(Data)
+            self.Ring.Write(Data)
+      except Exception as fout:
+         print("Error reading EMS bus: "+str(fout))
+         self.Error = fout
+      finally:
+         with self.Ring.Condition:
+            self.Running = False
+            self.Ring.Condition.notify_all()
+
+   @property
+   def in_waiting(self):
+      return(self.Ring.Available())
+
+   def read(self, Size=1):
+      # Wait in steps of a second, a wait without timeout can't be interrupted
+      # by Ctrl-C in python 2. Once stopped and drained, we report the end like
+      # the replay does.
+      Data = b''
+      while not Data:
+         if not self.Running and not self.Ring.Available():
+            if self.Error is not None:
+               raise self.Error
+            raise EOFError('EMS reader stopped')
+         Data = self.Ring.Read(Size, 1.0)
+      return(Data)
+
+   def Report(self):
+      return('Bytes read='+str(self.BytesRead)+', buffered='+str(self.Ring.Available())+', overflows='+str(self.Ring.Overflows)+', dropped bytes='+str(self.Ring.DroppedBytes))
+
+#################################################################################
+# Active Mode, instead of only listening we also take part in the bus as a device
+# with bus ID ActivePollID. The bus master (the UBA) polls every device in turn
+# with a single byte: the device ID with bit 7 set. When polled, a device may send
+# one telegram, or answers with just its ID to give the bus back.
+# When polled we send the read request (our ID, destination with bit 7 set, type,
+# offset, length, CRC) of the next request in ActivePollRequests that is due, and
+# correlate the reply (destination to us, same type and offset) when it arrives.
+# The replies are normal telegrams, they go through the parsers like the
+# broadcasts, the offset is handled by the parser images.
+# To never starve the thermostat, we only send when the bus time of our requests
+# and their replies over the last BusWindow seconds stays below MaxBusShare, and
+# we never have more than one request outstanding.
+# A telegram ends with a BREAK, on a real bus made with the break condition of
+# the port. A pty can't do that, with BreakMode 'none' we just send the bytes.
+# The bus master only waits a few ms for the answer, an answer after that talks
+# over the bus. So with the reader thread (Attach with the Reader) the polls are
+# answered from that thread, as soon as a chunk ends with our poll (our ID with
+# bit 7 set between two BREAKs), and not from the consumer, which can be busy
+# parsing or publishing. On the event loop the framer calls OnPoll right after
+# the read.
+#################################################################################
+class EMSActivePoller(object):
+   def __init__(self, MyEMS, OwnID=ActivePollID, Requests=ActivePollRequests, MaxBusShare=ActivePollBusShare, BusWindow=60.0, Timeout=1.0, BreakMode='line'):
+      self.MyEMS = MyEMS
+      self.OwnID = OwnID
+      self.Requests = [list(Request)+[0.0] for Request in Requests]
+      self.MaxBusShare = MaxBusShare
+      self.BusWindow = BusWindow
+      self.Timeout = Timeout
+      self.BreakMode = BreakMode
+      self.BusUsage = collections.deque()
+      self.BusBytes = 0
+      self.Outstanding = None
+      self.Polls = 0
+      self.Sent = 0
+      self.Replies = 0
+      self.Timeouts = 0
+      self.Throttled = 0
+      self.PollMark = bytes(bytearray([OwnID | 0x80]))+b'\xff\x00\x00'
+      self.Tail = b'\xff\x00\x00'
+      # OnPoll and OnFrame can run on different threads.
+      self.Lock = threading.Lock()
+
+   def Attach(self, Framer, Reader=None):
+      if Reader is not None:
+         Reader.OnData = self.OnData
+      else:
+         Framer.OnPoll = self.OnPoll
+      Framer.OnFrame = self.OnFrame
+
+   # Answers our poll when the chunk ends with it, the bus master waits for us
+   # then. The BREAK before the poll must not be an escaped 0xff data byte, so
+   # the number of 0xff-s before its 0x00 0x00 has to be odd.
+   def OnData(self, Data):
+      Stream = self.Tail+Data
+      self.Tail = Stream[-16:]
+      if not Stream.endswith(self.PollMark):
+         return
+      Before = Stream[:-len(self.PollMark)]
+      if not Before.endswith(b'\xff\x00\x00'):
+         return
+      Marks = len(Before)-2-len(Before[:-2].rstrip(b'\xff'))
+      if Marks % 2:
+         self.OnPoll(self.OwnID | 0x80)
+
+   def Send(self, Message):
+      self.MyEMS.write(bytes(Message))
+      if self.BreakMode == 'line':
+         self.MyEMS.flush()
+         self.MyEMS.break_condition = True
+         time.sleep(0.0012)
+         self.MyEMS.break_condition = False
+
+   def ExpireBusUsage(self, Now):
+      while self.BusUsage and self.BusUsage[0][0] < Now-self.BusWindow:
+         self.BusBytes -= self.BusUsage.popleft()[1]
+
+   def UseBus(self, Now, Bytes):
+      self.BusUsage.append((Now, Bytes))
+      self.BusBytes += Bytes
+
+   def OnPoll(self, Byte):
+      if Byte != (self.OwnID | 0x80):
+         return
+      with self.Lock:
+         self.Answer()
+
+   def Answer(self):
+      self.Polls += 1
+      Now = time.time()
+      if self.Outstanding is not None and (Now-self.Outstanding[4]) > self.Timeout:
+         self.Timeouts += 1
+         self.Outstanding = None
+      if self.Outstanding is None:
+         for Request in self.Requests:
+            Destination, Type, Offset, Length, Interval, LastSent = Request
+            if (Now-LastSent) < Interval:
+               continue
+            # Request and reply, both with a BREAK of about 1 byte time.
+            Bytes = (6+1)+(Length+5+1)
+            self.ExpireBusUsage(Now)
+            if (self.BusBytes+Bytes) > self.MaxBusShare*EMSLineRate*self.BusWindow:
+               self.Throttled += 1
+               break
+            ReadRequest = bytearray([self.OwnID, Destination | 0x80, Type, Offset, Length, 0x00])
+            ReadRequest[-1] = CalculateNefitEMSCRC(bytes(ReadRequest))
+            self.Send(ReadRequest)
+            self.UseBus(Now, Bytes)
+            Request[5] = Now
+            self.Outstanding = (Destination, Type, Offset, Length, Now)
+            self.Sent += 1
+            return
+      # Nothing to ask, give the bus back.
+      self.Send(bytearray([self.OwnID]))
+
+   def OnFrame(self, Message):
+      Header = bytearray(Message[0:4])
+      # The echo of our own request, nothing to do with it.
+      if Header[0] == self.OwnID:
+         return(True)
+      with self.Lock:
+         if self.Outstanding is not None and Header[1] == self.OwnID:
+            Destination, Type, Offset, Length, SentTime = self.Outstanding
+            if Header[0] == Destination and Header[2] == Type and Header[3] == Offset:
+               self.Replies += 1
+               Metrics.Observe('nefitems_active_reply_seconds', '', time.time()-SentTime)
+               self.Outstanding = None
+      return(False)
+
+   def Report(self):
+      return('Polls='+str(self.Polls)+', requests='+str(self.Sent)+', replies='+str(self.Replies)+', timeouts='+str(self.Timeouts)+', throttled='+str(self.Throttled)+', bus share='+('%.1f%%' % (100.0*self.BusBytes/(EMSLineRate*self.BusWindow))))
+
 #################################################################################
 # This function will read the next message from the serial port.
+# It reads everything that is waiting in one call (or blocks for 1 byte if 
+# nothing is waiting) and feeds it to the framer until a frame is available.
+# Frames with a bad CRC go back to the framer, which recovers the telegrams it
+# can find in them (see RecoverFrames), the rest is thrown away.
 # Broadcast Messages containing only the slave ID (<4 bytes) that indicates 
-# when a Bus slave is allowed to send data are beeing ignored for the 
-# moment, no plans to write on the bus yet...
+# when a Bus slave is allowed to send data are beeing ignored here, the active
+# mode (EMSActivePoller) gets them from the framer.
 #################################################################################
-def NextMessage(MyEMS):
-   MessageReceived = False
-   Message = []
-   BreakBytes = 0
-   while not MessageReceived:
-      char = numpy.uint8(ord(MyEMS.read(1))).__hex__()
-      if BreakBytes == 0:
-	 if char == '0xff':
-            BreakBytes = 1
-	 else:
-            Message.append(char)
-      elif BreakBytes == 1:
-	 if char == '0x0':
-            BreakBytes = 2
-	 else:
-	    Message.append('0xff')
-	    Message.append(char)
-	    BreakBytes = 0
-      elif BreakBytes == 2:
-	 if char == '0x0':
-	    #Complete Break Received
-	    BreakBytes = 0
-	    # Now check for message with valid CRC meaning we have a complete message
-	    # if we don't have that, we throw it away and continue receiving the next
-	    # message after this break.
-	    if len(Message) > 4: 
-	       #First PostProcess the messsage to remove redundant 0xff before calculating CRC.
-               Message = PostProcessMessage(Message)
-	       if CRCOK(Message):
-	          MessageReceived = True
-	       else:
-	          Message = []  
-	    else:
-	       Message = []  
-	 else:
-	    Message.append('0xff')
-	    Message.append('0x0')
-	    Message.append(char)
-	    BreakBytes = 0
-      #print('Char='+char.__str__()+', BreakBytes='+BreakBytes.__str__()+', MessageReceived='+MessageReceived.__str__()+' ,MessageStarted='+MessageStarted.__str__())
-   return(Message)
+def NextMessage(MyEMS, Framer):
+   while True:
+      while not Framer.Frames:
+         Waiting = MyEMS.in_waiting
+         Start = time.time()
+         Data = MyEMS.read(max(1, Waiting))
+         Read = time.time()
+         Framer.Feed(Data)
+         # Only time the read when the data was already waiting, otherwise we
+         # measure the bus being quiet.
+         if Waiting:
+            Metrics.Observe('nefitems_stage_seconds', 'stage="read"', Read-Start)
+         Metrics.Observe('nefitems_stage_seconds', 'stage="frame"', time.time()-Read)
+         Metrics.Count('nefitems_bytes_read_total', len(Data))
+      Message = Framer.Frames.popleft()
+      Start = time.time()
+      OK = FrameOK(Message)
+      Metrics.Observe('nefitems_stage_seconds', 'stage="crc"', time.time()-Start)
+      if OK:
+         if Framer.OnFrame is not None and Framer.OnFrame(Message):
+            continue
+         return(Message)
+      Framer.Resync(Message)
+
+#################################################################################
+# Catalogue of the telegrams we don't parse, to study them without printing every
+# one of them. Per (Sender, Receiver, Type, Offset, Length) it keeps:
+#  - the count and the first and last time seen.
+#  - the interval between arrivals: mean, standard deviation (Welford), min, max.
+#  - the change mask: the bits of the payload (the data bytes, without header and
+#    CRC) that have been seen changing, and the number of changes.
+#  - a reservoir of at most ReservoirSize distinct payloads with their counts,
+#    when it is full a new payload replaces a random one with probability
+#    ReservoirSize/distinct payloads seen, so it stays a uniform sample.
+# At most MaxKeys keys are kept, a new key replaces the one seen least (counted
+# as Evicted), so the memory is bounded. Add() is a few dictionary operations,
+# only a new key in a full catalogue scans the keys.
+# Report() gives a text table, Dump() a JSON-able list. The catalogue is on the
+# metrics endpoint as /catalogue and printed on SIGUSR1. With --bus the workers
+# forward the unknown telegrams to the aggregator, which keeps a catalogue per
+# bus in BusCatalogues, the entries of those have the name of the bus.
+#################################################################################
+class TelegramCatalogue(object):
+   def __init__(self, MaxKeys=256, ReservoirSize=8, Seed=None):
+      self.MaxKeys = MaxKeys
+      self.ReservoirSize = ReservoirSize
+      self.Random = random.Random(Seed)
+      self.Entries = dict()
+      self.Evicted = 0
+
+   def Add(self, Message, Now=None):
+      if Now is None:
+         Now = time.time()
+      Key = (ord(Message[0:1]), ord(Message[1:2]), ord(Message[2:3]), ord(Message[3:4]), len(Message))
+      Payload = Message[4:-1]
+      Entry = self.Entries.get(Key)
+      if Entry is None:
+         if len(self.Entries) >= self.MaxKeys:
+            del self.Entries[min(self.Entries, key=lambda Key: self.Entries[Key]['Count'])]
+            self.Evicted += 1
+         self.Entries[Key] = {'Count': 1, 'First': Now, 'Last': Now, 'Intervals': 0, 'Mean': 0.0, 'M2': 0.0, 'Min': None, 'Max': None,
+                              'Previous': Payload, 'Mask': 0, 'Changes': 0, 'Distinct': 1, 'Reservoir': {Payload: 1}}
+         return
+      Entry['Count'] += 1
+      Interval = Now-Entry['Last']
+      Entry['Last'] = Now
+      Entry['Intervals'] += 1
+      Delta = Interval-Entry['Mean']
+      Entry['Mean'] += Delta/Entry['Intervals']
+      Entry['M2'] += Delta*(Interval-Entry['Mean'])
+      if Entry['Min'] is None or Interval < Entry['Min']:
+         Entry['Min'] = Interval
+      if Entry['Max'] is None or Interval > Entry['Max']:
+         Entry['Max'] = Interval
+      if Payload != Entry['Previous']:
+         if Payload:
+            Entry['Mask'] |= int(binascii.hexlify(Payload), 16) ^ int(binascii.hexlify(Entry['Previous']), 16)
+         Entry['Previous'] = Payload
+         Entry['Changes'] += 1
+      Reservoir = Entry['Reservoir']
+      if Payload in Reservoir:
+         Reservoir[Payload] += 1
+         return
+      Entry['Distinct'] += 1
+      if len(Reservoir) < self.ReservoirSize:
+         Reservoir[Payload] = 1
+      elif self.Random.random() < float(self.ReservoirSize)/Entry['Distinct']:
+         del Reservoir[self.Random.choice(list(Reservoir))]
+         Reservoir[Payload] = 1
+
+   def Dump(self, Bus=None):
+      Entries = []
+      for Key, Entry in sorted(self.Entries.items(), key=lambda Item: -Item[1]['Count']):
+         Sender, Receiver, Type, Offset, Length = Key
+         Entries.append({
+            'sender': Sender, 'receiver': Receiver, 'type': Type, 'offset': Offset, 'length': Length,
+            'count': Entry['Count'], 'first': Entry['First'], 'last': Entry['Last'],
+            'interval_mean': Entry['Mean'] if Entry['Intervals'] else None,
+            'interval_stddev': (Entry['M2']/(Entry['Intervals']-1))**0.5 if Entry['Intervals'] > 1 else None,
+            'interval_min': Entry['Min'], 'interval_max': Entry['Max'],
+            'change_mask': ('%0'+str(2*max(0, Length-5))+'x') % Entry['Mask'], 'changes': Entry['Changes'],
+            'distinct_payloads': Entry['Distinct'],
+            'payloads': dict((binascii.hexlify(Payload), Count) for Payload, Count in Entry['Reservoir'].items()),
+         })
+         if Bus is not None:
+            Entries[-1]['bus'] = Bus
+      return(Entries)
+
+   def Report(self):
+      Lines = ['Unknown telegrams: '+str(len(self.Entries))+' kinds, '+str(self.Evicted)+' evicted']
+      for Entry in self.Dump():
+         Lines.append('  %02x -> %02x type %02x offset %3d length %2d: %8d seen, interval %s, %d distinct, changing %s' % (
+            Entry['sender'], Entry['receiver'], Entry['type'], Entry['offset'], Entry['length'], Entry['count'],
+            '%.3g s' % Entry['interval_mean'] if Entry['interval_mean'] is not None else '-', Entry['distinct_payloads'], Entry['change_mask']))
+         for Payload, Count in sorted(Entry['payloads'].items(), key=lambda Item: -Item[1]):
+            Lines.append('      %s %d' % (Payload, Count))
+      return('\n'.join(Lines))
+
+Catalogue = TelegramCatalogue()
+BusCatalogues = collections.OrderedDict()
+
+def PrintCatalogue(Prefix=''):
+   if Catalogue.Entries or not BusCatalogues:
+      print(Prefix+Catalogue.Report())
+   for Bus, BusCatalogue in BusCatalogues.items():
+      print(Prefix+Bus+', '+BusCatalogue.Report())
 
 #################################################################################
 # This function will return the Next Message of interest, other messages are
 # skipped. It will use the message parse dispatcher dictionary and only 
-# return the messages that have a key in that dictionary.
+# return the messages that have a key in that dictionary, the others go to the
+# catalogue.
 #################################################################################
-def NextMessageOfInterest(MyEMS):
+def NextMessageOfInterest(MyEMS, Framer):
    MessageReceived = False
    while not MessageReceived:
-      Message = NextMessage(MyEMS)
-      if MessageParseDispatcher.has_key(Message[2]):
-	 MessageReceived = True
-      #Comment out to print messages not parsed.
-      #else:
-	 #print('Unknown Message ID='+Message[2]+', Message='+Message.__str__())
+      Message = NextMessage(MyEMS, Framer)
+      Metrics.Count('nefitems_frames_total', 1, 'type="'+hex(ord(Message[2:3]))+'"')
+      if ord(Message[2:3]) in MessageParseDispatcher:
+         MessageReceived = True
+      else:
+         Catalogue.Add(Message)
    return (Message)
 
+def UnverifiedSSLContext():
+   global UnverifiedContext
+   if UnverifiedContext is None:
+      UnverifiedContext = ssl._create_unverified_context()
+   return(UnverifiedContext)
+
 #################################################################################
-# Post Process Message Data, remove double 0xff 0xff in case the message contained 
-# an actual 0xff byte. (Because our PARMRK termios setting as side effect will
-# replace each 0xff in the bytestream with 0xff 0xff to be able to distinguish
-# between a parity frame error and a message containing a 0xff 0x0 0x0 sequence.) 
-#################################################################################   
-def PostProcessMessage(Message):
-   if '0xff' in Message:
-      ByteRemoved = False
-      NewMessage = []
-      for byte in Message:
-	 if byte == '0xff': 
-	    if not ByteRemoved:
-	       ByteRemoved = True
-	    else:
-	       ByteRemoved = False
-	       NewMessage.append(byte)
-	 else:
-            NewMessage.append(byte)
-   else:
-      NewMessage = Message
-   return(NewMessage)
-      
-#################################################################################
-# Message Data Conversion Functions, input is list of numpy.uint8
-#################################################################################   
-
-def ConvertToFloat(MsgData, scalar):
-   length=len(MsgData)
-   if length == 1:
-      data=(float(int(MsgData[0],16))*scalar)
-   elif length == 2:
-      data=(float((256*int(MsgData[0],16))+int(MsgData[1],16))*scalar)
-   else:
-      #unknown, let's return 0.0 for now.
-      data=float(0.0)
-   return(data)
-
-def ConvertToint(MsgData):
-   length=len(MsgData)
-   if length == 1:
-      data=(int(MsgData[0],16))
-   elif length == 2:
-      data=(256*int(MsgData[0],16)+int(MsgData[1],16))
-   elif length == 3:
-      data=(65536*int(MsgData[0],16)+(256*int(MsgData[1],16))+int(MsgData[2],16))
-   else:
-      #unknown, let's return 0 for now.
-      data=int(0)
-   return(data)
+# Domoticz Publisher, pushes the values to Domoticz from a background thread, so
+# decoding never has to wait for the network.
+# Updates are kept in a bounded, ordered dictionary with the URL (and thus the idx)
+# as key. When a new value arrives for an idx that is still waiting to be sent,
+# only the newest value is kept (coalescing). The worker thread sends them over a
+# persistent keep-alive HTTP(S) connection, which is re-opened once on failure.
+# Only the path and query of the URLs are used, the connection goes to Host.
+# Updates that fail because Domoticz is unreachable go to the Spool, if any.
+#################################################################################
+class DomoticzPublisher(object):
+   def __init__(self, Host=DomoticzHost, MaxPending=64, Timeout=10):
+      HostParts = urlparse.urlsplit(Host)
+      self.Scheme = HostParts.scheme
+      self.NetLoc = HostParts.netloc
+      self.MaxPending = MaxPending
+      self.Timeout = Timeout
+      self.Pending = collections.OrderedDict()
+      self.Condition = threading.Condition()
+      self.Connection = None
+      self.Thread = None
+      self.Spool = None
+      self.Sent = 0
+      self.Coalesced = 0
+      self.Dropped = 0
+      self.Errors = 0
+      self.Status = None
+
+   def Start(self):
+      if self.Thread is None:
+         self.Thread = threading.Thread(target=self.Run, name='DomoticzPublisher')
+         self.Thread.daemon = True
+         self.Thread.start()
+
+   def Publish(self, URL, Value):
+      with self.Condition:
+         if URL in self.Pending:
+            self.Coalesced += 1
+         elif len(self.Pending) >= self.MaxPending:
+            self.Dropped += 1
+            return
+         self.Pending[URL] = Value
+         self.Condition.notify()
+
+   def Run(self):
+      while True:
+         with self.Condition:
+            while not self.Pending:
+               self.Condition.wait()
+            URL, Value = self.Pending.popitem(last=False)
+         self.Send(URL, Value)
+
+   def Connect(self):
+      if self.Scheme == 'https':
+         return(httplib.HTTPSConnection(self.NetLoc, timeout=self.Timeout, context=UnverifiedSSLContext()))
+      return(httplib.HTTPConnection(self.NetLoc, timeout=self.Timeout))
+
+   def Send(self, URL, Value):
+      URLParts = urlparse.urlsplit(URL)
+      Path = URLParts.path+'?'+URLParts.query+Value
+      # A keep-alive connection can be closed by the server at any time, so on
+      # failure we retry once on a fresh connection before reporting the error.
+      for Attempt in range(2):
+         try:
+            if self.Connection is None:
+               self.Connection = self.Connect()
+            Start = time.time()
+            self.Connection.request('GET', Path)
+            Page = self.Connection.getresponse()
+            DataString = Page.read()
+            self.Status = Page.status
+            Metrics.Observe('nefitems_domoticz_request_seconds', '', time.time()-Start)
+            if Page.status != 200:
+               self.Errors += 1
+               print("Error: HTTP "+str(Page.status)+" URL: "+URL)
+               if Page.status >= 500 and self.Spool is not None:
+                  self.Spool.Append(URL, Value)
+            else:
+               self.Sent += 1
+               if self.Spool is not None:
+                  self.Spool.Sent(URL)
+            return(Page.status == 200)
+         except (httplib.HTTPException, socket.error, ssl.SSLError) as fout:
+            if self.Connection is not None:
+               self.Connection.close()
+            self.Connection = None
+      self.Status = None
+      self.Errors += 1
+      print("Error: "+str(fout)+" URL: "+URL)
+      if self.Spool is not None:
+         self.Spool.Append(URL, Value)
+      return(False)
+
+   def Close(self):
+      if self.Connection is not None:
+         self.Connection.close()
+         self.Connection = None
+
+#################################################################################
+# Domoticz Spool, keeps the updates that could not be delivered because Domoticz
+# was unreachable (or answered with a server error), so an outage does not lose
+# the readings. The updates are appended to a spool file, flushed to disk with
+# fsync in batches (every SyncRecords updates or SyncInterval seconds). The file
+# is bounded to MaxBytes, when it is full new updates are dropped and counted.
+# A drainer thread sends the spooled updates in order, at most Rate per second,
+# over its own keep-alive connection, so the catch-up neither stalls the live
+# updates nor floods Domoticz. When it fails it backs off (up to a minute) and
+# tries again. Its position in the file is kept in <FileName>.offset, so a
+# restart continues where it left off, and the file is emptied once drained.
+# Domoticz only knows the current value of a device, and stamps an update with
+# the time it arrives, so the readings of the outage can't be replayed as they
+# were taken. What the spool guarantees is that Domoticz ends up with the newest
+# value of every idx: the drainer sends only the last spooled update per idx,
+# and skips it when a newer value for that idx was already sent live (the
+# others count as superseded). The history of the outage is in the sample
+# store and the other sinks. An update that Domoticz rejects (a 4xx, an idx
+# that is gone) will never get through, it is skipped and counted as rejected,
+# only a connection error or a server error stops the drain, which then starts
+# over without the updates that already got through. The drainer only reads
+# what was synced to disk.
+#################################################################################
+class DomoticzSpool(object):
+   def __init__(self, FileName, Host=DomoticzHost, MaxBytes=DomoticzSpoolMaxBytes, Rate=DomoticzSpoolRate, SyncInterval=5.0, SyncRecords=64):
+      self.FileName = FileName
+      self.OffsetFileName = FileName+'.offset'
+      self.MaxBytes = MaxBytes
+      self.Rate = Rate
+      self.SyncInterval = SyncInterval
+      self.SyncRecords = SyncRecords
+      self.File = open(FileName, 'ab')
+      self.File.seek(0, os.SEEK_END)
+      self.Size = self.File.tell()
+      self.SyncedSize = self.Size
+      self.ReadOffset = 0
+      if os.path.exists(self.OffsetFileName):
+         with open(self.OffsetFileName) as OffsetFile:
+            self.ReadOffset = min(int(OffsetFile.read() or 0), self.Size)
+      self.Lock = threading.Lock()
+      self.Unsynced = 0
+      self.LastSync = time.time()
+      self.LastLive = dict()
+      self.Delivered = dict()
+      # The drainer only uses Send() of this publisher, for its connection.
+      self.Sender = DomoticzPublisher(Host)
+      self.Thread = None
+      self.Spooled = 0
+      self.Dropped = 0
+      self.Drained = 0
+      self.Superseded = 0
+      self.Rejected = 0
+
+   def Start(self):
+      if self.Thread is None:
+         self.Thread = threading.Thread(target=self.Run, name='DomoticzSpool')
+         self.Thread.daemon = True
+         self.Thread.start()
+
+   def Append(self, URL, Value, Now=None):
+      if Now is None:
+         Now = time.time()
+      Line = repr(Now)+'\t'+URL+'\t'+Value+'\n'
+      with self.Lock:
+         if self.Size+len(Line) > self.MaxBytes:
+            self.Dropped += 1
+            return(False)
+         self.File.write(Line)
+         self.Size += len(Line)
+         self.Spooled += 1
+         self.Unsynced += 1
+         if self.Unsynced >= self.SyncRecords or (Now-self.LastSync) >= self.SyncInterval:
+            self.Sync()
+      return(True)
+
+   # Called by the publishers for every update that was delivered live.
+   def Sent(self, URL, Now=None):
+      self.LastLive[URL] = Now if Now is not None else time.time()
+
+   def Sync(self):
+      self.File.flush()
+      os.fsync(self.File.fileno())
+      self.SyncedSize = self.Size
+      self.Unsynced = 0
+      self.LastSync = time.time()
+
+   def Pending(self):
+      return(self.Size-self.ReadOffset)
+
+   def SaveOffset(self):
+      with open(self.OffsetFileName+'.tmp', 'w') as OffsetFile:
+         OffsetFile.write(str(self.ReadOffset))
+      os.rename(self.OffsetFileName+'.tmp', self.OffsetFileName)
+
+   def Run(self):
+      Backoff = 1.0
+      while True:
+         with self.Lock:
+            if self.Unsynced and (time.time()-self.LastSync) >= self.SyncInterval:
+               self.Sync()
+            Pending = self.ReadOffset < self.SyncedSize
+            Offset = self.ReadOffset
+         if not Pending:
+            time.sleep(1.0)
+         elif self.Drain():
+            Backoff = 1.0
+            # Only a partly written line, wait for the rest.
+            if self.ReadOffset == Offset:
+               time.sleep(1.0)
+         else:
+            time.sleep(Backoff)
+            Backoff = min(2*Backoff, 60.0)
+
+   # Sends the newest spooled update of every idx, returns False when Domoticz
+   # failed.
+   def Drain(self):
+      with open(self.FileName, 'rb') as SpoolFile:
+         SpoolFile.seek(self.ReadOffset)
+         Data = SpoolFile.read(self.SyncedSize-self.ReadOffset)
+      # Only complete lines, the last one can still be written.
+      End = Data.rfind('\n')+1
+      if not End:
+         return(True)
+      Superseded = 0
+      Newest = collections.OrderedDict()
+      for Line in Data[:End].splitlines():
+         try:
+            Time, URL, Value = Line.split('\t', 2)
+            Time = float(Time)
+         except ValueError:
+            # A line that was only partly written when we were killed.
+            Superseded += 1
+            continue
+         if URL in Newest:
+            Superseded += 1
+            del Newest[URL]
+         Newest[URL] = (Time, Value)
+      for URL, (Time, Value) in Newest.items():
+         if self.LastLive.get(URL, 0.0) >= Time:
+            Superseded += 1
+            continue
+         # Already sent (or rejected) before the drain was interrupted.
+         if self.Delivered.get(URL, 0.0) >= Time:
+            continue
+         if self.Sender.Send(URL, Value):
+            self.Drained += 1
+         elif self.Sender.Status is not None and self.Sender.Status < 500:
+            self.Rejected += 1
+         else:
+            return(False)
+         self.Delivered[URL] = Time
+         time.sleep(1.0/self.Rate)
+      self.Superseded += Superseded
+      self.ReadOffset += End
+      with self.Lock:
+         if self.ReadOffset >= self.Size:
+            self.File.truncate(0)
+            self.Size = 0
+            self.SyncedSize = 0
+            self.ReadOffset = 0
+            self.Sync()
+      self.SaveOffset()
+      return(True)
+
+   def Close(self):
+      with self.Lock:
+         self.Sync()
+         self.File.close()
+      self.SaveOffset()
+
+   def Report(self):
+      return('Spooled='+str(self.Spooled)+', drained='+str(self.Drained)+', superseded='+str(self.Superseded)+', rejected='+str(self.Rejected)+', dropped='+str(self.Dropped)+', pending bytes='+str(self.Pending()))
+
+Publisher = DomoticzPublisher()
 
 #################################################################################
-# Update Domoticz, try, except here to be robust for network problems or problems on
-# the domoticz host.
+# Event Loop Runtime, an alternative to the reader and publisher threads: one
+# select() loop that reads the serial port as soon as bytes arrive, frames and
+# parses them right away, and pushes to Domoticz over several non-blocking
+# keep-alive connections at the same time, so a slow Domoticz only delays the
+# pushes and never the bus.
+# (This is what asyncio would give us with loop.add_reader, but that does not
+# exist in python 2, so this is a minimal loop of our own: readers and writers
+# per file descriptor, and timers.) Stop() may be called from another thread,
+# it wakes up the select() through a pipe.
+#################################################################################
+class EMSEventLoop(object):
+   def __init__(self):
+      self.Readers = dict()
+      self.Writers = dict()
+      self.Timers = []
+      self.TimerCount = 0
+      self.Running = False
+      self.Wakeup = os.pipe()
+      self.AddReader(self.Wakeup[0], lambda: os.read(self.Wakeup[0], 64))
+
+   def AddReader(self, FileNo, Callback):
+      self.Readers[FileNo] = Callback
+
+   def RemoveReader(self, FileNo):
+      self.Readers.pop(FileNo, None)
+
+   def AddWriter(self, FileNo, Callback):
+      self.Writers[FileNo] = Callback
+
+   def RemoveWriter(self, FileNo):
+      self.Writers.pop(FileNo, None)
+
+   # Returns the timer, which can be cancelled with CancelTimer().
+   def CallLater(self, Delay, Callback):
+      self.TimerCount += 1
+      Timer = [time.time()+Delay, self.TimerCount, Callback]
+      heapq.heappush(self.Timers, Timer)
+      return(Timer)
+
+   def CancelTimer(self, Timer):
+      Timer[2] = None
+
+   def RunTimers(self):
+      Now = time.time()
+      while self.Timers and self.Timers[0][0] <= Now:
+         Callback = heapq.heappop(self.Timers)[2]
+         if Callback is not None:
+            Callback()
+
+   def Run(self):
+      self.Running = True
+      while self.Running:
+         while self.Timers and self.Timers[0][2] is None:
+            heapq.heappop(self.Timers)
+         Timeout = None
+         if self.Timers:
+            Timeout = max(0.0, self.Timers[0][0]-time.time())
+         try:
+            Readable, Writable, Failed = select.select(list(self.Readers), list(self.Writers), [], Timeout)
+         except select.error as fout:
+            if fout.args[0] == errno.EINTR:
+               continue
+            raise
+         for FileNo in Readable:
+            Callback = self.Readers.get(FileNo)
+            if Callback is not None:
+               Callback()
+         for FileNo in Writable:
+            Callback = self.Writers.get(FileNo)
+            if Callback is not None:
+               Callback()
+         self.RunTimers()
+
+   def Stop(self):
+      self.Running = False
+      os.write(self.Wakeup[1], b'x')
+
+#################################################################################
+# Serial ingest on the event loop, the counterpart of EMSReader + NextMessage:
+# whatever is waiting is read, (captured,) fed to the framer and every frame of
+# interest with a valid CRC is handed to OnMessage.
+#################################################################################
+class EMSLoopIngest(object):
+   def __init__(self, Loop, MyEMS, Framer, OnMessage, Capture=None):
+      self.Loop = Loop
+      self.MyEMS = MyEMS
+      self.Framer = Framer
+      self.OnMessage = OnMessage
+      self.Capture = Capture
+      self.BytesRead = 0
+
+   def Start(self):
+      self.Loop.AddReader(self.MyEMS.fileno(), self.OnReadable)
+
+   def Stop(self):
+      self.Loop.RemoveReader(self.MyEMS.fileno())
+      self.Loop.Stop()
+
+   def OnReadable(self):
+      Start = time.time()
+      Data = self.MyEMS.read(max(1, self.MyEMS.in_waiting))
+      Read = time.time()
+      if self.Capture is not None:
+         self.Capture.Write(Data, Read)
+      self.BytesRead += len(Data)
+      self.Framer.Feed(Data)
+      Metrics.Observe('nefitems_stage_seconds', 'stage="read"', Read-Start)
+      Metrics.Observe('nefitems_stage_seconds', 'stage="frame"', time.time()-Read)
+      Metrics.Count('nefitems_bytes_read_total', len(Data))
+      while self.Framer.Frames:
+         Message = self.Framer.Frames.popleft()
+         Start = time.time()
+         OK = FrameOK(Message)
+         Metrics.Observe('nefitems_stage_seconds', 'stage="crc"', time.time()-Start)
+         if not OK:
+            self.Framer.Resync(Message)
+            continue
+         if self.Framer.OnFrame is not None and self.Framer.OnFrame(Message):
+            continue
+         Type = ord(Message[2:3])
+         Metrics.Count('nefitems_frames_total', 1, 'type="'+hex(Type)+'"')
+         if Type in MessageParseDispatcher:
+            self.OnMessage(Message)
+         else:
+            Catalogue.Add(Message)
+
+   def Report(self):
+      return('Bytes read='+str(self.BytesRead))
+
+#################################################################################
+# Non-blocking Domoticz publisher for the event loop, with the same interface and
+# coalescing as DomoticzPublisher, but with up to Connections requests in flight
+# at the same time. Each connection is a small state machine: connect, (TLS
+# handshake,) send the request, receive the response, and then it stays open
+# for the next request. Every request has a Timeout, a request on a kept-alive
+# connection that the server closed in the meantime is retried once on a new one.
+# The host is resolved (IPv4 or IPv6) when the publisher is made, so the loop
+# doesn't wait for DNS. When that fails a connect starts a lookup on a helper
+# thread, at most once per Timeout, and the connects fail right away until it
+# succeeds: a lookup against a dead resolver can take seconds, the loop would
+# not read the serial port in the meantime.
+#################################################################################
+class AsyncDomoticzConnection(object):
+   def __init__(self, Publisher):
+      self.Publisher = Publisher
+      self.Loop = Publisher.Loop
+      self.Socket = None
+      self.State = 'idle'
+      self.Timer = None
+      self.Reused = False
+
+   def Request(self, URL, Value):
+      URLParts = urlparse.urlsplit(URL)
+      self.URL = URL
+      self.Value = Value
+      self.Outgoing = 'GET '+URLParts.path+'?'+URLParts.query+Value+' HTTP/1.1\r\nHost: '+self.Publisher.NetLoc+'\r\nConnection: keep-alive\r\n\r\n'
+      self.Incoming = b''
+      self.Start = time.time()
+      self.Timer = self.Loop.CallLater(self.Publisher.Timeout, self.OnTimeout)
+      self.Reused = self.Socket is not None
+      if self.Socket is None:
+         self.Connect()
+      else:
+         self.Sending()
+
+   def Connect(self):
+      try:
+         Family, SocketType, Protocol, Address = self.Publisher.Resolve()
+         self.Socket = socket.socket(Family, SocketType, Protocol)
+         self.FileNo = self.Socket.fileno()
+         self.Socket.setblocking(0)
+         Error = self.Socket.connect_ex(Address)
+         if Error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            raise socket.error(Error, os.strerror(Error))
+      except socket.error as fout:
+         self.Fail(fout)
+         return
+      self.State = 'connect'
+      self.Loop.AddWriter(self.FileNo, self.OnWritable)
+
+   def Sending(self):
+      self.State = 'send'
+      self.Loop.RemoveReader(self.FileNo)
+      self.Loop.AddWriter(self.FileNo, self.OnWritable)
+
+   def Receiving(self):
+      self.State = 'receive'
+      self.Loop.RemoveWriter(self.FileNo)
+      self.Loop.AddReader(self.FileNo, self.OnReadable)
+
+   def Handshake(self):
+      try:
+         self.Socket.do_handshake()
+      except ssl.SSLWantReadError:
+         self.Loop.RemoveWriter(self.FileNo)
+         self.Loop.AddReader(self.FileNo, self.OnReadable)
+         return
+      except ssl.SSLWantWriteError:
+         self.Loop.RemoveReader(self.FileNo)
+         self.Loop.AddWriter(self.FileNo, self.OnWritable)
+         return
+      self.Sending()
+
+   def OnWritable(self):
+      try:
+         if self.State == 'connect':
+            Error = self.Socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if Error:
+               raise socket.error(Error, os.strerror(Error))
+            if self.Publisher.Scheme == 'https':
+               self.Socket = UnverifiedSSLContext().wrap_socket(self.Socket, server_hostname=self.Publisher.Address[0], do_handshake_on_connect=False)
+               self.State = 'handshake'
+            else:
+               self.State = 'send'
+         if self.State == 'handshake':
+            self.Handshake()
+         elif self.State == 'send':
+            Sent = self.Socket.send(self.Outgoing)
+            self.Outgoing = self.Outgoing[Sent:]
+            if not self.Outgoing:
+               self.Receiving()
+      except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+         pass
+      except (socket.error, ssl.SSLError) as fout:
+         self.Fail(fout)
+
+   def OnReadable(self):
+      try:
+         if self.State == 'handshake':
+            self.Handshake()
+            return
+         while True:
+            Data = self.Socket.recv(4096)
+            if not Data:
+               self.Fail(socket.error('connection closed by Domoticz'))
+               return
+            self.Incoming += Data
+            if not (isinstance(self.Socket, ssl.SSLSocket) and self.Socket.pending()):
+               break
+      except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+         return
+      except (socket.error, ssl.SSLError) as fout:
+         self.Fail(fout)
+         return
+      self.Parse()
+
+   # Waits for a complete response: the headers and a body of Content-Length,
+   # or a chunked body up to its last (empty) chunk.
+   def Parse(self):
+      HeaderEnd = self.Incoming.find(b'\r\n\r\n')
+      if HeaderEnd < 0:
+         return
+      Lines = self.Incoming[:HeaderEnd].split(b'\r\n')
+      Headers = dict((Name.strip().lower(), Value.strip()) for Name, Separator, Value in (Line.partition(b':') for Line in Lines[1:]))
+      Body = self.Incoming[HeaderEnd+4:]
+      if 'content-length' in Headers:
+         if len(Body) < int(Headers['content-length']):
+            return
+      elif Headers.get('transfer-encoding', '').lower() == 'chunked':
+         if not Body.endswith(b'0\r\n\r\n'):
+            return
+      else:
+         # No length, the response ends when the server closes the connection,
+         # which we don't wait for.
+         Headers['connection'] = 'close'
+      try:
+         Status = int(Lines[0].split()[1])
+      except (IndexError, ValueError):
+         self.Fail(httplib.BadStatusLine(Lines[0]))
+         return
+      self.Loop.CancelTimer(self.Timer)
+      self.Loop.RemoveReader(self.FileNo)
+      if Headers.get('connection', '').lower() == 'close':
+         self.Close()
+      self.State = 'idle'
+      self.Publisher.Done(self, self.URL, Status, time.time()-self.Start)
+
+   def OnTimeout(self):
+      self.Timer = None
+      self.Reused = False
+      self.Fail(socket.timeout('timed out'))
+
+   def Fail(self, Error):
+      if self.Timer is not None:
+         self.Loop.CancelTimer(self.Timer)
+      self.Close()
+      self.State = 'idle'
+      if self.Reused:
+         # The server closed the kept-alive connection, retry on a new one.
+         self.Request(self.URL, self.Value)
+         self.Reused = False
+         return
+      self.Publisher.Failed(self, self.URL, Error)
+
+   def Close(self):
+      if self.Socket is not None:
+         self.Loop.RemoveReader(self.FileNo)
+         self.Loop.RemoveWriter(self.FileNo)
+         self.Socket.close()
+         self.Socket = None
+
+class AsyncDomoticzPublisher(object):
+   def __init__(self, Loop, Host=DomoticzHost, Connections=4, MaxPending=64, Timeout=10):
+      HostParts = urlparse.urlsplit(Host)
+      self.Loop = Loop
+      self.Scheme = HostParts.scheme
+      self.NetLoc = HostParts.netloc
+      self.Address = (HostParts.hostname, HostParts.port or (443 if self.Scheme == 'https' else 80))
+      self.MaxPending = MaxPending
+      self.Timeout = Timeout
+      self.AddressInfo = None
+      self.ResolveError = None
+      self.ResolveTime = time.time()
+      self.Resolving = False
+      try:
+         self.AddressInfo = self.Lookup()
+      except socket.error as fout:
+         self.ResolveError = fout
+         print("Error: "+str(fout)+" resolving "+str(self.Address[0]))
+      self.Pending = collections.OrderedDict()
+      self.Idle = [AsyncDomoticzConnection(self) for Connection in range(Connections)]
+      self.InFlight = set()
+      self.Spool = None
+      self.Sent = 0
+      self.Coalesced = 0
+      self.Dropped = 0
+      self.Errors = 0
+
+   def Start(self):
+      pass
+
+   # The (family, type, protocol, address) of the host, blocks on DNS.
+   def Lookup(self):
+      Family, SocketType, Protocol, Name, Address = socket.getaddrinfo(self.Address[0], self.Address[1], 0, socket.SOCK_STREAM)[0]
+      return((Family, SocketType, Protocol, Address))
+
+   def ResolveInBackground(self):
+      try:
+         self.AddressInfo = self.Lookup()
+      except socket.error as fout:
+         self.ResolveError = fout
+      finally:
+         self.Resolving = False
+
+   # The (family, type, protocol, address) to connect to, raises socket.error
+   # (socket.gaierror) when the host hasn't been resolved (yet).
+   def Resolve(self):
+      if self.AddressInfo is None:
+         if not self.Resolving and time.time()-self.ResolveTime >= self.Timeout:
+            self.Resolving = True
+            self.ResolveTime = time.time()
+            Thread = threading.Thread(target=self.ResolveInBackground, name='DomoticzResolver')
+            Thread.daemon = True
+            Thread.start()
+         raise self.ResolveError
+      return(self.AddressInfo)
+
+   def Publish(self, URL, Value):
+      if URL in self.Pending:
+         self.Coalesced += 1
+      elif len(self.Pending) >= self.MaxPending:
+         self.Dropped += 1
+         return
+      self.Pending[URL] = Value
+      self.Next()
+
+   # Starts the oldest pending updates on the idle connections, an idx that is
+   # still in flight waits, so its updates can't overtake each other.
+   def Next(self):
+      for URL in list(self.Pending):
+         if not self.Idle:
+            return
+         if URL not in self.InFlight:
+            Value = self.Pending.pop(URL)
+            self.InFlight.add(URL)
+            self.Idle.pop().Request(URL, Value)
+
+   def Done(self, Connection, URL, Status, Seconds):
+      Metrics.Observe('nefitems_domoticz_request_seconds', '', Seconds)
+      if Status != 200:
+         self.Errors += 1
+         print("Error: HTTP "+str(Status)+" URL: "+URL)
+         if Status >= 500 and self.Spool is not None:
+            self.Spool.Append(URL, Connection.Value)
+      else:
+         self.Sent += 1
+         if self.Spool is not None:
+            self.Spool.Sent(URL)
+      self.Release(Connection, URL)
+
+   def Failed(self, Connection, URL, Error):
+      self.Errors += 1
+      print("Error: "+str(Error)+" URL: "+URL)
+      if self.Spool is not None:
+         self.Spool.Append(URL, Connection.Value)
+      self.Release(Connection, URL)
+
+   def Release(self, Connection, URL):
+      self.InFlight.discard(URL)
+      self.Idle.append(Connection)
+      self.Next()
+
+   def Close(self):
+      for Connection in self.Idle:
+         Connection.Close()
+
+#################################################################################
+# Change Filter, keeps the last value pushed per sensor and suppresses values
+# that are within the deadband of it (see DeadbandDictionary), unless the sensor
+# has been silent for longer than the heartbeat, so Domoticz still sees it alive.
+#################################################################################
+class ChangeFilter(object):
+   def __init__(self, Deadbands=DeadbandDictionary, Heartbeat=DomoticzHeartbeat):
+      self.Deadbands = Deadbands
+      self.Heartbeat = Heartbeat
+      self.LastValue = dict()
+      self.LastTime = dict()
+      self.Passed = 0
+      self.Suppressed = 0
+
+   def Changed(self, URL, Value, Now=None):
+      if Now is None:
+         Now = time.time()
+      if URL in self.LastValue and (Now-self.LastTime[URL]) < self.Heartbeat:
+         Last = self.LastValue[URL]
+         if isinstance(Value, basestring) or isinstance(Last, basestring):
+            Suppress = (Value == Last)
+         else:
+            Absolute, Relative = self.Deadbands.get(URL, (0.0, 0.0))
+            Difference = abs(Value-Last)
+            Suppress = (Difference <= Absolute) or (Difference <= Relative*abs(Last))
+         if Suppress:
+            self.Suppressed += 1
+            return(False)
+      self.LastValue[URL] = Value
+      self.LastTime[URL] = Now
+      self.Passed += 1
+      return(True)
+
+   def Report(self):
+      Total = self.Passed+self.Suppressed
+      return('Updates passed='+str(self.Passed)+', suppressed='+str(self.Suppressed)+' ('+str((100*self.Suppressed)//max(Total, 1))+'%)')
+
+DomoticzFilter = ChangeFilter()
+
+#################################################################################
+# Update Domoticz, unchanged values are filtered out first, the others are handed
+# to the publisher, which takes care of network problems or problems on the
+# domoticz host.
 #################################################################################
 def UpdateDomoticz(URL, Value):
-   try:
-      Page=urllib2.urlopen(URL+Value.__str__(), context=UnverifiedContext)
-      DataString=Page.read()
-   except (urllib2.HTTPError, urllib2.URLError, httplib.BadStatusLine) as fout:
-      print("Error: "+str(fout)+" URL: "+URL)
+   if DomoticzFilter.Changed(URL, Value):
+      Publisher.Publish(URL, Value.__str__())
 
 def UpdateDomoticzText(URL, Text):
-   TextValue=urllib2.quote(Text)
-   try:
-      Page=urllib2.urlopen(URL+TextValue, context=UnverifiedContext)
-      DataString=Page.read()
-   except (urllib2.HTTPError, urllib2.URLError, httplib.BadStatusLine) as fout:
-      print("Error: "+str(fout)+" URL: "+URL)
+   if DomoticzFilter.Changed(URL, Text):
+      Publisher.Publish(URL, urllib2.quote(Text))
 
 #################################################################################
-# Calculate System efficiency by interpolation i.c.w. lookup dictionary
+# Calculate System efficiency by interpolation in the efficiency curve, the
+# EfficiencyDictionary as sorted lists. Below 10C and above 100C the efficiency
+# at the end of the curve is used. A single temperature is looked up with bisect
+# in plain python, that's what the parsers do for every telegram. Temperature
+# can also be an array, to calculate a whole window of samples at once with
+# numpy.interp (the curve as numpy arrays is built on first use).
 #################################################################################
+EfficiencyTemperatures = [float(Key) for Key in sorted(EfficiencyDictionary)]
+EfficiencyValues = [float(EfficiencyDictionary[Key]) for Key in sorted(EfficiencyDictionary)]
+EfficiencyCurve = None
+
 def CalculateSystemEfficiency(Temperature):
-   LowValue=float(EfficiencyDictionary[(int(Temperature))])
-   HighValue=float(EfficiencyDictionary[(int(Temperature)+1)])
-   Fraction=Temperature-(int(Temperature))
-   #Efficiency goes down as temperature goes up, the high and low refer to the
-   #temperature, not the efficiency. Fraction*(HighValue-LowValue) is a negative number.
-   Efficiency=LowValue+(Fraction*(HighValue-LowValue))
-   return(Efficiency)
+   global EfficiencyCurve
+   if isinstance(Temperature, (int, long, float)):
+      #A plain float, numpy floats are slow and can't be marshalled by the bus workers.
+      Temperature = float(Temperature)
+      Temperatures = EfficiencyTemperatures
+      Values = EfficiencyValues
+      if Temperature <= Temperatures[0]:
+         return(Values[0])
+      if Temperature >= Temperatures[-1]:
+         return(Values[-1])
+      High = bisect.bisect_right(Temperatures, Temperature)
+      Low = High-1
+      return(Values[Low]+(Temperature-Temperatures[Low])*(Values[High]-Values[Low])/(Temperatures[High]-Temperatures[Low]))
+   if EfficiencyCurve is None:
+      EfficiencyCurve = (numpy.array(EfficiencyTemperatures), numpy.array(EfficiencyValues))
+   return(numpy.interp(Temperature, EfficiencyCurve[0], EfficiencyCurve[1]))
 
 #################################################################################
-# Our Message Parse Functions
+# Derived values, calculated from the decoded fields of a message. They get the
+# Result dictionary of the message and add their values to it.
 #################################################################################
-def UBAMonitorFast(Msg):
-   Result = dict()
-   #First do sanity check on MsgID and size, if ok parse the message.
-   MsgSize=len(Msg)
-   if (Msg[2] == '0x18') and MsgSize == 30:
-      Result['RequestedFlowTemperature']=ConvertToFloat([Msg[4]],1.0)
-      Result['FlowTemperature']=ConvertToFloat([Msg[5],Msg[6]],0.1)
-      Result['RequestedBurnerDutyCycle']=ConvertToFloat([Msg[7]],1.0)
-      Result['BurnerDutyCycle']=ConvertToFloat([Msg[8]],1.0)
-      Result['Boiler']=ConvertToFloat([Msg[15],Msg[16]],0.1)
-      Result['FlowReturnTemperature']=ConvertToFloat([Msg[17],Msg[18]],0.1)
-      Result['IonizationCurrent']=ConvertToFloat([Msg[19],Msg[20]],0.1)
-      Result['Pressure']=ConvertToFloat([Msg[21]],0.1)
-      Result['StatusCode']=(chr(int(Msg[22],16))+(chr(int(Msg[23],16))))
-      Result['ErrorCode']=ConvertToint([Msg[24],Msg[25]])
-      Result['DeltaT']=Result['FlowTemperature']-Result['FlowReturnTemperature']
-      if StatusDictionary.has_key(Result['StatusCode']):
-         Result['StatusText']=StatusDictionary[Result['StatusCode']]
-         UpdateDomoticzText(StatusURL, Result['StatusText'])
-	 if Result['StatusCode'] == '-H':
-	    Result['SystemStatus'] = 1
-	 elif Result['StatusCode'] == '=H':
-	    Result['SystemStatus'] = 2
-	 else:
-	    Result['SystemStatus'] = 0
-	 UpdateDomoticz(SystemStatusURL, Result['SystemStatus'])
-      #Result['WarmWaterOut']=(float((256*int(Msg[13],16))+int(Msg[14],16))/10)
-      UpdateDomoticz(DeltaTURL, Result['DeltaT']) 
-      UpdateDomoticz(FlowTemperatureURL, Result['FlowTemperature']) 
-      UpdateDomoticz(ReturnFlowTemperatureURL, Result['FlowReturnTemperature']) 
-      UpdateDomoticz(BurnerDutyCycleURL, Result['BurnerDutyCycle']) 
-      UpdateDomoticz(SystemPressureURL, Result['Pressure']) 
-      UpdateDomoticz(IonizationCurrentURL, Result['IonizationCurrent'])
-      Result['Efficiency']=CalculateSystemEfficiency(float(Result['FlowReturnTemperature']))
-      UpdateDomoticz(SystemEfficiencyURL, Result['Efficiency'])
-   return(Result)
+def UBAMonitorFastDerived(Result):
+   Result['DeltaT']=Result['FlowTemperature']-Result['FlowReturnTemperature']
+   if StatusDictionary.has_key(Result['StatusCode']):
+      Result['StatusText']=StatusDictionary[Result['StatusCode']]
+      if Result['StatusCode'] == '-H':
+         Result['SystemStatus'] = 1
+      elif Result['StatusCode'] == '=H':
+         Result['SystemStatus'] = 2
+      else:
+         Result['SystemStatus'] = 0
+   Result['Efficiency']=CalculateSystemEfficiency(float(Result['FlowReturnTemperature']))
 
-def UBAMonitorSlow(Msg):
-   Result = dict()
-   #First do sanity check on MsgID and size, if ok parse the message.
-   MsgSize=len(Msg)
-   if (Msg[2] == '0x19') and MsgSize == 32:
-      Result['BurnerOutWaterTemperature']=ConvertToFloat([Msg[6],Msg[7]],0.1)
-      Result['PumpDutyCycle']=ConvertToFloat([Msg[13]],1.0)
-      Result['BurnerStarts']=ConvertToint([Msg[14],Msg[15],Msg[16]])
-      Result['BurnerRuntimeInMinutes']=ConvertToint([Msg[17],Msg[18],Msg[19]])
-      Result['HeatingRuntimeInMinutes']=ConvertToint([Msg[23],Msg[24],Msg[25]])
-      Result['HotWaterRuntimeInMinutes']=Result['BurnerRuntimeInMinutes']-Result['HeatingRuntimeInMinutes']
-      UpdateDomoticz(BurnerTemperatureURL, Result['BurnerOutWaterTemperature'])
-      UpdateDomoticz(PumpDutyCycleURL, Result['PumpDutyCycle'])
-      UpdateDomoticz(RuntimeHeatingURL, (float(Result['HeatingRuntimeInMinutes'])/60))
-      UpdateDomoticz(RuntimeHotWaterURL, (float(Result['HotWaterRuntimeInMinutes'])/60))
-      UpdateDomoticz(BurnerStartsURL, Result['BurnerStarts'])
-   return(Result)
+def UBAMonitorSlowDerived(Result):
+   Result['HotWaterRuntimeInMinutes']=Result['BurnerRuntimeInMinutes']-Result['HeatingRuntimeInMinutes']
+   Result['HeatingRuntimeInHours']=float(Result['HeatingRuntimeInMinutes'])/60
+   Result['HotWaterRuntimeInHours']=float(Result['HotWaterRuntimeInMinutes'])/60
 
-def Moduline300Status(Msg):
-   Result = dict()
-   #First do sanity check on MsgID and size, if ok parse the message.
-   MsgSize=len(Msg)
-   if (Msg[2] == '0x91') and MsgSize == 19:
-      Result['Setpoint']=ConvertToFloat([Msg[5]],0.5)
-      Result['Actual']=ConvertToFloat([Msg[15],Msg[16]],0.1)
-      UpdateDomoticz(RoomTemperatureURL, Result['Actual'])
-      UpdateDomoticz(RoomSetpointURL, Result['Setpoint'])
-   return(Result)
+#################################################################################
+# Our Message Schema Table, its a dictionary with the Message Type as Key, and
+# per message type:
+#   Name    : Name of the message.
+#   Size    : Expected message size, including header and CRC.
+#   Fields  : (Name, Offset, Format, Scale), Offset is the position in the 
+#             message (so including the 4 header bytes), Format is a struct
+#             format, uppercase unsigned and lowercase signed: 'B'/'b' 1 byte, 
+#             'H'/'h' 2 bytes, or 'T' for 3 bytes unsigned (struct has no 24 bit
+#             type) and 'Ns' for N raw bytes. Scale None keeps the value an int.
+#   Derived : Optional function to calculate derived values.
+#   Publish : (Name, URL), the Domoticz sensors the DomoticzSink pushes the
+#             values to.
+# Adding a message type (or a field) is just adding data to this table.
+# Only the types of which we know the fields are in here, the others go to the
+# Catalogue to be figured out. Seen on the bus, not known yet:
+#   0x07 : 08 00 07 00 03 80 00 00 00 00 00 00 00 00 00 00 00 6b
+#   0x35 : 17 08 35 00 11 00 c1 (flags?)
+#   0xa2 : 17 00 a2 00 00 00 00 00 00 00 00 00 00 00 00 00 00 51
+#################################################################################
+MessageSchema = {
+   0x06: {
+      'Name': 'RCTimeMessage',
+      'Size': 18,
+      'Fields': [
+         ('Year', 4, 'B', None),
+         ('Month', 5, 'B', None),
+         ('Hour', 6, 'B', None),
+         ('Day', 7, 'B', None),
+         ('Minute', 8, 'B', None),
+         ('Second', 9, 'B', None),
+         ('DayOfWeek', 10, 'B', None),
+      ],
+   },
+   0x18: {
+      'Name': 'UBAMonitorFast',
+      'Size': 30,
+      'Fields': [
+         ('RequestedFlowTemperature', 4, 'B', 1.0),
+         ('FlowTemperature', 5, 'H', 0.1),
+         ('RequestedBurnerDutyCycle', 7, 'B', 1.0),
+         ('BurnerDutyCycle', 8, 'B', 1.0),
+         ('Boiler', 15, 'H', 0.1),
+         ('FlowReturnTemperature', 17, 'H', 0.1),
+         ('IonizationCurrent', 19, 'H', 0.1),
+         ('Pressure', 21, 'B', 0.1),
+         ('StatusCode', 22, '2s', None),
+         ('ErrorCode', 24, 'H', None),
+      ],
+      'Derived': UBAMonitorFastDerived,
+      'Publish': [
+         ('StatusText', StatusURL),
+         ('SystemStatus', SystemStatusURL),
+         ('DeltaT', DeltaTURL),
+         ('FlowTemperature', FlowTemperatureURL),
+         ('FlowReturnTemperature', ReturnFlowTemperatureURL),
+         ('BurnerDutyCycle', BurnerDutyCycleURL),
+         ('Pressure', SystemPressureURL),
+         ('IonizationCurrent', IonizationCurrentURL),
+         ('Efficiency', SystemEfficiencyURL),
+      ],
+   },
+   0x19: {
+      'Name': 'UBAMonitorSlow',
+      'Size': 32,
+      'Fields': [
+         ('BurnerOutWaterTemperature', 6, 'H', 0.1),
+         ('PumpDutyCycle', 13, 'B', 1.0),
+         ('BurnerStarts', 14, 'T', None),
+         ('BurnerRuntimeInMinutes', 17, 'T', None),
+         ('HeatingRuntimeInMinutes', 23, 'T', None),
+      ],
+      'Derived': UBAMonitorSlowDerived,
+      'Publish': [
+         ('BurnerOutWaterTemperature', BurnerTemperatureURL),
+         ('PumpDutyCycle', PumpDutyCycleURL),
+         ('HeatingRuntimeInHours', RuntimeHeatingURL),
+         ('HotWaterRuntimeInHours', RuntimeHotWaterURL),
+         ('BurnerStarts', BurnerStartsURL),
+      ],
+   },
+   # UBASollwerte
+   0x1a: {
+      'Name': 'UBASetPoints',
+      'Size': 9,
+      'Fields': [
+         ('FlowSetpoint', 4, 'B', 1.0),
+         ('BurnerPowerSetpoint', 5, 'B', 1.0),
+      ],
+   },
+   # UBA WartungsMeldung, seen as: 08 00 1c 00 80 01 01 01 11 ..., a date of 1-1-(20)17.
+   0x1c: {
+      'Name': 'UBAMaintenanceMessage',
+      'Size': 16,
+      'Fields': [
+         ('MaintenanceFlags', 4, 'B', None),
+         ('MaintenanceMessage', 5, 'B', None),
+         ('MaintenanceDay', 6, 'B', None),
+         ('MaintenanceMonth', 7, 'B', None),
+         ('MaintenanceYear', 8, 'B', None),
+      ],
+   },
+   0x34: {
+      'Name': 'UBAMonitorWWMessage',
+      'Size': 22,
+      'Fields': [
+         ('WarmWaterOutTemperature', 5, 'H', 0.1),
+         ('BoilerTemperature', 7, 'H', 0.1),
+         ('WarmWaterFlow', 13, 'B', 0.1),
+      ],
+      'Publish': [
+         ('WarmWaterFlow', HotWaterFlowURL),
+      ],
+   },
+   0x91: {
+      'Name': 'Moduline300Status',
+      'Size': 19,
+      'Fields': [
+         ('Setpoint', 5, 'B', 0.5),
+         ('Actual', 15, 'H', 0.1),
+      ],
+      'Publish': [
+         ('Actual', RoomTemperatureURL),
+         ('Setpoint', RoomSetpointURL),
+      ],
+   },
+   # RC Temp Message?
+   0xa3: {
+      'Name': 'RCOutdoorTemperature',
+      'Size': 8,
+      'Fields': [
+         ('DampedOutdoorTemperature', 4, 'b', 1.0),
+      ],
+   },
+}
 
-def UBAMonitorWWMessage(Msg):
-   Result = dict()
-   #First do sanity check on MsgID and size, if ok parse the message.
-   MsgSize=len(Msg)
-   if (Msg[2] == '0x34') and MsgSize == 22:
-      Result['BoilerTemperature']=ConvertToFloat([Msg[7],Msg[8]],0.1)
-      Result['WarmWaterOutTemperature']=ConvertToFloat([Msg[5],Msg[6]],0.1)
-      Result['WarmWaterFlow']=ConvertToFloat([Msg[13]],0.1)
-      UpdateDomoticz(HotWaterFlowURL, Result['WarmWaterFlow'])
-   return(Result)
+#################################################################################
+# The Message Parser, compiles the schema of one message type into a single
+# struct.Struct (with padding for the bytes we skip) and a plan with per value
+# its name, position in the unpacked tuple and scale. Decoding a message is then
+# one unpack call plus the scaling, Decode() has no side effects.
+#
+# Telegrams don't always come complete: the offset byte (Msg[3]) tells where in
+# the message the data bytes belong, and devices send parts of a message too.
+# Read requests (the receiver has bit 7 set) and telegrams with data beyond the
+# Size of the message are ignored.
+# So per sender the parser keeps an image of the message, Update() merges the
+# data bytes at their offset, and only the fields of which bytes changed (and of
+# which all bytes have been received) are decoded and returned, together with
+# the derived values that changed. Every RefreshInterval seconds all fields are
+# returned, so the Domoticz heartbeat keeps working. Calling the parser updates
+# the image and writes the returned values to the Output sinks.
+#################################################################################
+HeaderStruct = struct.Struct('>BBBB')
+
+class MessageParser(object):
+   def __init__(self, Type, Schema, RefreshInterval=DomoticzHeartbeat/2):
+      self.Type = Type
+      self.Name = Schema['Name']
+      self.Size = Schema['Size']
+      self.Derived = Schema.get('Derived')
+      self.Sensors = dict()
+      self.RefreshInterval = RefreshInterval
+      self.Plan = []
+      self.Fields = []
+      self.FieldsAt = [[] for Position in range(self.Size)]
+      self.Images = dict()
+      Format = '>'
+      Position = 0
+      Index = 0
+      for Name, Offset, FieldFormat, Scale in sorted(Schema['Fields'], key=lambda Field: Field[1]):
+         if Offset < Position:
+            raise ValueError(self.Name+': field '+Name+' overlaps the previous field')
+         Format += 'x'*(Offset-Position)
+         if FieldFormat == 'T':
+            FieldFormat = 'BH'
+            Width = 3
+            Items = 2
+         else:
+            Width = struct.calcsize('>'+FieldFormat)
+            Items = 1
+         Format += FieldFormat
+         self.Plan.append((Name, Index, Items, Scale))
+         Index += Items
+         Position = Offset+Width
+         if Position > self.Size-1:
+            raise ValueError(self.Name+': fields extend beyond the message size')
+         for Byte in range(Offset, Position):
+            self.FieldsAt[Byte].append(len(self.Fields))
+         self.Fields.append((Name, Offset, Width, struct.Struct('>'+FieldFormat), Items, Scale))
+      self.Struct = struct.Struct(Format)
+
+   # Msg is the telegram as bytes, or a memoryview on it (Frame.View).
+   def Decode(self, Msg):
+      Result = dict()
+      #First do sanity check on MsgID and size, if ok parse the message.
+      if len(Msg) != self.Size or HeaderStruct.unpack_from(Msg)[2] != self.Type:
+         return(Result)
+      Values = self.Struct.unpack_from(Msg)
+      for Name, Index, Items, Scale in self.Plan:
+         Value = Values[Index]
+         if Items == 2:
+            Value = (Value << 16) | Values[Index+1]
+         if Scale is not None:
+            Value = Value*Scale
+         Result[Name] = Value
+      if self.Derived:
+         self.Derived(Result)
+      return(Result)
+
+   def Update(self, Msg, Now=None):
+      Result = dict()
+      if len(Msg) < 6:
+         return(Result)
+      Sender, Receiver, Type, Offset = HeaderStruct.unpack_from(Msg)
+      # Read requests (receiver with bit 7 set) carry a length, not data, and
+      # data that doesn't fit in the message is not this message.
+      Offset += 4
+      End = Offset+len(Msg)-5
+      if Type != self.Type or Receiver & 0x80 or End > self.Size-1:
+         return(Result)
+      if Now is None:
+         Now = time.time()
+      Payload = bytearray(Msg[4:4+End-Offset])
+      Image = self.Images.get(Sender)
+      if Image is None:
+         # Data, Valid, Values and the time of the last refresh.
+         Image = self.Images[Sender] = [bytearray(self.Size), bytearray(self.Size), dict(), None]
+      Data, Valid, Values, LastRefresh = Image
+      Changed = set()
+      if Data[Offset:End] != Payload or 0 in Valid[Offset:End]:
+         FieldsAt = self.FieldsAt
+         for Position in range(Offset, End):
+            Byte = Payload[Position-Offset]
+            if Data[Position] != Byte or not Valid[Position]:
+               Data[Position] = Byte
+               Valid[Position] = 1
+               Changed.update(FieldsAt[Position])
+      Refresh = LastRefresh is None or (Now-LastRefresh) >= self.RefreshInterval
+      if Refresh:
+         Changed = range(len(self.Fields))
+         Image[3] = Now
+      for Index in Changed:
+         Name, Start, Width, FieldStruct, Items, Scale = self.Fields[Index]
+         if 0 in Valid[Start:Start+Width]:
+            continue
+         Value = FieldStruct.unpack_from(Data, Start)
+         if Items == 2:
+            Value = (Value[0] << 16) | Value[1]
+         else:
+            Value = Value[0]
+         if Scale is not None:
+            Value = Value*Scale
+         Result[Name] = Value
+      Metrics.Count('nefitems_fields_decoded_total', len(Result))
+      if Result and self.Derived:
+         Current = dict(Values)
+         Current.update(Result)
+         try:
+            self.Derived(Current)
+         except KeyError:
+            # Not all inputs of the derived values have been received yet.
+            pass
+         for Name, Value in Current.items():
+            if Refresh or Name not in Values or Values[Name] != Value:
+               Result[Name] = Value
+         Image[2] = Current
+      else:
+         Values.update(Result)
+      return(Result)
+
+   # The (Time, Sensor, Value) records of a result, the sensor is the message
+   # and the field name, after the bus name with --bus: [Bus/]Message/Field.
+   def Records(self, Result, Time, Bus=None):
+      Sensors = self.Sensors.get(Bus)
+      if Sensors is None:
+         Sensors = self.Sensors[Bus] = dict()
+      Records = []
+      for Name, Value in Result.items():
+         Sensor = Sensors.get(Name)
+         if Sensor is None:
+            Sensor = Sensors[Name] = (Bus+'/' if Bus else '')+self.Name+'/'+Name
+         Records.append((Time, Sensor, Value))
+      return(Records)
+
+   def Publish(self, Result, Time=None, Bus=None):
+      if Result:
+         Output.Write(self.Records(Result, time.time() if Time is None else Time, Bus))
+
+   def __call__(self, Msg):
+      Start = time.time()
+      Result = self.Update(Msg)
+      Decoded = time.time()
+      self.Publish(Result, Decoded)
+      Metrics.Observe('nefitems_stage_seconds', 'stage="parse"', Decoded-Start)
+      Metrics.Observe('nefitems_stage_seconds', 'stage="publish"', time.time()-Decoded)
+      return(Result)
 
 # Dumping Raw Message, usefull for inpecting unknown message types
 def Raw(Msg):
@@ -479,52 +2283,1217 @@ def Raw(Msg):
 #################################################################################
 # Our Parse Table, its a dictionary with the Message Typ as Key, an easy
 # way to explicitly parse the messages, it is also the definition of what to
-# parse and thus implicitly to skip anything else.
+# parse and thus implicitly to skip anything else. It is generated from the
+# MessageSchema table.
 #################################################################################
-MessageParseDispatcher = {
-   '0x18': UBAMonitorFast,
-   '0x19': UBAMonitorSlow,
-   '0x34': UBAMonitorWWMessage,
-   '0x91': Moduline300Status,
-}
+MessageParseDispatcher = dict((Type, MessageParser(Type, Schema)) for Type, Schema in MessageSchema.items())
+
+#################################################################################
+# Output Sinks, the parsers write their values as batches of (Time, Sensor, Value)
+# records to Output, which hands them to the sinks. A sink has Write(Records),
+# Flush() (called when the output is idle) and Close().
+#  - DomoticzSink: the sensors in the Publish lists of the MessageSchema, through
+#    the change filter to the Domoticz Publisher.
+#  - InfluxLineSink: InfluxDB line protocol in a file, the fields of a message in
+#    one line, written in bulk when BufferBytes are buffered or the oldest line
+#    is FlushInterval seconds old.
+#  - MQTTSink: one topic per sensor, <Prefix>/[Bus/]Message/Field, published with
+#    QoS 0 by a minimal MQTT 3.1.1 client. A batch goes out in one send, when the
+#    broker is down the records are dropped and it retries after RetryInterval.
+# OutputFanOut hands the batches to all sinks from one thread (or the event
+# loop), so the ingest path only appends the batch to a queue however many sinks
+# there are. Before Start() it writes to the sinks directly. The thread shares the
+# interpreter with the ingest path, so instead of waking up for every batch it
+# lets the batches gather for GatherInterval and gives the sinks all of them at
+# once: one Influx write, one MQTT send and no thread switch per batch (half of
+# MaxBatches queued ends the gathering early). When MaxBatches are queued the
+# ingest thread waits for the sinks (a replay shouldn't lose records), on the
+# event loop, which can't wait for itself, the oldest batch is dropped.
+#################################################################################
+InfluxBufferBytes = 64*1024
+MQTTPort = 1883
+MQTTPrefix = 'nefitems'
+
+class OutputSink(object):
+   def Flush(self):
+      pass
+
+   def Close(self):
+      self.Flush()
+
+   def Report(self):
+      return(self.__class__.__name__)
+
+class DomoticzSink(OutputSink):
+   def __init__(self, IdxOffsets=None):
+      self.IdxOffsets = IdxOffsets or dict()
+      self.Sensors = dict((Schema['Name']+'/'+Name, URL) for Schema in MessageSchema.values() for Name, URL in Schema.get('Publish', []))
+      self.URLs = dict()
+
+   # The URL of a sensor, None for sensors that are not pushed to Domoticz.
+   def URL(self, Sensor):
+      if Sensor in self.URLs:
+         return(self.URLs[Sensor])
+      Parts = Sensor.split('/')
+      URL = self.Sensors.get('/'.join(Parts[-2:]))
+      if URL is not None and len(Parts) > 2:
+         URL = BusURL(URL, self.IdxOffsets.get(Parts[0], 0))
+      self.URLs[Sensor] = URL
+      return(URL)
+
+   def Write(self, Records):
+      for Time, Sensor, Value in Records:
+         URL = self.URL(Sensor)
+         if URL is not None:
+            if isinstance(Value, basestring):
+               UpdateDomoticzText(URL, Value)
+            else:
+               UpdateDomoticz(URL, Value)
+
+   def Report(self):
+      return(DomoticzFilter.Report())
+
+class InfluxLineSink(OutputSink):
+   def __init__(self, FileName, BufferBytes=InfluxBufferBytes, FlushInterval=5.0):
+      self.File = open(FileName, 'ab')
+      self.BufferBytes = BufferBytes
+      self.FlushInterval = FlushInterval
+      self.Keys = dict()
+      self.Lines = []
+      self.Buffered = 0
+      self.Oldest = None
+      self.Written = 0
+      self.Writes = 0
+
+   @staticmethod
+   def FieldValue(Value):
+      if isinstance(Value, basestring):
+         if not all(32 <= ord(Character) < 127 for Character in Value):
+            Value = binascii.hexlify(Value)
+         return('"'+Value.replace('\\', '\\\\').replace('"', '\\"')+'"')
+      if isinstance(Value, (int, long)):
+         return(str(Value)+'i')
+      return(repr(float(Value)))
+
+   def Write(self, Records):
+      # The fields with the same time and measurement go in one line, the records
+      # of a message come one after the other, so that is mostly the last line.
+      Keys = self.Keys
+      Points = dict()
+      Order = []
+      Last = None
+      Fields = None
+      for Time, Sensor, Value in Records:
+         Key = Keys.get(Sensor)
+         if Key is None:
+            Parts = Sensor.split('/')
+            Key = Keys[Sensor] = (Parts[-2]+(',bus='+Parts[0] if len(Parts) > 2 else ''), Parts[-1]+'=')
+         if Last is None or Last[0] != Time or Last[1] is not Key[0]:
+            Last = (Time, Key[0])
+            Fields = Points.get(Last)
+            if Fields is None:
+               Fields = Points[Last] = []
+               Order.append(Last)
+         Fields.append(Key[1]+(repr(Value) if type(Value) is float else self.FieldValue(Value)))
+      for Time, Series in Order:
+         Line = Series+' '+','.join(Points[(Time, Series)])+' '+str(int(Time*1e9))+'\n'
+         self.Lines.append(Line)
+         self.Buffered += len(Line)
+      if self.Oldest is None and self.Lines:
+         self.Oldest = time.time()
+      if self.Buffered >= self.BufferBytes or (self.Oldest is not None and time.time()-self.Oldest >= self.FlushInterval):
+         self.Flush()
+
+   def Flush(self):
+      if self.Lines:
+         self.File.write(''.join(self.Lines))
+         self.File.flush()
+         self.Written += len(self.Lines)
+         self.Writes += 1
+         self.Lines = []
+         self.Buffered = 0
+         self.Oldest = None
+
+   def Close(self):
+      self.Flush()
+      self.File.close()
+
+   def Report(self):
+      return('Influx lines='+str(self.Written)+', writes='+str(self.Writes))
+
+def MQTTPacket(Type, Body):
+   Length = len(Body)
+   if Length < 128:
+      return(chr(Type)+chr(Length)+Body)
+   Header = bytearray([Type])
+   while True:
+      Byte = Length & 0x7f
+      Length >>= 7
+      Header.append(Byte | (0x80 if Length else 0))
+      if not Length:
+         return(bytes(Header)+Body)
+
+def MQTTString(Text):
+   return(struct.pack('>H', len(Text))+Text)
+
+def ParseMQTTArgument(Value):
+   Host, Separator, Port = Value.partition(':')
+   try:
+      return(Host, int(Port or MQTTPort))
+   except ValueError:
+      raise argparse.ArgumentTypeError('expected HOST[:PORT], got '+Value)
 
+class MQTTSink(OutputSink):
+   def __init__(self, Host='127.0.0.1', Port=MQTTPort, Prefix=MQTTPrefix, ClientID='nefitems', Retain=True, KeepAlive=60, Timeout=5, RetryInterval=30):
+      self.Host = Host
+      self.Port = Port
+      self.Prefix = Prefix
+      self.ClientID = ClientID
+      self.Flags = 0x31 if Retain else 0x30
+      self.KeepAlive = KeepAlive
+      self.Timeout = Timeout
+      self.RetryInterval = RetryInterval
+      self.Socket = None
+      self.RetryTime = 0
+      self.LastSend = 0
+      self.Topics = dict()
+      self.Sent = 0
+      self.Dropped = 0
+      self.Errors = 0
+
+   def Connect(self):
+      Socket = socket.create_connection((self.Host, self.Port), self.Timeout)
+      try:
+         # Protocol level 4 (3.1.1), clean session.
+         Socket.sendall(MQTTPacket(0x10, MQTTString(b'MQTT')+struct.pack('>BBH', 4, 0x02, self.KeepAlive)+MQTTString(self.ClientID)))
+         Reply = b''
+         while len(Reply) < 4:
+            Data = Socket.recv(4-len(Reply))
+            if not Data:
+               raise socket.error('connection closed by the broker')
+            Reply += Data
+         if Reply[0:1] != b'\x20' or Reply[3:4] != b'\x00':
+            raise socket.error('connection refused by the broker, code '+str(ord(Reply[3:4])))
+      except:
+         Socket.close()
+         raise
+      self.Socket = Socket
+      self.LastSend = time.time()
+
+   def Disconnect(self):
+      if self.Socket is not None:
+         self.Socket.close()
+         self.Socket = None
+
+   def Send(self, Data, Count=0):
+      if self.Socket is None:
+         if time.time() < self.RetryTime:
+            self.Dropped += Count
+            return
+         try:
+            self.Connect()
+         except socket.error as fout:
+            print('MQTT error: '+str(fout)+' Broker: '+self.Host+':'+str(self.Port))
+            self.Errors += 1
+            self.Dropped += Count
+            self.RetryTime = time.time()+self.RetryInterval
+            return
+      try:
+         self.Socket.sendall(Data)
+         self.LastSend = time.time()
+         self.Sent += Count
+      except socket.error as fout:
+         print('MQTT error: '+str(fout)+' Broker: '+self.Host+':'+str(self.Port))
+         self.Errors += 1
+         self.Dropped += Count
+         self.Disconnect()
+
+   def Write(self, Records):
+      # Most packets are short, their header is the flags and a single length
+      # byte, which is done inline instead of with MQTTPacket().
+      Topics = self.Topics
+      Flags = chr(self.Flags)
+      Packets = []
+      for Time, Sensor, Value in Records:
+         Topic = Topics.get(Sensor)
+         if Topic is None:
+            Topic = Topics[Sensor] = MQTTString(self.Prefix+'/'+Sensor)
+         Body = Topic+(Value if isinstance(Value, basestring) else str(Value))
+         if len(Body) < 128:
+            Packets.append(Flags+chr(len(Body))+Body)
+         else:
+            Packets.append(MQTTPacket(self.Flags, Body))
+      self.Send(b''.join(Packets), len(Packets))
+
+   # Keeps the connection alive, and reads the PINGRESP-s of the broker.
+   def Flush(self):
+      if self.Socket is None:
+         return
+      try:
+         while select.select([self.Socket], [], [], 0)[0]:
+            if not self.Socket.recv(4096):
+               self.Disconnect()
+               return
+      except socket.error:
+         self.Disconnect()
+         return
+      if time.time()-self.LastSend >= self.KeepAlive/2:
+         self.Send(b'\xc0\x00')
+
+   def Close(self):
+      if self.Socket is not None:
+         try:
+            self.Socket.sendall(b'\xe0\x00')
+         except socket.error:
+            pass
+         self.Disconnect()
+
+   def Report(self):
+      return('MQTT published='+str(self.Sent)+', dropped='+str(self.Dropped)+', errors='+str(self.Errors))
+
+class OutputFanOut(object):
+   def __init__(self, Sinks, MaxBatches=4096, IdleInterval=1.0, GatherInterval=0.05):
+      self.Sinks = Sinks
+      self.MaxBatches = MaxBatches
+      self.IdleInterval = IdleInterval
+      self.GatherInterval = GatherInterval
+      self.Pending = collections.deque()
+      self.Condition = threading.Condition()
+      self.Thread = None
+      self.Loop = None
+      self.Scheduled = False
+      self.Running = False
+      self.Batches = 0
+      self.Waits = 0
+      self.Dropped = 0
+
+   def Write(self, Records):
+      if self.Thread is None and self.Loop is None:
+         self.Deliver([Records])
+         return
+      with self.Condition:
+         if self.Thread is not None:
+            while len(self.Pending) >= self.MaxBatches and self.Running:
+               self.Waits += 1
+               self.Condition.wait(self.IdleInterval)
+         elif len(self.Pending) >= self.MaxBatches:
+            self.Pending.popleft()
+            self.Dropped += 1
+         self.Pending.append(Records)
+         # The thread waits for the first batch, and while the rest gather for
+         # half of MaxBatches, so the ingest doesn't have to wait for it.
+         if self.Thread is not None:
+            if len(self.Pending) in (1, self.MaxBatches//2):
+               self.Condition.notify_all()
+         elif not self.Scheduled:
+            self.Scheduled = True
+            self.Loop.CallLater(self.GatherInterval, self.DeliverPending)
+
+   def Deliver(self, Batches):
+      Records = Batches[0] if len(Batches) == 1 else [Record for Batch in Batches for Record in Batch]
+      self.Batches += len(Batches)
+      for Sink in self.Sinks:
+         try:
+            Sink.Write(Records)
+         except Exception as fout:
+            print('Output error: '+str(fout)+' Sink: '+Sink.__class__.__name__)
+
+   def DeliverPending(self):
+      with self.Condition:
+         Batches = list(self.Pending)
+         self.Pending.clear()
+         self.Scheduled = False
+         self.Condition.notify_all()
+      if Batches:
+         self.Deliver(Batches)
+
+   def FlushSinks(self):
+      for Sink in self.Sinks:
+         try:
+            Sink.Flush()
+         except Exception as fout:
+            print('Output error: '+str(fout)+' Sink: '+Sink.__class__.__name__)
+
+   def Run(self):
+      while self.Running or self.Pending:
+         with self.Condition:
+            if not self.Pending and self.Running:
+               self.Condition.wait(self.IdleInterval)
+            Idle = not self.Pending
+            if not Idle:
+               # Let the batches gather, but don't let the ingest wait for us.
+               Deadline = time.time()+self.GatherInterval
+               while self.Running and len(self.Pending) < self.MaxBatches//2:
+                  Left = Deadline-time.time()
+                  if Left <= 0:
+                     break
+                  self.Condition.wait(Left)
+         if Idle:
+            self.FlushSinks()
+         else:
+            self.DeliverPending()
+
+   def IdleTimer(self):
+      self.FlushSinks()
+      if self.Running:
+         self.Loop.CallLater(self.IdleInterval, self.IdleTimer)
+
+   # Delivers from a thread, or on the event loop Loop.
+   def Start(self, Loop=None):
+      self.Running = True
+      if Loop is not None:
+         self.Loop = Loop
+         Loop.CallLater(self.IdleInterval, self.IdleTimer)
+      else:
+         self.Thread = threading.Thread(target=self.Run, name='OutputFanOut')
+         self.Thread.daemon = True
+         self.Thread.start()
+
+   def Close(self):
+      self.Running = False
+      if self.Thread is not None:
+         with self.Condition:
+            self.Condition.notify()
+         self.Thread.join()
+         self.Thread = None
+      self.DeliverPending()
+      self.Loop = None
+      for Sink in self.Sinks:
+         Sink.Close()
+
+   def Report(self):
+      return('; '.join(Sink.Report() for Sink in self.Sinks))
+
+Output = OutputFanOut([DomoticzSink()])
 
 #################################################################################
-# Messages seen on the bus, nothing done with yet, for future reference.
+# Library interface, for other Python programs that want the telegrams or the
+# decoded values without the Domoticz script around them:
+#   for Frame in IterFrames(Source): ...
+#   for Frame, Result in IterDecoded(IterFrames(Source)): ...
+# Source is anything with read() that delivers the PARMRK stream (the port of
+# StartEMS(), an EMSReader, an EMSReplay, a file with a raw dump), read until it
+# returns nothing or raises EOFError, or an iterable of chunks of that stream.
+# IterFrames unescapes each chunk once with EMSFramer.Split() and yields the
+# telegrams with a valid CRC as Frame-s: a memoryview on the buffer of the chunk,
+# no copy per telegram. The telegrams the framer recovers from a frame with a bad
+# CRC are yielded too. Pass a Framer to see its statistics (Breaks, Recovered,
+# Lost, Overruns).
+# IterDecoded yields (Frame, Result) for the telegrams in the MessageSchema,
+# Result has the changed values (MessageParser.Update), or all values of the
+# telegram (MessageParser.Decode) with Changes=False. It has parsers of its own,
+# the images of the MessageParseDispatcher parsers are left alone, and nothing
+# is published.
+# The names iter_frames and iter_decoded are there for library users.
 #################################################################################
-# RCTimeMessage:
-#Unknown Message ID=0x6, Message=['0x17', '0x0', '0x6', '0x0', '0x13', '0x2', '0xd', '0x9', '0x31', '0x17', '0x5', '0x0', '0x0', '0x0', '0x0', '0x0', '0x0', '0xb7']
-# ?:
-#Unknown Message ID=0x7, Message=['0x8', '0x0', '0x7', '0x0', '0x3', '0x80', '0x0', '0x0', '0x0', '0x0', '0x0', '0x0', '0x0', '0x0', '0x0', '0x0', '0x0', '0x6b']
-# UBASollwerte:
-#Unknown Message ID=0x1a, Message=['0x17', '0x8', '0x1a', '0x0', '0x0', '0x0', '0x0', '0x0', '0x3a']
-# UBA WartungsMeldung:
-#Unknown Message ID=0x1c, Message=['0x8', '0x0', '0x1c', '0x0', '0x80', '0x1', '0x1', '0x1', '0x11', '0x0', '0x0', '0x0', '0x0', '0x0', '0x0', '0xed']
-# Flags ?:
-#Unknown Message ID=0x35, Message=['0x17', '0x8', '0x35', '0x0', '0x11', '0x0', '0xc1']
-# ?:
-#Unknown Message ID=0xa2, Message=['0x17', '0x0', '0xa2', '0x0', '0x0', '0x0', '0x0', '0x0', '0x0', '0x0', '0x0', '0x0', '0x0', '0x0', '0x0', '0x0', '0x0', '0x51']
-# RC Temp Message?
-#Unknown Message ID=0xa3, Message=['0x17', '0x0', '0xa3', '0x0', '0x0', '0x0', '0x0', '0x77']
+class Frame(object):
+   __slots__ = ('View', 'Time')
+
+   def __init__(self, View, Time=None):
+      self.View = View
+      self.Time = Time
+
+   @property
+   def Sender(self):
+      return(ord(self.View[0]))
 
+   @property
+   def Receiver(self):
+      return(ord(self.View[1]))
 
+   @property
+   def Type(self):
+      return(ord(self.View[2]))
 
+   @property
+   def Offset(self):
+      return(ord(self.View[3]))
+
+   @property
+   def Payload(self):
+      return(self.View[4:-1])
+
+   def __len__(self):
+      return(len(self.View))
+
+   def tobytes(self):
+      return(self.View.tobytes())
+
+   def __repr__(self):
+      return('Frame('+binascii.hexlify(self.View.tobytes())+')')
+
+def IterChunks(Source, ChunkSize=4096):
+   if not hasattr(Source, 'read'):
+      for Chunk in Source:
+         yield Chunk
+      return
+   while True:
+      try:
+         Chunk = Source.read(max(1, getattr(Source, 'in_waiting', ChunkSize)))
+      except EOFError:
+         return
+      if not Chunk:
+         return
+      yield Chunk
+
+def IterFrames(Source, MaxFrameLength=EMSMaxFrameLength, Recover=True, Framer=None):
+   if Framer is None:
+      Framer = EMSFramer(MaxFrameLength)
+   for Chunk in IterChunks(Source):
+      Time = getattr(Source, 'BlockTime', None) or time.time()
+      Buffer, Bounds = Framer.Split(Chunk)
+      if not Bounds:
+         continue
+      View = memoryview(Buffer)
+      for Start, End in Bounds:
+         Message = View[Start:End]
+         CRCMatches = CalculateNefitEMSCRC(Message) == Buffer[End-1]
+         if CRCMatches and TelegramInMessage(Buffer, Start, End-Start):
+            yield Frame(Message, Time)
+         else:
+            # Counted like CRCOK() does, a frame that only doesn't fit isn't.
+            if not CRCMatches:
+               Metrics.Count('nefitems_crc_failures_total')
+            if Recover:
+               for Recovered in Framer.Recover(Message.tobytes()):
+                  yield Frame(memoryview(Recovered), Time)
+
+def IterDecoded(Frames, Changes=True):
+   Parsers = dict()
+   for Frame in Frames:
+      Type = ord(Frame.View[2])
+      Parser = Parsers.get(Type)
+      if Parser is None:
+         if Type not in MessageSchema:
+            continue
+         Parser = Parsers[Type] = MessageParser(Type, MessageSchema[Type])
+      Result = Parser.Update(Frame.View, Frame.Time) if Changes else Parser.Decode(Frame.View)
+      if Result:
+         yield (Frame, Result)
+
+iter_frames = IterFrames
+iter_decoded = IterDecoded
+
+
+#################################################################################
+# Sample Store, keeps the decoded values locally, for analysis without having to
+# query Domoticz. Per field (every numeric value of the parse results):
+#  - the recent samples in memory, in a numpy ring of RawCapacity samples.
+#  - 1 minute and 1 hour rollups (min, mean, max and count) in memory-mapped
+#    column files, one file per column: <Directory>/<Field>.<Resolution>.<Column>.
+#    Only changed values are appended, so a value holds until the next one (at
+#    most SampleMaxHold seconds, the parsers refresh all values well within that)
+#    and the mean is weighted by the time each value held.
+# The column files have a fixed capacity, rows are appended at the write position
+# and wrap around, so disk usage is bounded: with the default capacities a week
+# of minutes and two years of hours, about 1.1 MB per field.
+# Query() returns contiguous, time ordered arrays for a time range.
+#################################################################################
+SampleMaxHold = 2*DomoticzHeartbeat
+
+SampleStoreResolutions = (
+   # Name, Seconds, Capacity
+   ('1min', 60, 7*24*60),
+   ('1hour', 3600, 2*366*24),
+)
+
+class SampleRing(object):
+   def __init__(self, Capacity):
+      self.Time = numpy.zeros(Capacity)
+      self.Value = numpy.zeros(Capacity)
+      self.Capacity = Capacity
+      self.Position = 0
+      self.Count = 0
+
+   def Append(self, Time, Value):
+      self.Time[self.Position] = Time
+      self.Value[self.Position] = Value
+      self.Position = (self.Position+1) % self.Capacity
+      self.Count = min(self.Count+1, self.Capacity)
+
+   def Query(self, Start, End):
+      Order = numpy.arange(self.Position-self.Count, self.Position) % self.Capacity
+      Times = self.Time[Order]
+      Selection = Order[(Times >= Start) & (Times < End)]
+      return({'Time': self.Time[Selection], 'Value': self.Value[Selection]})
+
+class RollupColumns(object):
+   Columns = ('Time', 'Min', 'Mean', 'Max', 'Count')
+
+   def __init__(self, Path, Capacity):
+      self.Capacity = Capacity
+      self.Maps = dict()
+      for Column in self.Columns:
+         FileName = Path+'.'+Column
+         if os.path.exists(FileName) and os.path.getsize(FileName) == Capacity*8:
+            self.Maps[Column] = numpy.memmap(FileName, dtype=numpy.float64, mode='r+', shape=(Capacity,))
+         else:
+            self.Maps[Column] = numpy.memmap(FileName, dtype=numpy.float64, mode='w+', shape=(Capacity,))
+            self.Maps[Column][:] = numpy.nan
+      # Continue after the newest row.
+      Times = self.Maps['Time']
+      if numpy.isnan(Times).all():
+         self.Position = 0
+      else:
+         self.Position = (int(numpy.nanargmax(Times))+1) % Capacity
+
+   def Append(self, Row):
+      for Column, Value in zip(self.Columns, Row):
+         self.Maps[Column][self.Position] = Value
+      self.Position = (self.Position+1) % self.Capacity
+
+   def Query(self, Start, End):
+      Order = numpy.roll(numpy.arange(self.Capacity), -self.Position)
+      Times = self.Maps['Time'][Order]
+      # Rows that were never written are NaN, and never selected.
+      with numpy.errstate(invalid='ignore'):
+         Selection = Order[(Times >= Start) & (Times < End)]
+      return(dict((Column, numpy.array(self.Maps[Column][Selection])) for Column in self.Columns))
+
+   def Flush(self):
+      for Map in self.Maps.values():
+         Map.flush()
+
+class SampleField(object):
+   def __init__(self, Path, RawCapacity, Resolutions):
+      self.Raw = SampleRing(RawCapacity)
+      self.Rollups = dict()
+      self.Buckets = dict()
+      self.Last = None
+      for Name, Seconds, Capacity in Resolutions:
+         self.Rollups[Name] = (Seconds, RollupColumns(Path+'.'+Name, Capacity))
+         self.Buckets[Name] = None
+
+   def Append(self, Time, Value):
+      self.Raw.Append(Time, Value)
+      for Name, (Seconds, Columns) in self.Rollups.items():
+         if self.Last is not None:
+            LastTime, LastValue = self.Last
+            self.Hold(Name, Seconds, LastTime, min(Time, LastTime+SampleMaxHold), LastValue)
+         Bucket = self.Bucket(Name, Seconds, Time)
+         Bucket[1] = min(Bucket[1], Value)
+         Bucket[3] = max(Bucket[3], Value)
+         Bucket[4] += 1
+      self.Last = (Time, Value)
+
+   # The open bucket of Time: [Time, Min, Value*Seconds, Max, Count, Seconds].
+   def Bucket(self, Name, Seconds, Time):
+      BucketTime = Time-(Time % Seconds)
+      Bucket = self.Buckets[Name]
+      if Bucket is not None and Bucket[0] != BucketTime:
+         self.CloseBucket(Name)
+         Bucket = None
+      if Bucket is None:
+         Bucket = self.Buckets[Name] = [BucketTime, float('inf'), 0.0, float('-inf'), 0, 0.0]
+      return(Bucket)
+
+   # The value held from Start to End, spread over the buckets it covers.
+   def Hold(self, Name, Seconds, Start, End, Value):
+      while Start < End:
+         Bucket = self.Bucket(Name, Seconds, Start)
+         Until = min(Bucket[0]+Seconds, End)
+         Bucket[1] = min(Bucket[1], Value)
+         Bucket[2] += Value*(Until-Start)
+         Bucket[3] = max(Bucket[3], Value)
+         Bucket[5] += Until-Start
+         Start = Until
+
+   def CloseBucket(self, Name):
+      Bucket = self.Buckets[Name]
+      if Bucket is not None:
+         BucketTime, Minimum, Sum, Maximum, Count, Seconds = Bucket
+         self.Rollups[Name][1].Append((BucketTime, Minimum, Sum/Seconds if Seconds else Minimum, Maximum, Count))
+         self.Buckets[Name] = None
+
+   def Close(self):
+      for Name, (Seconds, Columns) in self.Rollups.items():
+         self.CloseBucket(Name)
+         Columns.Flush()
+
+class EMSSampleStore(object):
+   def __init__(self, Directory, RawCapacity=3600, Resolutions=SampleStoreResolutions):
+      if not os.path.isdir(Directory):
+         os.makedirs(Directory)
+      self.Directory = Directory
+      self.RawCapacity = RawCapacity
+      self.Resolutions = Resolutions
+      self.Fields = dict()
+
+   def Append(self, Time, Result):
+      for Name, Value in Result.items():
+         if isinstance(Value, (int, long, float)) and not isinstance(Value, bool):
+            Field = self.Fields.get(Name)
+            if Field is None:
+               Field = self.Fields[Name] = SampleField(os.path.join(self.Directory, Name), self.RawCapacity, self.Resolutions)
+            Field.Append(Time, Value)
+
+   def Query(self, Name, Start, End, Resolution='raw'):
+      Field = self.Fields.get(Name)
+      if Field is None:
+         # Nothing received yet this run, the rollups can still be on disk.
+         if Resolution == 'raw':
+            return({'Time': numpy.zeros(0), 'Value': numpy.zeros(0)})
+         Field = self.Fields[Name] = SampleField(os.path.join(self.Directory, Name), self.RawCapacity, self.Resolutions)
+      if Resolution == 'raw':
+         return(Field.Raw.Query(Start, End))
+      return(Field.Rollups[Resolution][1].Query(Start, End))
+
+   def Close(self):
+      for Field in self.Fields.values():
+         Field.Close()
+
+#################################################################################
+# Derived Metrics, calculated over windows of Window seconds instead of per frame.
+# Append() only collects the samples of the input fields, when a window is
+# complete the aggregates are calculated with numpy on the whole window:
+#  - the inputs are step functions (a value holds until the next sample), they
+#    are evaluated on the grid of all sample times and weighted by the time they
+#    held, the value at the start of the window is the last one of the previous.
+#  - MeanEfficiency, ModulationWeightedEfficiency: the efficiency curve on the
+#    return temperature, weighted by time, and by time and burner modulation.
+#  - MeanDeltaT: the difference between the flow and return temperature.
+#  - BurnerOnShare: the share of the time the modulation is more than 0.
+#  - BurnerCyclesPerHour: from the burner starts counter if it was received,
+#    otherwise from the modulation going from 0 to more than 0.
+#  - HeatingRuntimeShare, HotWaterRuntimeShare: from the runtime counters.
+#  - HeatOutput (kWh), GasInput (kWh) and GasVolume (m3): estimates from the
+#    modulation as percentage of the nominal power, and the efficiency.
+# Aggregates that have no input in the window are left out.
+#################################################################################
+class DerivedMetrics(object):
+   Inputs = ('FlowTemperature', 'FlowReturnTemperature', 'BurnerDutyCycle', 'BurnerStarts', 'BurnerRuntimeInMinutes', 'HeatingRuntimeInMinutes')
+
+   def __init__(self, Window=DerivedWindow, NominalPower=BoilerNominalPower, CalorificValue=GasCalorificValue):
+      self.Window = Window
+      self.NominalPower = NominalPower
+      self.CalorificValue = CalorificValue
+      self.Start = None
+      self.Samples = dict((Name, ([], [])) for Name in self.Inputs)
+      self.Last = dict()
+      self.Latest = dict()
+      self.Windows = 0
+      self.HeatOutput = 0.0
+      self.GasInput = 0.0
+
+   # Returns (Time, Aggregates) when the sample completes a window, else None.
+   def Append(self, Time, Result):
+      Completed = None
+      if self.Start is None:
+         self.Start = Time-(Time % self.Window)
+      elif Time >= self.Start+self.Window:
+         Completed = (self.Start+self.Window, self.Close())
+         if Time >= self.Start+self.Window:
+            # A gap of more than a window, the values from before it are stale.
+            self.Start = Time-(Time % self.Window)
+            self.Last.clear()
+      for Name, Value in Result.items():
+         Samples = self.Samples.get(Name)
+         if Samples is not None:
+            Samples[0].append(Time)
+            Samples[1].append(Value)
+      return(Completed)
+
+   # The values of a field on the Grid, NaN before its first value.
+   def Step(self, Name, Grid):
+      Times, Values = self.Samples[Name]
+      if Name in self.Last:
+         Times = [self.Start]+Times
+         Values = [self.Last[Name]]+Values
+      if not Times:
+         return(None)
+      Index = numpy.searchsorted(Times, Grid, 'right')-1
+      Stepped = numpy.array(Values, dtype=numpy.float64)[Index]
+      Stepped[Index < 0] = numpy.nan
+      return(Stepped)
+
+   # The increase of a counter in the window, None if it is not known.
+   def Increase(self, Name):
+      Values = self.Samples[Name][1]
+      if Name not in self.Last or not Values:
+         return(None)
+      return(Values[-1]-self.Last[Name])
+
+   def Close(self):
+      End = self.Start+self.Window
+      Grid = numpy.unique(numpy.array([self.Start]+self.Samples['FlowTemperature'][0]+self.Samples['FlowReturnTemperature'][0]+self.Samples['BurnerDutyCycle'][0], dtype=numpy.float64))
+      Duration = numpy.diff(numpy.append(Grid, End))
+      Modulation = self.Step('BurnerDutyCycle', Grid)
+      Return = self.Step('FlowReturnTemperature', Grid)
+      Flow = self.Step('FlowTemperature', Grid)
+      Aggregates = dict()
+      if Return is not None:
+         Efficiency = CalculateSystemEfficiency(Return)
+         Known = ~numpy.isnan(Efficiency)
+         if Duration[Known].sum() > 0:
+            Aggregates['MeanEfficiency'] = float(numpy.dot(Efficiency[Known], Duration[Known])/Duration[Known].sum())
+         if Flow is not None:
+            DeltaT = Flow-Return
+            Known = ~numpy.isnan(DeltaT)
+            if Duration[Known].sum() > 0:
+               Aggregates['MeanDeltaT'] = float(numpy.dot(DeltaT[Known], Duration[Known])/Duration[Known].sum())
+      if Modulation is not None:
+         Known = ~numpy.isnan(Modulation)
+         On = numpy.zeros(len(Grid), dtype=bool)
+         On[Known] = Modulation[Known] > 0
+         if Duration[Known].sum() > 0:
+            Aggregates['BurnerOnShare'] = float(Duration[On].sum()/Duration[Known].sum())
+         Aggregates['BurnerCyclesPerHour'] = float(numpy.count_nonzero(On[1:] & ~On[:-1] & Known[:-1])*3600.0/self.Window)
+         Power = self.NominalPower*numpy.where(Known, Modulation, 0.0)/100.0
+         Heat = float(numpy.dot(Power, Duration)/3600.0)
+         Aggregates['HeatOutput'] = Heat
+         self.HeatOutput += Heat
+         if Return is not None:
+            Weight = Power*Duration
+            Known = ~numpy.isnan(Efficiency)
+            Gas = None
+            if Weight[Known].sum() > 0:
+               Weighted = numpy.dot(Efficiency[Known], Weight[Known])/Weight[Known].sum()
+               Aggregates['ModulationWeightedEfficiency'] = float(Weighted)
+               # The heat of the time without a return temperature at the weighted efficiency.
+               Gas = float((numpy.dot(Weight[Known], 100.0/Efficiency[Known])+Weight[~Known].sum()*100.0/Weighted)/3600.0)
+            elif Heat == 0:
+               Gas = 0.0
+            if Gas is not None:
+               Aggregates['GasInput'] = Gas
+               Aggregates['GasVolume'] = Gas/self.CalorificValue
+               self.GasInput += Gas
+      Starts = self.Increase('BurnerStarts')
+      if Starts is not None:
+         Aggregates['BurnerCyclesPerHour'] = float(Starts*3600.0/self.Window)
+      Burner = self.Increase('BurnerRuntimeInMinutes')
+      Heating = self.Increase('HeatingRuntimeInMinutes')
+      if Heating is not None:
+         Aggregates['HeatingRuntimeShare'] = float(Heating*60.0/self.Window)
+         if Burner is not None:
+            Aggregates['HotWaterRuntimeShare'] = float((Burner-Heating)*60.0/self.Window)
+      for Name, (Times, Values) in self.Samples.items():
+         if Values:
+            self.Last[Name] = Values[-1]
+            del Times[:]
+            del Values[:]
+      self.Start = End
+      self.Windows += 1
+      self.Latest = Aggregates
+      return(Aggregates)
+
+   def Register(self, Label=''):
+      for Name, Aggregate in (('efficiency_percent', 'ModulationWeightedEfficiency'), ('delta_t_celsius', 'MeanDeltaT'), ('burner_on_ratio', 'BurnerOnShare'), ('burner_cycles_per_hour', 'BurnerCyclesPerHour'), ('heating_runtime_ratio', 'HeatingRuntimeShare'), ('hot_water_runtime_ratio', 'HotWaterRuntimeShare')):
+         Metrics.Register('nefitems_derived_'+Name, 'gauge', lambda Aggregate=Aggregate: self.Latest.get(Aggregate, float('nan')), Label)
+      Metrics.Register('nefitems_derived_heat_output_kwh_total', 'counter', lambda: self.HeatOutput, Label)
+      Metrics.Register('nefitems_derived_gas_input_kwh_total', 'counter', lambda: self.GasInput, Label)
+
+#################################################################################
+# Multi Bus, for more than one boiler, each with its own EMS interface. Every bus
+# (--bus PORT[:IDXOFFSET]) gets a worker process that does the reading, framing,
+# CRC checking and decoding, so the buses are spread over the cores. The decoded
+# records go through a ring buffer in shared memory to the main process, the
+# aggregator, which publishes them (with the Domoticz idx-es shifted by the
+# IDXOFFSET of the bus) and keeps the sample store.
+# Each ring has a single producer (the worker) and a single consumer (the
+# aggregator), so it only needs the head and tail positions. One semaphore, shared
+# by all rings, counts the records, the aggregator waits on it. When a ring is
+# full (the aggregator falls behind) the new record is dropped and counted.
+# The aggregator checks the workers every second, a worker that exited (its
+# serial port failed) is reported, counted and started again after
+# BusRestartInterval, with the same ring. It is forked from the threaded main
+# process then, the worker only uses its own serial port, reader and parsers.
+# The records are (Type, Time, Result) dictionaries, serialized with marshal.
+# The telegrams without a parser are forwarded as (Type, Time, Message), the
+# aggregator adds them to the catalogue of the bus.
+#################################################################################
+BusURLs = dict()
+
+def BusURL(URL, IdxOffset):
+   if not IdxOffset:
+      return(URL)
+   Mapped = BusURLs.get((URL, IdxOffset))
+   if Mapped is None:
+      Mapped = BusURLs[(URL, IdxOffset)] = re.sub(r'idx=(\d+)', lambda Match: 'idx='+str(int(Match.group(1))+IdxOffset), URL, 1)
+      if URL in DeadbandDictionary:
+         DeadbandDictionary[Mapped] = DeadbandDictionary[URL]
+   return(Mapped)
+
+class EMSSharedRing(object):
+   def __init__(self, Size=65536, Records=None):
+      self.Size = Size
+      self.Buffer = multiprocessing.RawArray(ctypes.c_char, Size)
+      self.Head = multiprocessing.RawValue(ctypes.c_ulonglong, 0)
+      self.Tail = multiprocessing.RawValue(ctypes.c_ulonglong, 0)
+      self.Dropped = multiprocessing.RawValue(ctypes.c_ulonglong, 0)
+      self.Records = Records if Records is not None else multiprocessing.Semaphore(0)
+
+   def Write(self, Position, Data):
+      Start = Position % self.Size
+      First = min(len(Data), self.Size-Start)
+      self.Buffer[Start:Start+First] = Data[:First]
+      if First < len(Data):
+         self.Buffer[0:len(Data)-First] = Data[First:]
+
+   def Read(self, Position, Length):
+      Start = Position % self.Size
+      First = min(Length, self.Size-Start)
+      Data = self.Buffer[Start:Start+First]
+      if First < Length:
+         Data += self.Buffer[0:Length-First]
+      return(Data)
+
+   def Put(self, Data):
+      Record = struct.pack('<H', len(Data))+Data
+      Head = self.Head.value
+      if len(Record) > self.Size-(Head-self.Tail.value):
+         self.Dropped.value += 1
+         return(False)
+      self.Write(Head, Record)
+      self.Head.value = Head+len(Record)
+      self.Records.release()
+      return(True)
+
+   def Get(self):
+      Tail = self.Tail.value
+      if Tail == self.Head.value:
+         return(None)
+      Length = struct.unpack('<H', self.Read(Tail, 2))[0]
+      Data = self.Read(Tail+2, Length)
+      self.Tail.value = Tail+2+Length
+      return(Data)
+
+# The statistics a worker shares with the aggregator, in a shared array of doubles.
+EMSBusStatistics = ('bytes_read', 'frames', 'records', 'recovered', 'lost', 'overruns')
+
+def RunBusWorker(Port, ParityMark, Ring, Statistics):
+   # Ctrl-C is for the aggregator, it stops the workers.
+   signal.signal(signal.SIGINT, signal.SIG_IGN)
+   signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+   MyEMS=StartEMS(Port, ParityMark)
+   MyEMS.flushInput()
+   Reader=EMSReader(MyEMS)
+   Reader.Start()
+   Framer=EMSFramer()
+   Frames = 0
+   Records = 0
+   while True:
+      Message = NextMessage(Reader, Framer)
+      Now = time.time()
+      Type = ord(Message[2:3])
+      Parser = MessageParseDispatcher.get(Type)
+      if Parser is None:
+         Ring.Put(marshal.dumps((Type, Now, Message)))
+         continue
+      Frames += 1
+      Result = Parser.Update(Message, Now)
+      if Result:
+         Ring.Put(marshal.dumps((Type, Now, Result)))
+         Records += 1
+      Statistics[:] = [Reader.BytesRead, Frames, Records, Framer.Recovered, Framer.Lost, Framer.Overruns]
+
+class EMSBus(object):
+   def __init__(self, Name, Port, IdxOffset=0, ParityMark=True, Records=None, RingSize=65536):
+      self.Name = Name
+      self.Port = Port
+      self.IdxOffset = IdxOffset
+      self.ParityMark = ParityMark
+      self.Ring = EMSSharedRing(RingSize, Records)
+      self.Statistics = multiprocessing.RawArray(ctypes.c_double, len(EMSBusStatistics))
+      self.Catalogue = TelegramCatalogue()
+      self.Process = None
+      self.Exited = None
+      self.Restarts = 0
+
+   def Start(self):
+      self.Process = multiprocessing.Process(target=RunBusWorker, args=(self.Port, self.ParityMark, self.Ring, self.Statistics), name='EMSBus '+self.Port)
+      self.Process.daemon = True
+      self.Process.start()
+
+   def Stop(self):
+      if self.Process is not None and self.Process.is_alive():
+         self.Process.terminate()
+         self.Process.join()
+
+   def Alive(self):
+      return(self.Process is not None and self.Process.is_alive())
+
+   # Reports a worker that exited and restarts it after BusRestartInterval.
+   def Check(self, Now=None):
+      if self.Process is None or self.Process.is_alive():
+         return
+      if Now is None:
+         Now = time.time()
+      if self.Exited is None:
+         self.Exited = Now
+         print('Error: '+self.Name+' '+self.Port+': worker exited with code '+str(self.Process.exitcode)+', restarting in '+str(BusRestartInterval)+' s')
+         Metrics.Count('nefitems_bus_worker_exits_total', 1, 'bus="'+self.Name+'"')
+      elif Now-self.Exited >= BusRestartInterval:
+         self.Exited = None
+         self.Restarts += 1
+         self.Process.join()
+         self.Start()
+
+   def Report(self):
+      return(self.Name+' '+self.Port+': '+', '.join(Name+'='+str(int(Value)) for Name, Value in zip(EMSBusStatistics, self.Statistics))+', dropped records='+str(self.Ring.Dropped.value)+', restarts='+str(self.Restarts))
+
+def ParseBusArgument(Value):
+   # Device paths can contain colons (/dev/serial/by-path/...-usb-0:1.3:1.0-port0),
+   # only a number after the last one is an offset.
+   Port, Separator, IdxOffset = Value.rpartition(':')
+   try:
+      return(Port, int(IdxOffset)) if Separator else (Value, 0)
+   except ValueError:
+      return(Value, 0)
+
+class EMSAggregator(object):
+   def __init__(self, Buses, ParityMark=True, RingSize=65536):
+      self.Records = multiprocessing.Semaphore(0)
+      self.Buses = [EMSBus('Bus'+str(Index+1), Port, IdxOffset, ParityMark, self.Records, RingSize) for Index, (Port, IdxOffset) in enumerate(Buses)]
+      self.Next = 0
+      self.LastCheck = 0.0
+      for Bus in self.Buses:
+         BusCatalogues[Bus.Name] = Bus.Catalogue
+
+   def Start(self):
+      for Bus in self.Buses:
+         Bus.Start()
+
+   def Stop(self):
+      for Bus in self.Buses:
+         Bus.Stop()
+
+   # Returns the next record as (Bus, Type, Time, Result), or None after Timeout
+   # or for a telegram without a parser, which goes to the catalogue of the bus.
+   def Get(self, Timeout=1.0):
+      Now = time.time()
+      if Now-self.LastCheck >= 1.0:
+         self.LastCheck = Now
+         for Bus in self.Buses:
+            Bus.Check(Now)
+      if not self.Records.acquire(True, Timeout):
+         return(None)
+      for Count in range(len(self.Buses)):
+         Bus = self.Buses[self.Next]
+         self.Next = (self.Next+1) % len(self.Buses)
+         Data = Bus.Ring.Get()
+         if Data is not None:
+            Type, Time, Result = marshal.loads(Data)
+            if Type not in MessageParseDispatcher:
+               Bus.Catalogue.Add(Result, Time)
+               return(None)
+            return((Bus, Type, Time, Result))
+      return(None)
+
+   def Alive(self):
+      return(sum(1 for Bus in self.Buses if Bus.Alive()))
+
+   def Report(self):
+      return('; '.join(Bus.Report() for Bus in self.Buses))
 
 #################################################################################
 # Main Program
 #################################################################################
 
-MyEMS=StartEMS()
+if __name__ == '__main__':
+   ArgumentParser = argparse.ArgumentParser(description='Read the EMS bus and push the values to Domoticz.')
+   ArgumentParser.add_argument('--port', default=EMSPort, help='serial port of the EMS interface (default: %(default)s)')
+   ArgumentParser.add_argument('--no-parity-mark', dest='ParityMark', action='store_false', help='the port delivers an already marked stream (a simulator pty)')
+   ArgumentParser.add_argument('--domoticz', default=DomoticzHost, help='Domoticz URL to push to (default: %(default)s)')
+   ArgumentParser.add_argument('--influx', metavar='FILE', help='also write the values to this file in the InfluxDB line protocol')
+   ArgumentParser.add_argument('--mqtt', type=ParseMQTTArgument, metavar='HOST[:PORT]', help='also publish the values to this MQTT broker')
+   ArgumentParser.add_argument('--mqtt-prefix', default=MQTTPrefix, help='prefix of the MQTT topics (default: %(default)s)')
+   ArgumentParser.add_argument('--spool', metavar='FILE', help='keep the updates that could not be delivered in this file and send them when Domoticz is back')
+   ArgumentParser.add_argument('--metrics-port', type=int, default=MetricsPort, help='port of the Prometheus metrics endpoint, 0 disables it (default: %(default)s)')
+   ArgumentParser.add_argument('--store', metavar='DIRECTORY', help='keep the decoded values in a local sample store in this directory')
+   ArgumentParser.add_argument('--derived-window', type=int, default=DerivedWindow, metavar='SECONDS', help='window of the derived metrics (efficiency, burner cycles, gas estimate) (default: %(default)s)')
+   ArgumentParser.add_argument('--nominal-power', type=float, default=BoilerNominalPower, metavar='KW', help='nominal power of the boiler, for the heat and gas estimates (default: %(default)s)')
+   ArgumentParser.add_argument('--active', action='store_true', help='take part in the bus and send read requests when polled (see ActivePollRequests)')
+   ArgumentParser.add_argument('--loop', action='store_true', help='read the port and push to Domoticz on one event loop instead of the reader and publisher threads')
+   ArgumentParser.add_argument('--bus', action='append', type=ParseBusArgument, metavar='PORT[:IDXOFFSET]', help='read this EMS bus in a worker process, repeat it for more boilers; the Domoticz idx-es of the bus are shifted by IDXOFFSET')
+   ArgumentParser.add_argument('--capture', metavar='FILE', help='also write the raw bus traffic to a capture file')
+   ArgumentParser.add_argument('--replay', metavar='FILE', help='read a capture file instead of the serial port')
+   ArgumentParser.add_argument('--realtime', action='store_true', help='replay at the recorded speed instead of as fast as possible')
+   Arguments = ArgumentParser.parse_args()
+
+   if Arguments.loop and Arguments.replay:
+      ArgumentParser.error('--loop reads a serial port, it can not be combined with --replay')
+   if Arguments.bus and (Arguments.loop or Arguments.replay or Arguments.active or Arguments.capture):
+      ArgumentParser.error('--bus can not be combined with --loop, --replay, --active or --capture')
+
+   #The bus workers are started first, so they are forked before any thread.
+   Aggregator=None
+   if Arguments.bus:
+      Aggregator=EMSAggregator(Arguments.bus, Arguments.ParityMark)
+      Aggregator.Start()
+      Metrics.Register('nefitems_bus_workers_alive', 'gauge', Aggregator.Alive)
+      for Bus in Aggregator.Buses:
+         for Index, Name in enumerate(EMSBusStatistics):
+            Metrics.Register('nefitems_bus_'+Name+'_total', 'counter', lambda Statistics=Bus.Statistics, Index=Index: Statistics[Index], 'bus="'+Bus.Name+'"')
+         Metrics.Register('nefitems_bus_dropped_records_total', 'counter', lambda Ring=Bus.Ring: Ring.Dropped.value, 'bus="'+Bus.Name+'"')
+         Metrics.Register('nefitems_bus_worker_restarts_total', 'counter', lambda Bus=Bus: Bus.Restarts, 'bus="'+Bus.Name+'"')
+         Metrics.Register('nefitems_catalogue_kinds', 'gauge', lambda BusCatalogue=Bus.Catalogue: len(BusCatalogue.Entries), 'bus="'+Bus.Name+'"')
+         Metrics.Register('nefitems_catalogue_evicted_total', 'counter', lambda BusCatalogue=Bus.Catalogue: BusCatalogue.Evicted, 'bus="'+Bus.Name+'"')
+
+   Framer=EMSFramer()
+   Loop=None
+   if Arguments.loop:
+      Loop=EMSEventLoop()
+      Publisher=AsyncDomoticzPublisher(Loop, Arguments.domoticz)
+   else:
+      Publisher=DomoticzPublisher(Arguments.domoticz)
+   Spool=None
+   if Arguments.spool:
+      Spool=DomoticzSpool(Arguments.spool, Arguments.domoticz)
+      Spool.Start()
+      Publisher.Spool=Spool
+      Metrics.Register('nefitems_spool_spooled_total', 'counter', lambda: Spool.Spooled)
+      Metrics.Register('nefitems_spool_drained_total', 'counter', lambda: Spool.Drained)
+      Metrics.Register('nefitems_spool_superseded_total', 'counter', lambda: Spool.Superseded)
+      Metrics.Register('nefitems_spool_rejected_total', 'counter', lambda: Spool.Rejected)
+      Metrics.Register('nefitems_spool_dropped_total', 'counter', lambda: Spool.Dropped)
+      Metrics.Register('nefitems_spool_pending_bytes', 'gauge', Spool.Pending)
+   Publisher.Start()
+
+   Sinks=[DomoticzSink(dict((Bus.Name, Bus.IdxOffset) for Bus in Aggregator.Buses) if Aggregator is not None else None)]
+   if Arguments.influx:
+      Sinks.append(InfluxLineSink(Arguments.influx))
+   if Arguments.mqtt:
+      Sinks.append(MQTTSink(Arguments.mqtt[0], Arguments.mqtt[1], Arguments.mqtt_prefix))
+      Metrics.Register('nefitems_mqtt_published_total', 'counter', lambda: Sinks[-1].Sent)
+      Metrics.Register('nefitems_mqtt_dropped_total', 'counter', lambda: Sinks[-1].Dropped)
+   Output=OutputFanOut(Sinks)
+   Output.Start(Loop)
+   Metrics.Register('nefitems_output_dropped_batches_total', 'counter', lambda: Output.Dropped)
+
+   Capture=None
+   MyEMS=None
+   if Aggregator is not None:
+      Source=Aggregator
+   elif Arguments.replay:
+      MyEMS=EMSReplay(Arguments.replay, Arguments.realtime)
+      Source=MyEMS
+   else:
+      MyEMS=StartEMS(Arguments.port, Arguments.ParityMark)
+      #Flush to start with an empty buffer, no old data required.
+      MyEMS.flushInput()
+      if Arguments.capture:
+         Capture=EMSCaptureWriter(Arguments.capture)
+   if Loop is not None:
+      Source=EMSLoopIngest(Loop, MyEMS, Framer, lambda Message: ProcessMessage(Message), Capture)
+      Source.Start()
+      Metrics.Register('nefitems_reader_bytes_total', 'counter', lambda: Source.BytesRead)
+   elif Aggregator is None and not Arguments.replay:
+      Source=EMSReader(MyEMS, Capture=Capture)
+      Source.Start()
+      Metrics.Register('nefitems_reader_bytes_total', 'counter', lambda: Source.BytesRead)
+      Metrics.Register('nefitems_ring_buffered_bytes', 'gauge', lambda: Source.Ring.Available())
+      Metrics.Register('nefitems_ring_overflows_total', 'counter', lambda: Source.Ring.Overflows)
+      Metrics.Register('nefitems_ring_dropped_bytes_total', 'counter', lambda: Source.Ring.DroppedBytes)
+
+   Poller=None
+   if Arguments.active and not Arguments.replay:
+      Poller=EMSActivePoller(MyEMS, BreakMode=('line' if Arguments.ParityMark else 'none'))
+      Poller.Attach(Framer, Source if Loop is None else None)
+      Metrics.Register('nefitems_active_requests_total', 'counter', lambda: Poller.Sent)
+      Metrics.Register('nefitems_active_replies_total', 'counter', lambda: Poller.Replies)
+      Metrics.Register('nefitems_active_timeouts_total', 'counter', lambda: Poller.Timeouts)
+      Metrics.Register('nefitems_active_throttled_total', 'counter', lambda: Poller.Throttled)
+
+   Metrics.Register('nefitems_breaks_total', 'counter', lambda: Framer.Breaks)
+   Metrics.Register('nefitems_frame_overruns_total', 'counter', lambda: Framer.Overruns)
+   Metrics.Register('nefitems_frames_recovered_total', 'counter', lambda: Framer.Recovered)
+   Metrics.Register('nefitems_frames_lost_total', 'counter', lambda: Framer.Lost)
+   Metrics.Register('nefitems_domoticz_requests_total', 'counter', lambda: Publisher.Sent)
+   Metrics.Register('nefitems_domoticz_errors_total', 'counter', lambda: Publisher.Errors)
+   Metrics.Register('nefitems_domoticz_coalesced_total', 'counter', lambda: Publisher.Coalesced)
+   Metrics.Register('nefitems_domoticz_dropped_total', 'counter', lambda: Publisher.Dropped)
+   Metrics.Register('nefitems_updates_suppressed_total', 'counter', lambda: DomoticzFilter.Suppressed)
+   Metrics.Register('nefitems_catalogue_kinds', 'gauge', lambda: len(Catalogue.Entries))
+   Metrics.Register('nefitems_catalogue_evicted_total', 'counter', lambda: Catalogue.Evicted)
+
+   #kill -USR1 prints the catalogue of unknown telegrams, of every bus with --bus.
+   signal.signal(signal.SIGUSR1, lambda Signal, Frame: PrintCatalogue())
+   if Arguments.metrics_port:
+      StartMetricsServer(Arguments.metrics_port)
+
+   Store=None
+   if Arguments.store:
+      Store=EMSSampleStore(Arguments.store)
 
-#Flush to start with an empty buffer, no old data required.
-MyEMS.flushInput()
-while (1):
-   Result = NextMessageOfInterest(MyEMS)
-   #MessageLength=len(Result)
-   ProcessedResult = MessageParseDispatcher[Result[2]](Result)
-   Now = datetime.datetime.now().strftime("%H:%M:%S")
-   #print(Now+', Size='+MessageLength.__str__()+', MsgType='+[Result[2]].__str__()+', Data='+ProcessedResult.__str__())
-   print(Now+', Data='+ProcessedResult.__str__())
-   time.sleep(1)
+   #The derived metrics, per bus when there is more than one.
+   Derived=dict()
+   for Bus in (Aggregator.Buses if Aggregator is not None else [None]):
+      Derived[Bus] = DerivedMetrics(Arguments.derived_window, Arguments.nominal_power)
+      Derived[Bus].Register('bus="'+Bus.Name+'"' if Bus is not None else '')
+
+   def PrintStatistics(Prefix=''):
+      if Aggregator is not None:
+         print(Prefix+Aggregator.Report())
+      else:
+         print(Prefix+Source.Report()+', frame overruns='+str(Framer.Overruns)+', recovered='+str(Framer.Recovered)+', lost='+str(Framer.Lost))
+      print(Prefix+Output.Report())
+      if Spool is not None:
+         print(Prefix+Spool.Report())
+      if Poller is not None:
+         print(Prefix+Poller.Report())
+
+   LastReport = [time.time()]
+   def ProcessMessage(Result):
+      #MessageLength=len(Result)
+      ProcessedResult = MessageParseDispatcher[ord(Result[2:3])](Result)
+      Completed = Derived[None].Append(time.time(), ProcessedResult)
+      if Store is not None:
+         Store.Append(time.time(), ProcessedResult)
+         if Completed is not None:
+            Store.Append(*Completed)
+      Now = datetime.datetime.now().strftime("%H:%M:%S")
+      #print(Now+', Size='+MessageLength.__str__()+', MsgType='+hex(ord(Result[2:3]))+', Data='+ProcessedResult.__str__())
+      #Most telegrams change nothing, only print the ones that do.
+      if ProcessedResult:
+         print(Now+', Data='+ProcessedResult.__str__())
+      if Completed is not None:
+         print(Now+', Derived='+Completed[1].__str__())
+      if (time.time()-LastReport[0]) > StatisticsInterval:
+         LastReport[0] = time.time()
+         PrintStatistics(Now+', ')
+
+   # A record of a bus worker, already decoded, the field names in the store get
+   # the bus name as prefix.
+   def ProcessRecord(Bus, Type, Time, Result):
+      MessageParseDispatcher[Type].Publish(Result, Time, Bus.Name)
+      Completed = Derived[Bus].Append(Time, Result)
+      if Store is not None:
+         Store.Append(Time, dict((Bus.Name+'_'+Name, Value) for Name, Value in Result.items()))
+         if Completed is not None:
+            Store.Append(Completed[0], dict((Bus.Name+'_'+Name, Value) for Name, Value in Completed[1].items()))
+      Now = datetime.datetime.now().strftime("%H:%M:%S")
+      print(Now+', '+Bus.Name+', Data='+Result.__str__())
+      if Completed is not None:
+         print(Now+', '+Bus.Name+', Derived='+Completed[1].__str__())
+      if (time.time()-LastReport[0]) > StatisticsInterval:
+         LastReport[0] = time.time()
+         PrintStatistics(Now+', ')
+
+   try:
+      if Loop is not None:
+         Loop.Run()
+      elif Aggregator is not None:
+         while (1):
+            Record = Aggregator.Get()
+            if Record is not None:
+               ProcessRecord(*Record)
+      else:
+         while (1):
+            ProcessMessage(NextMessageOfInterest(Source, Framer))
+   except (EOFError, KeyboardInterrupt):
+      pass
 
-StopEMS(MyEMS)
+   PrintStatistics()
+   if Catalogue.Entries or any(BusCatalogue.Entries for BusCatalogue in BusCatalogues.values()):
+      PrintCatalogue()
+   if Source is not MyEMS:
+      Source.Stop()
+   Output.Close()
+   if Capture is not None:
+      Capture.Close()
+   if Store is not None:
+      Store.Close()
+   if Spool is not None:
+      Spool.Close()
+   if MyEMS is not None:
+      StopEMS(MyEMS)
@@ -0,0 +1,638 @@
+#################################################################################
+#
+# Benchmarks for NefitEMS.py, they run on synthetic EMS traffic, so no boiler
+# or serial port is needed.
+#
+# Usage: python NefitEMSBenchmark.py [active] [crc] [decode] [derived] [endtoend] [framer]
+#        [library] [loop] [multibus] [recovery] [sinks]
+#
+#################################################################################
+
+#################################################################################
+#Imports
+#################################################################################
+import sys
+import time
+import random
+import collections
+import threading
+import tempfile
+import subprocess
+import os
+import numpy
+import NefitEMS
+import NefitEMSSimulator
+import NefitEMSDecode
+
+#################################################################################
+# Synthetic traffic, the 4 telegrams we parse with realistic sizes, random data
+# (including 0xff data bytes, which PARMRK escapes to 0xff 0xff) and the poll
+# bytes of the bus master in between, all seperated by BREAKs (0xff 0x00 0x00).
+#################################################################################
+BenchmarkTelegrams = [
+   (0x08, 0x00, 0x18, 30),
+   (0x08, 0x00, 0x19, 32),
+   (0x08, 0x00, 0x34, 22),
+   (0x17, 0x00, 0x91, 19),
+]
+
+def BuildTelegram(Sender, Receiver, Type, Size, Random):
+   Message = bytearray([Sender, Receiver, Type, 0x00])
+   Message += bytearray(Random.randint(0, 255) for Index in range(Size-5))
+   Message.append(NefitEMS.CalculateNefitEMSCRC(bytes(Message)+b'\x00'))
+   return(bytes(Message))
+
+def EscapeTelegram(Message):
+   return(Message.replace(b'\xff', b'\xff\xff')+b'\xff\x00\x00')
+
+def BuildStream(Count, Seed=1):
+   Random = random.Random(Seed)
+   Stream = bytearray()
+   Messages = []
+   for Index in range(Count):
+      Message = BuildTelegram(*(BenchmarkTelegrams[Index % len(BenchmarkTelegrams)]+(Random,)))
+      Messages.append(Message)
+      Stream += EscapeTelegram(Message)
+      Stream += b'\x89\xff\x00\x00'
+   return(bytes(Stream), Messages)
+
+#################################################################################
+# A fake serial port, serving the stream in chunks like a UART FIFO would. Like
+# EMSReplay it raises EOFError at the end of the stream.
+#################################################################################
+class BenchmarkPort(object):
+   def __init__(self, Data, ChunkSize=64):
+      self.Data = Data
+      self.Position = 0
+      self.ChunkSize = ChunkSize
+
+   @property
+   def in_waiting(self):
+      return(min(self.ChunkSize, len(self.Data)-self.Position))
+
+   def read(self, Size=1):
+      if self.Position >= len(self.Data):
+         raise EOFError('end of the benchmark stream')
+      Chunk = self.Data[self.Position:self.Position+Size]
+      self.Position += len(Chunk)
+      return(Chunk)
+
+#################################################################################
+# The original per byte NextMessage implementation, kept as reference.
+#################################################################################
+def LegacyCalculateNefitEMSCRC(SerialBuffer):
+  StrippedBuffer=SerialBuffer[:-1]
+  crc = 0x0
+  d = 0x0
+  for Entry in StrippedBuffer:
+    d = 0;
+    if ( crc & 0x80 ):
+       crc ^= 12
+       d = 1
+    crc  = (crc << 1) & 0xfe
+    crc |= d
+    crc ^= int(Entry,16)
+  return (crc)
+
+def LegacyCRCOK(SerialBuffer):
+   CRC = LegacyCalculateNefitEMSCRC(SerialBuffer)
+   return (CRC==int(SerialBuffer[(len(SerialBuffer)-1)],16))
+
+def LegacyPostProcessMessage(Message):
+   if '0xff' in Message:
+      ByteRemoved = False
+      NewMessage = []
+      for byte in Message:
+         if byte == '0xff':
+            if not ByteRemoved:
+               ByteRemoved = True
+            else:
+               ByteRemoved = False
+               NewMessage.append(byte)
+         else:
+            NewMessage.append(byte)
+   else:
+      NewMessage = Message
+   return(NewMessage)
+
+def LegacyNextMessage(MyEMS):
+   MessageReceived = False
+   Message = []
+   BreakBytes = 0
+   while not MessageReceived:
+      char = numpy.uint8(ord(MyEMS.read(1))).__hex__()
+      if BreakBytes == 0:
+         if char == '0xff':
+            BreakBytes = 1
+         else:
+            Message.append(char)
+      elif BreakBytes == 1:
+         if char == '0x0':
+            BreakBytes = 2
+         else:
+            Message.append('0xff')
+            Message.append(char)
+            BreakBytes = 0
+      elif BreakBytes == 2:
+         if char == '0x0':
+            BreakBytes = 0
+            if len(Message) > 4:
+               Message = LegacyPostProcessMessage(Message)
+               if LegacyCRCOK(Message):
+                  MessageReceived = True
+               else:
+                  Message = []
+            else:
+               Message = []
+         else:
+            Message.append('0xff')
+            Message.append('0x0')
+            Message.append(char)
+            BreakBytes = 0
+   return(Message)
+
+#################################################################################
+# Benchmarks
+#################################################################################
+def BenchmarkFramer(Count=20000):
+   Stream, Messages = BuildStream(Count)
+
+   Port = BenchmarkPort(Stream)
+   Legacy = []
+   Start = time.time()
+   for Index in range(Count):
+      Legacy.append(LegacyNextMessage(Port))
+   LegacyTime = time.time()-Start
+
+   Port = BenchmarkPort(Stream)
+   Framer = NefitEMS.EMSFramer()
+   New = []
+   Start = time.time()
+   for Index in range(Count):
+      New.append(NefitEMS.NextMessage(Port, Framer))
+   NewTime = time.time()-Start
+
+   # Both have to deliver exactly the telegrams we put in the stream.
+   assert New == Messages
+   assert [bytes(bytearray(int(Byte,16) for Byte in Message)) for Message in Legacy] == Messages
+   print('Framer: '+str(Count)+' frames, '+str(len(Stream))+' bytes')
+   print('  legacy NextMessage : %10.0f frames/s' % (Count/LegacyTime))
+   print('  EMSFramer          : %10.0f frames/s (x%.1f)' % (Count/NewTime, LegacyTime/NewTime))
+
+def BenchmarkCRC(Count=20000):
+   Random = random.Random(2)
+   Frames = []
+   for Index in range(Count):
+      Frame = bytearray(Random.randint(0, 255) for Byte in range(Random.randint(2, 40)))
+      # Give half of the frames a valid CRC.
+      if Index % 2:
+         Frame[-1] = NefitEMS.CalculateNefitEMSCRC(bytes(Frame))
+      Frames.append(bytes(Frame))
+   HexFrames = [[hex(Byte) for Byte in bytearray(Frame)] for Frame in Frames]
+
+   Start = time.time()
+   Legacy = [LegacyCRCOK(Frame) for Frame in HexFrames]
+   LegacyTime = time.time()-Start
+
+   Start = time.time()
+   Table = [NefitEMS.CalculateNefitEMSCRC(Frame) == ord(Frame[-1:]) for Frame in Frames]
+   TableTime = time.time()-Start
+
+   NefitEMS.CRCOKBatch(Frames[:1])
+   Start = time.time()
+   Batch = NefitEMS.CRCOKBatch(Frames)
+   BatchTime = time.time()-Start
+
+   # Equivalence with the original bit by bit implementation.
+   for Frame, HexFrame in zip(Frames, HexFrames):
+      assert NefitEMS.CalculateNefitEMSCRC(Frame) == LegacyCalculateNefitEMSCRC(HexFrame)
+   assert Legacy == Table == list(Batch)
+   assert sum(Legacy) >= Count//2
+   print('CRC: '+str(Count)+' frames')
+   print('  legacy CRCOK       : %10.0f frames/s' % (Count/LegacyTime))
+   print('  table CRC          : %10.0f frames/s (x%.1f)' % (Count/TableTime, LegacyTime/TableTime))
+   print('  CRCOKBatch         : %10.0f frames/s (x%.1f)' % (Count/BatchTime, LegacyTime/BatchTime))
+
+#################################################################################
+# End to end benchmark, runs the complete StartEMS -> NextMessageOfInterest ->
+# parser -> UpdateDomoticz path against the simulator on a pty and the stand-in
+# Domoticz server. It measures the decoded frames/s, the frames lost and the
+# latency from the BREAK closing a telegram to the Domoticz request it caused
+# (using the burner starts, which increase with every UBAMonitorSlow telegram).
+# Runtime 'threads' uses the EMSReader and DomoticzPublisher threads, 'loop' the
+# EMSEventLoop with the AsyncDomoticzPublisher. HTTPDelay makes Domoticz slow.
+#################################################################################
+def RunEndToEnd(Cycles, Speed, Burst, ErrorRate, Runtime='threads', HTTPDelay=0.0):
+   BreakTimes = dict()
+   Latencies = []
+
+   def OnBreak(Telegram, Now):
+      if ord(Telegram[2:3]) == 0x19:
+         BreakTimes[NefitEMS.MessageParseDispatcher[0x19].Decode(Telegram)['BurnerStarts']] = Now
+
+   def OnRequest(Path, Now):
+      if NefitEMSSimulator.BurnerStartsIdx in Path:
+         Starts = int(Path.rsplit('=', 1)[1])
+         if Starts in BreakTimes:
+            Latencies.append(Now-BreakTimes[Starts])
+
+   Domoticz = NefitEMSSimulator.DomoticzStandIn(OnRequest=OnRequest, Delay=HTTPDelay)
+   Domoticz.Start()
+   NefitEMS.DomoticzFilter = NefitEMS.ChangeFilter()
+   Simulator = NefitEMSSimulator.EMSSimulator(NefitEMSSimulator.EMSTrafficGenerator(ErrorRate), Speed, Burst, OnBreak)
+   MyEMS = NefitEMS.StartEMS(Simulator.PortName, ParityMark=False)
+   Framer = NefitEMS.EMSFramer()
+   Decoded = [0, None]
+
+   def Decode(Message):
+      NefitEMS.MessageParseDispatcher[ord(Message[2:3])](Message)
+      Decoded[0] += 1
+      Decoded[1] = time.time()
+
+   if Runtime == 'loop':
+      Loop = NefitEMS.EMSEventLoop()
+      NefitEMS.Publisher = NefitEMS.AsyncDomoticzPublisher(Loop, Domoticz.URL())
+      Reader = NefitEMS.EMSLoopIngest(Loop, MyEMS, Framer, Decode)
+      Reader.Start()
+      Consume = Loop.Run
+   else:
+      NefitEMS.Publisher = NefitEMS.DomoticzPublisher(Domoticz.URL())
+      Reader = NefitEMS.EMSReader(MyEMS)
+      Reader.Start()
+
+      def Consume():
+         try:
+            while True:
+               Decode(NefitEMS.NextMessageOfInterest(Reader, Framer))
+         except EOFError:
+            pass
+   NefitEMS.Publisher.Start()
+
+   Consumer = threading.Thread(target=Consume, name='Consumer')
+   Consumer.daemon = True
+   Consumer.start()
+   Start = time.time()
+   Simulator.Start(Cycles)
+   Simulator.Thread.join()
+   # Give the pipeline time to drain the ring buffer and the publisher.
+   Deadline = time.time()+10
+   while time.time() < Deadline and ((Runtime == 'threads' and Reader.in_waiting) or Framer.Frames or NefitEMS.Publisher.Pending or (Decoded[1] or 0) > time.time()-0.5):
+      time.sleep(0.1)
+   Sent = sum(Simulator.Generator.Sent.values())
+   Elapsed = (Decoded[1] or time.time())-Start
+   Latencies.sort()
+   print('  '+str(Sent)+' telegrams sent, '+str(Simulator.Generator.Corrupted)+' corrupted, '+str(Simulator.BytesWritten)+' bytes')
+   print('  decoded            : %10.0f frames/s, %d frames, %d lost' % (Decoded[0]/Elapsed, Decoded[0], Sent-Decoded[0]))
+   print('  reader             : '+Reader.Report())
+   print('  Domoticz           : %d requests, %d coalesced, %d dropped, %d errors' % (NefitEMS.Publisher.Sent, NefitEMS.Publisher.Coalesced, NefitEMS.Publisher.Dropped, NefitEMS.Publisher.Errors))
+   if Latencies:
+      print('  BREAK -> Domoticz  : median %.1f ms, p95 %.1f ms, max %.1f ms (%d requests)' % (1000*Latencies[len(Latencies)//2], 1000*Latencies[(95*len(Latencies))//100], 1000*Latencies[-1], len(Latencies)))
+   Reader.Stop()
+   Consumer.join()
+   Simulator.Stop()
+   NefitEMS.Publisher.Close()
+   Domoticz.shutdown()
+   time.sleep(0.2)
+
+def BenchmarkEndToEnd():
+   print('End to end, line rate:')
+   RunEndToEnd(Cycles=60, Speed=1.0, Burst=True, ErrorRate=0.02)
+   print('End to end, unthrottled:')
+   RunEndToEnd(Cycles=2000, Speed=0, Burst=True, ErrorRate=0.02)
+
+#################################################################################
+# Active mode benchmark, the simulator polls our ID after every bus cycle and
+# answers the read requests of the EMSActivePoller. It reports how many of the
+# requests got an answer and the bus share the poller used.
+#################################################################################
+def BenchmarkActive(Cycles=40):
+   Simulator = NefitEMSSimulator.EMSSimulator(NefitEMSSimulator.EMSTrafficGenerator(0.0), 1.0, True, PollID=NefitEMS.ActivePollID)
+   MyEMS = NefitEMS.StartEMS(Simulator.PortName, ParityMark=False)
+   Reader = NefitEMS.EMSReader(MyEMS)
+   Reader.Start()
+   Framer = NefitEMS.EMSFramer()
+   Poller = NefitEMS.EMSActivePoller(MyEMS, Requests=[(0x08, 0x18, 0, 25, 0.0)], MaxBusShare=0.2, BreakMode='none')
+   Poller.Attach(Framer, Reader)
+   Replies = [0]
+
+   def Consume():
+      try:
+         while True:
+            Message = NefitEMS.NextMessageOfInterest(Reader, Framer)
+            if bytearray(Message[1:2])[0] == NefitEMS.ActivePollID:
+               Replies[0] += 1
+      except EOFError:
+         pass
+
+   Consumer = threading.Thread(target=Consume, name='Consumer')
+   Consumer.daemon = True
+   Consumer.start()
+   Simulator.Start(Cycles)
+   Simulator.Thread.join()
+   time.sleep(0.5)
+   print('Active mode: '+str(Cycles)+' bus cycles at line rate')
+   print('  simulator          : polls='+str(Simulator.Polls)+', poll replies='+str(Simulator.PollReplies)+', read requests answered='+str(Simulator.ReadRequests)+', late answers='+str(Simulator.LateAnswers))
+   print('  poller             : '+Poller.Report())
+   print('  replies decoded    : '+str(Replies[0]))
+   Histogram = NefitEMS.Metrics.Histograms.get(('nefitems_active_reply_seconds', ''))
+   if Histogram:
+      print('  reply latency      : mean %.1f ms' % (1000*Histogram[-1]/max(1, sum(Histogram[:-1]))))
+   Reader.Stop()
+   Consumer.join()
+   Simulator.Stop()
+
+def BenchmarkLoop():
+   for Runtime in ('threads', 'loop'):
+      print('End to end, '+Runtime+', line rate, Domoticz answering in 200 ms:')
+      RunEndToEnd(Cycles=60, Speed=1.0, Burst=True, ErrorRate=0.02, Runtime=Runtime, HTTPDelay=0.2)
+
+#################################################################################
+# Multi bus benchmark, 1, 2 and 4 simulated buses at full speed, each read by its
+# own worker process, the aggregator only collects the records. It shows how the
+# decoding scales over the cores.
+#################################################################################
+def BenchmarkMultiBus(Cycles=1000):
+   for Count in (1, 2, 4):
+      Simulators = [NefitEMSSimulator.EMSSimulator(NefitEMSSimulator.EMSTrafficGenerator(Seed=Index+1), 0, True) for Index in range(Count)]
+      Aggregator = NefitEMS.EMSAggregator([(Simulator.PortName, 100*Index) for Index, Simulator in enumerate(Simulators)], ParityMark=False)
+      Aggregator.Start()
+      time.sleep(0.5)
+      Start = time.time()
+      for Simulator in Simulators:
+         Simulator.Start(Cycles)
+      Records = 0
+      LastRecord = time.time()
+      while time.time()-LastRecord < 1.0:
+         if Aggregator.Get(0.1) is not None:
+            Records += 1
+            LastRecord = time.time()
+      Elapsed = LastRecord-Start
+      Sent = sum(sum(Simulator.Generator.Sent.values()) for Simulator in Simulators)
+      Frames = sum(int(Bus.Statistics[NefitEMS.EMSBusStatistics.index('frames')]) for Bus in Aggregator.Buses)
+      print('Multi bus, %d buses: %10.0f frames/s, %d of %d frames decoded, %d records' % (Count, Frames/Elapsed, Frames, Sent, Records))
+      Aggregator.Stop()
+      for Simulator in Simulators:
+         Simulator.Stop()
+         Simulator.Close()
+
+#################################################################################
+# Batch decoder benchmark, a capture of simulator traffic decoded by replaying it
+# through the live path (NextMessageOfInterest and the parsers, without
+# publishing) and by the batch decoder of NefitEMSDecode.py.
+#################################################################################
+def BenchmarkDecode(Cycles=25000):
+   Generator = NefitEMSSimulator.EMSTrafficGenerator(ErrorRate=0.01, BreakLossRate=0.01)
+   FileName = tempfile.mktemp(suffix='.emscap')
+   Capture = NefitEMS.EMSCaptureWriter(FileName)
+   Now = 1.5e9
+   for Cycle in range(Cycles):
+      Stream = bytearray()
+      for Telegram, Valid, Break in Generator.Telegrams():
+         if Break:
+            Stream += NefitEMSSimulator.EscapeTelegram(Telegram)+Generator.Polls()
+         else:
+            Stream += Telegram.replace(b'\xff', b'\xff\xff')
+      # Blocks of the size the reader thread typically gets.
+      for Start in range(0, len(Stream), 32):
+         Now += 0.03
+         Capture.Write(bytes(Stream[Start:Start+32]), Now)
+   Capture.Close()
+   print('Decode: '+str(os.path.getsize(FileName))+' byte capture, '+str(sum(Generator.Sent.values()))+' valid telegrams')
+
+   MyEMS = NefitEMS.EMSReplay(FileName)
+   Framer = NefitEMS.EMSFramer()
+   Live = 0
+   Start = time.time()
+   try:
+      while True:
+         Message = NefitEMS.NextMessageOfInterest(MyEMS, Framer)
+         NefitEMS.MessageParseDispatcher[ord(Message[2:3])].Update(Message)
+         Live += 1
+   except EOFError:
+      pass
+   LiveTime = time.time()-Start
+   MyEMS.close()
+
+   Start = time.time()
+   Columns, Statistics = NefitEMSDecode.DecodeArchives([FileName], ChunkBytes=256*1024)
+   BatchTime = time.time()-Start
+   os.remove(FileName)
+   # The text columns keep the full text, across the chunks.
+   Texts = set(Columns['StatusText'].tolist())-set([b''])
+   assert Texts and Texts <= set(Text.encode('ascii') for Text in NefitEMS.StatusDictionary.values())
+   assert b'Heating Mode Enabled' in Texts
+   print('  live loop          : %10.0f frames/s, %d frames' % (Live/LiveTime, Live))
+   print('  NefitEMSDecode     : %10.0f frames/s, %d frames, %d decoded (x%.1f)' % (Statistics['Frames']/BatchTime, Statistics['Frames'], Statistics['Decoded'], LiveTime/BatchTime))
+
+#################################################################################
+# Frame recovery benchmark, simulator traffic with corrupted telegrams and lost
+# BREAKs, framed once with and once without recovering the merged telegrams.
+# Every frame is matched against one of the valid telegrams that were sent, the
+# frames without a match are false positives (and don't count for the yield).
+#################################################################################
+def BenchmarkRecovery(Cycles=5000):
+   Generator = NefitEMSSimulator.EMSTrafficGenerator(ErrorRate=0.02, BreakLossRate=0.05)
+   Stream = bytearray()
+   Expected = []
+   for Cycle in range(Cycles):
+      for Telegram, Valid, Break in Generator.Telegrams():
+         if Valid:
+            Expected.append(Telegram)
+         if Break:
+            Stream += NefitEMSSimulator.EscapeTelegram(Telegram)+Generator.Polls()
+         else:
+            Stream += Telegram.replace(b'\xff', b'\xff\xff')
+   Stream += b'\xff\x00\x00'
+   print('Recovery: '+str(len(Expected))+' valid telegrams, '+str(Generator.Corrupted)+' corrupted, '+str(Generator.LostBreaks)+' lost BREAKs')
+   for Recover in (False, True):
+      Port = BenchmarkPort(bytes(Stream))
+      Framer = NefitEMS.EMSFramer()
+      if not Recover:
+         Framer.Resync = lambda Message: 0
+      Frames = []
+      Start = time.time()
+      try:
+         while True:
+            Frames.append(NefitEMS.NextMessage(Port, Framer))
+      except EOFError:
+         pass
+      Elapsed = time.time()-Start
+      Unmatched = collections.Counter(Expected)
+      FalsePositives = 0
+      for Frame in Frames:
+         if Unmatched[Frame]:
+            Unmatched[Frame] -= 1
+         else:
+            FalsePositives += 1
+      print('  %-18s : %10.0f frames/s, yield %5.1f%%, %d false positives, %d recovered, %d lost' % ('with recovery' if Recover else 'without recovery', len(Frames)/Elapsed, 100.0*(len(Frames)-FalsePositives)/len(Expected), FalsePositives, Framer.Recovered, Framer.Lost))
+
+#################################################################################
+# Derived metrics benchmark, a day of UBAMonitorFast/Slow results (every 10 and
+# 60 seconds) with the burner cycling and return temperatures from 5C to 105C.
+# The old efficiency lookup per frame and the bisect lookup of the parsers,
+# against the windowed DerivedMetrics.
+#################################################################################
+def LegacyCalculateSystemEfficiency(Temperature):
+   LowValue=float(NefitEMS.EfficiencyDictionary[(int(Temperature))])
+   HighValue=float(NefitEMS.EfficiencyDictionary[(int(Temperature)+1)])
+   Fraction=Temperature-(int(Temperature))
+   Efficiency=LowValue+(Fraction*(HighValue-LowValue))
+   return(Efficiency)
+
+def BenchmarkDerived(Seconds=86400):
+   Random = random.Random(1)
+   Results = []
+   Starts = 0
+   for Second in range(0, Seconds, 10):
+      Modulation = float(Random.randint(20, 100)) if (Second % 1800) < 900 else 0.0
+      Return = 55.0+50.0*numpy.sin(Second/7200.0)+Random.uniform(-1, 1)
+      Results.append((Second, {'FlowTemperature': Return+10.0, 'FlowReturnTemperature': Return, 'BurnerDutyCycle': Modulation}))
+      if Second % 60 == 0:
+         Starts += (Second % 1800) == 0
+         Results.append((Second, {'BurnerStarts': Starts, 'BurnerRuntimeInMinutes': Second/120, 'HeatingRuntimeInMinutes': Second/180}))
+   print('Derived: '+str(len(Results))+' results, '+str(Seconds/NefitEMS.DerivedWindow)+' windows')
+
+   Errors = 0
+   Start = time.time()
+   for Time, Result in Results:
+      if 'FlowReturnTemperature' in Result:
+         try:
+            LegacyCalculateSystemEfficiency(Result['FlowReturnTemperature'])
+         except KeyError:
+            Errors += 1
+   Elapsed = time.time()-Start
+   print('  legacy efficiency  : %10.2f us/result, %d KeyErrors' % (1e6*Elapsed/len(Results), Errors))
+
+   Start = time.time()
+   for Time, Result in Results:
+      if 'FlowReturnTemperature' in Result:
+         NefitEMS.CalculateSystemEfficiency(Result['FlowReturnTemperature'])
+   Elapsed = time.time()-Start
+   print('  bisect efficiency  : %10.2f us/result' % (1e6*Elapsed/len(Results)))
+
+   Derived = NefitEMS.DerivedMetrics()
+   Windows = []
+   Start = time.time()
+   for Time, Result in Results:
+      Completed = Derived.Append(Time, Result)
+      if Completed is not None:
+         Windows.append(Completed[1])
+   Elapsed = time.time()-Start
+   print('  DerivedMetrics     : %10.2f us/result, %d windows, %.1f kWh heat, %.1f m3 gas' % (1e6*Elapsed/len(Results), len(Windows), Derived.HeatOutput, Derived.GasInput/NefitEMS.GasCalorificValue))
+   print('  last window        : '+', '.join('%s=%.2f' % Item for Item in sorted(Windows[-1].items())))
+
+#################################################################################
+# Output sinks benchmark, the decoded results of simulator traffic written to the
+# Domoticz sink only, and to the Domoticz, InfluxDB line protocol and MQTT sinks
+# (against the stand-in broker), once directly on the ingest path and once
+# through the OutputFanOut thread. It measures the time the ingest path spends
+# publishing, and checks that every record arrived.
+#################################################################################
+def BenchmarkSinks(Cycles=5000):
+   Generator = NefitEMSSimulator.EMSTrafficGenerator()
+   Results = []
+   for Cycle in range(Cycles):
+      for Telegram, Valid, Break in Generator.Telegrams():
+         Parser = NefitEMS.MessageParseDispatcher[ord(Telegram[2:3])]
+         Results.append((Parser, Parser.Decode(Telegram)))
+   Records = sum(len(Result) for Parser, Result in Results)
+   print('Sinks: '+str(len(Results))+' results, '+str(Records)+' records')
+   Domoticz = NefitEMSSimulator.DomoticzStandIn()
+   Domoticz.Start()
+   Broker = NefitEMSSimulator.MQTTStandIn()
+   Broker.Start()
+   FileName = tempfile.mktemp(suffix='.influx')
+   for Sinks in ('domoticz', 'domoticz+influx+mqtt'):
+      for FanOut in (False, True):
+         NefitEMS.DomoticzFilter = NefitEMS.ChangeFilter()
+         NefitEMS.Publisher = NefitEMS.DomoticzPublisher(Domoticz.URL())
+         NefitEMS.Publisher.Start()
+         Outputs = [NefitEMS.DomoticzSink()]
+         if 'influx' in Sinks:
+            Outputs += [NefitEMS.InfluxLineSink(FileName), NefitEMS.MQTTSink(*Broker.server_address)]
+         NefitEMS.Output = NefitEMS.OutputFanOut(Outputs)
+         if FanOut:
+            NefitEMS.Output.Start()
+         Published = Broker.Published
+         Start = time.time()
+         for Parser, Result in Results:
+            Parser.Publish(Result)
+         Ingest = time.time()-Start
+         NefitEMS.Output.Close()
+         Total = time.time()-Start
+         # The broker gets the last packets after the sink closed the connection.
+         Deadline = time.time()+5
+         while 'mqtt' in Sinks and Broker.Published-Published < Records and time.time() < Deadline:
+            time.sleep(0.01)
+         NefitEMS.Publisher.Close()
+         Check = ''
+         if 'influx' in Sinks:
+            Check = ', %d MQTT messages, %d influx lines' % (Broker.Published-Published, Outputs[1].Written)
+         if FanOut:
+            Check += ', %d batches, ingest waited %d times' % (NefitEMS.Output.Batches, NefitEMS.Output.Waits)
+         print('  %-21s %-7s: ingest %6.2f us/record, all sinks %6.2f us/record%s' % (Sinks, 'fan-out' if FanOut else 'direct', 1e6*Ingest/Records, 1e6*Total/Records, Check))
+   os.remove(FileName)
+   Broker.shutdown()
+   Domoticz.shutdown()
+   NefitEMS.Output = NefitEMS.OutputFanOut([NefitEMS.DomoticzSink()])
+
+#################################################################################
+# Library benchmark, the time to import NefitEMS in a fresh interpreter, and the
+# IterFrames/IterDecoded generators against NextMessage with the parsers, on the
+# same stream read in chunks of 4096 bytes.
+#################################################################################
+def BenchmarkLibrary(Count=40000):
+   Startups = []
+   for Run in range(5):
+      Start = time.time()
+      subprocess.check_call([sys.executable, '-c', 'import NefitEMS'], cwd=os.path.dirname(os.path.abspath(NefitEMS.__file__)))
+      Startups.append(time.time()-Start)
+   Start = time.time()
+   subprocess.check_call([sys.executable, '-c', 'pass'])
+   Interpreter = time.time()-Start
+   print('Library: import NefitEMS %.0f ms (interpreter alone %.0f ms)' % (1000*min(Startups), 1000*Interpreter))
+
+   Stream, Messages = BuildStream(Count)
+   Port = BenchmarkPort(Stream, 4096)
+   Framer = NefitEMS.EMSFramer()
+   Start = time.time()
+   try:
+      while True:
+         Message = NefitEMS.NextMessage(Port, Framer)
+         NefitEMS.MessageParseDispatcher[ord(Message[2:3])].Decode(Message)
+   except EOFError:
+      pass
+   LiveTime = time.time()-Start
+
+   Start = time.time()
+   Frames = 0
+   for Frame in NefitEMS.IterFrames(BenchmarkPort(Stream, 4096)):
+      Frames += 1
+   FramesTime = time.time()-Start
+   Start = time.time()
+   Decoded = 0
+   for Frame, Result in NefitEMS.IterDecoded(NefitEMS.IterFrames(BenchmarkPort(Stream, 4096)), Changes=False):
+      Decoded += 1
+   DecodedTime = time.time()-Start
+   assert Frames == Count and Decoded == Count
+   print('  NextMessage+Decode : %10.0f frames/s' % (Count/LiveTime))
+   print('  IterFrames         : %10.0f frames/s' % (Count/FramesTime))
+   print('  IterDecoded        : %10.0f frames/s (x%.1f)' % (Count/DecodedTime, LiveTime/DecodedTime))
+
+Benchmarks = {
+   'active': BenchmarkActive,
+   'crc': BenchmarkCRC,
+   'decode': BenchmarkDecode,
+   'derived': BenchmarkDerived,
+   'endtoend': BenchmarkEndToEnd,
+   'framer': BenchmarkFramer,
+   'library': BenchmarkLibrary,
+   'loop': BenchmarkLoop,
+   'multibus': BenchmarkMultiBus,
+   'recovery': BenchmarkRecovery,
+   'sinks': BenchmarkSinks,
+}
+
+if __name__ == '__main__':
+   for Name in (sys.argv[1:] or sorted(Benchmarks.keys())):
+      Benchmarks[Name]()
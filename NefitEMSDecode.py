@@ -0,0 +1,276 @@
+#################################################################################
+#
+# Batch decoder for raw EMS bus archives, the capture files of NefitEMS.py
+# --capture (or plain raw dumps of the serial port, without timestamps).
+#
+# The archive is split in chunks on BREAK boundaries, the chunks are framed,
+# CRC checked (in batch, with recovery of merged telegrams) and parsed with the
+# MessageParseDispatcher parsers by a pool of worker processes, one per core.
+# The result is written as a numpy .npz file with one column per attribute:
+#   Time, Sender, Receiver, Type, Offset, Length : per telegram
+#   Frame                                         : the raw telegram bytes,
+#                                                   padded with zeros
+#   <Field>                                       : the decoded fields of the
+#                                                   known telegram types, NaN
+#                                                   (or empty) for the others
+# The telegram counts per type are printed at the end, the unknown types are
+# the ones to look into (numpy.load(Output)['Frame'][Type == 0x..]).
+# The records are in the order of the archives on the command line.
+#
+# Usage: python NefitEMSDecode.py [--output FILE] [--workers N] ARCHIVE...
+#
+#################################################################################
+
+#################################################################################
+#Imports
+#################################################################################
+import os
+import time
+import mmap
+import argparse
+import multiprocessing
+import numpy
+import NefitEMS
+
+#################################################################################
+#Some definitions To use
+#################################################################################
+
+#Size of the chunks the archive is split in, in bytes of bus data.
+DecodeChunkBytes = 4*1024*1024
+
+#################################################################################
+# The archive as one continuous stream of bus data. A capture file is a list of
+# blocks (the time it was read, the length and the data), the block table has
+# per block the position of its data in the file, its length, its position in
+# the stream and its time. A raw dump is a single block without time (NaN).
+# Blocks() gives the table of the blocks of a part of the stream, to hand to a
+# worker together with the file name.
+#################################################################################
+class ArchiveStream(object):
+   def __init__(self, FileName):
+      self.FileName = FileName
+      self.File = open(FileName, 'rb')
+      Size = os.fstat(self.File.fileno()).st_size
+      self.Map = mmap.mmap(self.File.fileno(), 0, access=mmap.ACCESS_READ) if Size else b''
+      FilePositions = []
+      Lengths = []
+      Times = []
+      if self.Map[:len(NefitEMS.EMSCaptureMagic)] == NefitEMS.EMSCaptureMagic:
+         Position = len(NefitEMS.EMSCaptureMagic)
+         HeaderSize = NefitEMS.EMSCaptureBlock.size
+         while Position+HeaderSize <= Size:
+            Time, Length = NefitEMS.EMSCaptureBlock.unpack_from(self.Map, Position)
+            Position += HeaderSize
+            Length = min(Length, Size-Position)
+            FilePositions.append(Position)
+            Lengths.append(Length)
+            Times.append(Time)
+            Position += Length
+      elif Size:
+         FilePositions.append(0)
+         Lengths.append(Size)
+         Times.append(float('nan'))
+      self.FilePositions = numpy.array(FilePositions, dtype=numpy.int64)
+      self.Lengths = numpy.array(Lengths, dtype=numpy.int64)
+      self.Times = numpy.array(Times, dtype=numpy.float64)
+      self.Starts = numpy.concatenate(([0], numpy.cumsum(self.Lengths)))
+      self.Size = int(self.Starts[-1])
+
+   def Slice(self, Start, End):
+      Start = max(0, Start)
+      End = min(End, self.Size)
+      Data = []
+      Block = int(numpy.searchsorted(self.Starts, Start, side='right'))-1
+      while Start < End:
+         Offset = Start-int(self.Starts[Block])
+         Length = min(int(self.Lengths[Block])-Offset, End-Start)
+         FilePosition = int(self.FilePositions[Block])+Offset
+         Data.append(self.Map[FilePosition:FilePosition+Length])
+         Start += Length
+         Block += 1
+      return(b''.join(Data))
+
+   def Blocks(self, Start, End):
+      First = int(numpy.searchsorted(self.Starts, Start, side='right'))-1
+      Last = int(numpy.searchsorted(self.Starts, End, side='left'))
+      return((self.FilePositions[First:Last].tolist(), self.Lengths[First:Last].tolist(), self.Times[First:Last].tolist(), self.Starts[First:Last].tolist()))
+
+   # The position right after the first BREAK at or after Position. 0xff 0x00
+   # 0x00 is only a BREAK when its 0xff is a mark: a run of 0xff bytes is pairs of
+   # escaped data bytes, with a mark at the end when its length is odd.
+   def FindBreak(self, Position, Window=65536):
+      while Position < self.Size:
+         Data = self.Slice(Position, Position+Window+2)
+         Found = Data.find(b'\xff\x00\x00')
+         while Found >= 0:
+            Run = 1
+            while self.Slice(Position+Found-Run, Position+Found-Run+1) == b'\xff':
+               Run += 1
+            if Run % 2:
+               return(Position+Found+3)
+            Found = Data.find(b'\xff\x00\x00', Found+1)
+         Position += Window
+      return(self.Size)
+
+   def Close(self):
+      if self.Size:
+         self.Map.close()
+      self.File.close()
+
+# Splits the stream in chunks of about ChunkBytes that start and end on a BREAK,
+# returns the tasks for DecodeChunk.
+def SplitArchive(Stream, ChunkBytes=DecodeChunkBytes):
+   Boundaries = [0]
+   while Boundaries[-1] < Stream.Size:
+      Boundaries.append(Stream.FindBreak(Boundaries[-1]+ChunkBytes))
+   return([(Stream.FileName, Start, End, Stream.Blocks(Start, End)) for Start, End in zip(Boundaries[:-1], Boundaries[1:])])
+
+#################################################################################
+# The worker, decodes the part [Start, End) of the stream of an archive. It is
+# framed in one go, the frames get the time of the block in which their closing
+# BREAK was read, just like the live program would have seen them. The CRC is checked for all frames
+# at once, the telegrams in frames that fail (or don't fit their message) are
+# recovered where possible.
+# It returns the frames, their times, the decoded fields per frame and the
+# framer statistics.
+#################################################################################
+def DecodeChunk(Task):
+   FileName, Start, End, (FilePositions, Lengths, BlockTimes, BlockStarts) = Task
+   File = open(FileName, 'rb')
+   Map = mmap.mmap(File.fileno(), 0, access=mmap.ACCESS_READ)
+   # The part of the first and last block that is in the chunk.
+   Data = b''.join(Map[FilePosition+max(0, Start-BlockStart):FilePosition+min(Length, End-BlockStart)] for FilePosition, Length, BlockStart in zip(FilePositions, Lengths, BlockStarts))
+   Map.close()
+   File.close()
+   Framer = NefitEMS.EMSFramer()
+   Framer.Position = Start
+   Framer.FrameEnds = []
+   Framer.Feed(Data)
+   Frames = list(Framer.Frames)
+   # The block in which the BREAK after the frame ends.
+   Blocks = numpy.searchsorted(BlockStarts, numpy.array(Framer.FrameEnds, dtype=numpy.int64)-1, side='right')-1
+   Times = numpy.array(BlockTimes)[Blocks].tolist() if Frames else []
+
+   OK = NefitEMS.CRCOKBatch(Frames)
+   Failures = len(Frames)-int(OK.sum())
+   ValidTimes = []
+   ValidFrames = []
+   for Index, Frame in enumerate(Frames):
+      if OK[Index] and NefitEMS.FrameFits(Frame):
+         Recovered = [Frame]
+      else:
+         Recovered = Framer.Recover(Frame)
+      for Part in Recovered:
+         ValidFrames.append(Part)
+         ValidTimes.append(Times[Index])
+
+   # The decoded values per field, as (Indices, Values) lists.
+   Fields = dict()
+   for Index, Frame in enumerate(ValidFrames):
+      Parser = NefitEMS.MessageParseDispatcher.get(ord(Frame[2:3]))
+      if Parser is not None:
+         for Name, Value in Parser.Decode(Frame).items():
+            Field = Fields.get(Name)
+            if Field is None:
+               Field = Fields[Name] = ([], [])
+            Field[0].append(Index)
+            Field[1].append(Value)
+   Statistics = {'Bytes': End-Start, 'Breaks': Framer.Breaks, 'CRCFailures': Failures, 'Recovered': Framer.Recovered, 'Lost': Framer.Lost, 'Overruns': Framer.Overruns}
+   return(BuildColumns(ValidTimes, ValidFrames, Fields), Statistics)
+
+# The columns of a chunk, the frames padded with zeros to the longest one.
+def BuildColumns(Times, Frames, Fields):
+   Lengths = numpy.array([len(Frame) for Frame in Frames], dtype=numpy.int64)
+   Flat = numpy.frombuffer(b''.join(Frames), dtype=numpy.uint8)
+   FrameColumn = numpy.zeros((len(Frames), max(4, int(Lengths.max()) if len(Frames) else 0)), dtype=numpy.uint8)
+   Rows = numpy.repeat(numpy.arange(len(Frames)), Lengths)
+   FrameColumn[Rows, numpy.arange(len(Flat))-numpy.repeat(numpy.cumsum(Lengths)-Lengths, Lengths)] = Flat
+   Columns = {
+      'Time': numpy.array(Times, dtype=numpy.float64),
+      'Sender': FrameColumn[:, 0].copy(),
+      'Receiver': FrameColumn[:, 1].copy(),
+      'Type': FrameColumn[:, 2].copy(),
+      'Offset': FrameColumn[:, 3].copy(),
+      'Length': Lengths.astype(numpy.uint8),
+      'Frame': FrameColumn,
+   }
+   for Name, (Indices, Values) in Fields.items():
+      if isinstance(Values[0], basestring):
+         Column = numpy.zeros(len(Frames), dtype='S%d' % max(1, max(len(Value) for Value in Values)))
+      else:
+         Column = numpy.full(len(Frames), numpy.nan)
+      Column[Indices] = Values
+      Columns[Name] = Column
+   return(Columns)
+
+# Empty values of a column for Count frames of a chunk that does not have it.
+def MissingColumn(Column, Count):
+   if Column.dtype.kind == 'S':
+      return(numpy.zeros(Count, dtype=Column.dtype))
+   return(numpy.full(Count, numpy.nan))
+
+#################################################################################
+# Decodes the archives with a pool of Workers processes and returns the columns
+# and the summed statistics.
+#################################################################################
+def DecodeArchives(FileNames, Workers=None, ChunkBytes=DecodeChunkBytes):
+   Tasks = []
+   for FileName in FileNames:
+      Stream = ArchiveStream(FileName)
+      Tasks += SplitArchive(Stream, ChunkBytes)
+      Stream.Close()
+   Pool = multiprocessing.Pool(Workers)
+   try:
+      Chunks = Pool.map(DecodeChunk, Tasks, 1)
+   finally:
+      Pool.close()
+      Pool.join()
+
+   Statistics = dict.fromkeys(('Bytes', 'Breaks', 'CRCFailures', 'Recovered', 'Lost', 'Overruns'), 0)
+   for ChunkColumns, ChunkStatistics in Chunks:
+      for Name, Value in ChunkStatistics.items():
+         Statistics[Name] += Value
+   Chunks = [ChunkColumns for ChunkColumns, ChunkStatistics in Chunks if len(ChunkColumns['Time'])] or [BuildColumns([], [], dict())]
+   Columns = dict()
+   Width = max([ChunkColumns['Frame'].shape[1] for ChunkColumns in Chunks])
+   for ChunkColumns in Chunks:
+      Frame = ChunkColumns['Frame']
+      ChunkColumns['Frame'] = numpy.pad(Frame, ((0, 0), (0, Width-Frame.shape[1])), 'constant')
+      for Name, Column in ChunkColumns.items():
+         Columns.setdefault(Name, Column)
+   for Name in Columns:
+      Parts = [ChunkColumns.get(Name, MissingColumn(Columns[Name], len(ChunkColumns['Time']))) for ChunkColumns in Chunks]
+      # The text columns of the chunks differ in width, keep the widest.
+      if Columns[Name].dtype.kind == 'S':
+         TextWidth = max(Part.dtype.itemsize for Part in Parts)
+         Parts = [Part.astype('S%d' % TextWidth) for Part in Parts]
+      Columns[Name] = numpy.concatenate(Parts)
+   Statistics['Frames'] = len(Columns['Time'])
+   Statistics['Decoded'] = int(numpy.in1d(Columns['Type'], list(NefitEMS.MessageParseDispatcher)).sum())
+   return(Columns, Statistics)
+
+#################################################################################
+# Main Program
+#################################################################################
+if __name__ == '__main__':
+   ArgumentParser = argparse.ArgumentParser(description='Decode raw EMS bus archives into a columnar .npz file.')
+   ArgumentParser.add_argument('archives', nargs='+', metavar='ARCHIVE', help='capture file (NefitEMS.py --capture) or raw dump')
+   ArgumentParser.add_argument('--output', default='decoded.npz', help='output file (default: %(default)s)')
+   ArgumentParser.add_argument('--workers', type=int, help='number of worker processes (default: one per core)')
+   ArgumentParser.add_argument('--chunk', type=int, default=DecodeChunkBytes, help='chunk size in bytes (default: %(default)s)')
+   ArgumentParser.add_argument('--compress', action='store_true', help='write a compressed .npz')
+   Arguments = ArgumentParser.parse_args()
+
+   Start = time.time()
+   Columns, Statistics = DecodeArchives(Arguments.archives, Arguments.workers, Arguments.chunk)
+   Elapsed = time.time()-Start
+   (numpy.savez_compressed if Arguments.compress else numpy.savez)(Arguments.output, **Columns)
+
+   print('Decoded '+str(Statistics['Frames'])+' telegrams from '+str(Statistics['Bytes'])+' bytes in %.1f s (%.0f telegrams/s)' % (Elapsed, Statistics['Frames']/max(Elapsed, 1e-9)))
+   print('CRC failures='+str(Statistics['CRCFailures'])+', recovered='+str(Statistics['Recovered'])+', lost='+str(Statistics['Lost'])+', frame overruns='+str(Statistics['Overruns']))
+   Types, Counts = numpy.unique(Columns['Type'], return_counts=True)
+   for Type, Count in zip(Types, Counts):
+      Parser = NefitEMS.MessageParseDispatcher.get(int(Type))
+      print('  0x%02x %-24s %10d' % (Type, Parser.Name if Parser is not None else 'unknown', Count))
+   print('Written to '+Arguments.output)
@@ -0,0 +1,415 @@
+#################################################################################
+#
+# EMS bus simulator, to run and benchmark NefitEMS.py without a boiler.
+#
+# It creates a pseudo terminal and writes realistic EMS traffic to it: the
+# UBAMonitorFast (0x18), UBAMonitorSlow (0x19), UBAMonitorWW (0x34) and
+# Moduline300Status (0x91) telegrams with slowly changing values, the poll bytes
+# of the bus master, 0xff data bytes and optionally telegrams with a bad CRC
+# or a lost BREAK.
+# A pty can't carry a BREAK, so the simulator writes the stream as the serial
+# port delivers it with PARMRK: BREAK as 0xff 0x00 0x00 and 0xff as 0xff 0xff.
+# With a poll ID it also polls that device every bus cycle, like the UBA does,
+# and answers its read requests, to test the active mode of NefitEMS.py.
+# It also runs a stand-in Domoticz HTTP server that accepts and counts the
+# updates, and optionally a stand-in MQTT broker.
+#
+# Usage: python NefitEMSSimulator.py [--speed N] [--errors RATE] [--lost-breaks RATE] [--poll-id ID] [--mqtt-port PORT]
+#        python NefitEMS.py --port <pty> --no-parity-mark --domoticz <url> [--active]
+#
+#################################################################################
+
+#################################################################################
+#Imports
+#################################################################################
+import os
+import time
+import random
+import select
+import struct
+import argparse
+import threading
+import BaseHTTPServer
+import SocketServer
+import NefitEMS
+
+#################################################################################
+# Some definitions To use
+#################################################################################
+
+#Poll bytes of the bus master (0x08 UBA), it polls the bus devices in turn.
+EMSPollBytes = [0x89, 0x8b, 0x90, 0x97, 0x98]
+
+#Domoticz idx of the burner starts, it increases with every UBAMonitorSlow
+#telegram, which makes it usable to match Domoticz requests to telegrams.
+BurnerStartsIdx = 'idx=87&'
+
+#################################################################################
+# Telegram encoding, the inverse of the MessageSchema decoding in NefitEMS.py.
+# Bytes that are not a field are filled with Filler, 0xff is also what the real
+# bus uses for sensors that are not present.
+#################################################################################
+def EncodeTelegram(Type, Values, Sender=0x08, Receiver=0x00, Filler=0x00):
+   Schema = NefitEMS.MessageSchema[Type]
+   Message = bytearray([Filler]*Schema['Size'])
+   Message[0:4] = bytearray([Sender, Receiver, Type, 0x00])
+   for Name, Offset, Format, Scale in Schema['Fields']:
+      if Name not in Values:
+         continue
+      Value = Values[Name]
+      if Scale is not None:
+         Value = int(round(Value/Scale))
+      if Format == 'T':
+         Message[Offset:Offset+3] = struct.pack('>I', Value)[1:]
+      else:
+         struct.pack_into('>'+Format, Message, Offset, Value)
+   Message[-1] = NefitEMS.CalculateNefitEMSCRC(bytes(Message))
+   return(bytes(Message))
+
+def EscapeTelegram(Message):
+   return(Message.replace(b'\xff', b'\xff\xff')+b'\xff\x00\x00')
+
+#################################################################################
+# The traffic generator, produces the stream of one bus cycle at a time: a burst
+# of telegrams, each followed by a few poll bytes. The values follow a simple
+# heating cycle, and the burner starts counter increases with every 0x19.
+# ErrorRate is the fraction of telegrams with a corrupted data byte, BreakLossRate
+# the fraction of telegrams whose BREAK gets lost, so they merge with the next.
+#################################################################################
+class EMSTrafficGenerator(object):
+   def __init__(self, ErrorRate=0.0, Seed=1, BreakLossRate=0.0):
+      self.Random = random.Random(Seed)
+      self.ErrorRate = ErrorRate
+      self.BreakLossRate = BreakLossRate
+      self.Cycle = 0
+      self.BurnerStarts = 10000
+      self.Sent = dict()
+      self.Corrupted = 0
+      self.LostBreaks = 0
+      self.Latest = dict()
+
+   def Values(self):
+      Phase = (self.Cycle % 600)/600.0
+      Flow = 35.0+30.0*Phase
+      Return = Flow-8.0-2.0*self.Random.random()
+      return({
+         'RequestedFlowTemperature': 70.0,
+         'FlowTemperature': Flow,
+         'RequestedBurnerDutyCycle': 60.0,
+         'BurnerDutyCycle': float(int(40+40*Phase)),
+         'Boiler': Flow+1.5,
+         'FlowReturnTemperature': Return,
+         'IonizationCurrent': 4.2,
+         'Pressure': 1.6,
+         'StatusCode': b'-H',
+         'ErrorCode': 200,
+         'BurnerOutWaterTemperature': Flow+3.0,
+         'PumpDutyCycle': 100.0,
+         'BurnerStarts': self.BurnerStarts,
+         'BurnerRuntimeInMinutes': 123456,
+         'HeatingRuntimeInMinutes': 100000,
+         'WarmWaterOutTemperature': 52.0,
+         'BoilerTemperature': 55.0,
+         'WarmWaterFlow': 0.0,
+         'Setpoint': 20.5,
+         'Actual': 19.0+Phase,
+      })
+
+   # Returns a list of (Telegram, Valid, Break), Break is False when the BREAK
+   # after the telegram is lost.
+   def Telegrams(self):
+      self.Cycle += 1
+      self.BurnerStarts += 1
+      Values = self.Values()
+      Telegrams = [
+         EncodeTelegram(0x18, Values, Filler=0xff),
+         EncodeTelegram(0x19, Values),
+         EncodeTelegram(0x34, Values, Filler=0xff),
+         EncodeTelegram(0x91, Values, Sender=0x17),
+      ]
+      for Telegram in Telegrams:
+         self.Latest[ord(Telegram[2:3])] = Telegram
+      Result = []
+      for Telegram in Telegrams:
+         Valid = True
+         if self.Random.random() < self.ErrorRate:
+            Corrupt = bytearray(Telegram)
+            Corrupt[self.Random.randint(4, len(Corrupt)-2)] ^= 0x10
+            Telegram = bytes(Corrupt)
+            Valid = False
+            self.Corrupted += 1
+         else:
+            Type = ord(Telegram[2:3])
+            self.Sent[Type] = self.Sent.get(Type, 0)+1
+         Break = True
+         if self.Random.random() < self.BreakLossRate:
+            Break = False
+            self.LostBreaks += 1
+         Result.append((Telegram, Valid, Break))
+      return(Result)
+
+   def Polls(self):
+      Stream = bytearray()
+      for Poll in range(self.Random.randint(1, 3)):
+         Stream.append(self.Random.choice(EMSPollBytes))
+         Stream += b'\xff\x00\x00'
+      return(bytes(Stream))
+
+#################################################################################
+# The Simulator, owns the pty and writes the generated traffic to it. Speed is
+# a multiple of the 9600 baud line rate (0 is as fast as the pty accepts it),
+# Burst leaves out the idle time between bus cycles. OnBreak is called with the
+# telegram and the time its closing BREAK was written.
+# With a PollID, the device with that ID is polled after every bus cycle. Like
+# the bus master, it waits AnswerWindow for the answer to start, an answer that
+# comes later is counted as late (and its bytes are thrown away when the next
+# poll is sent). A pty carries no BREAK, so the answer is read until
+# PollTimeout passes without bytes: a single byte gives the bus back, a 6 byte
+# read request is answered with the requested part of the latest telegram of
+# that type.
+#################################################################################
+class EMSSimulator(object):
+   def __init__(self, Generator=None, Speed=1.0, Burst=False, OnBreak=None, PollID=None, PollTimeout=0.005, AnswerWindow=0.02):
+      self.Generator = Generator or EMSTrafficGenerator()
+      self.Speed = Speed
+      self.Burst = Burst
+      self.OnBreak = OnBreak
+      self.PollID = PollID
+      self.PollTimeout = PollTimeout
+      self.AnswerWindow = AnswerWindow
+      self.Master, self.Slave = os.openpty()
+      self.PortName = os.ttyname(self.Slave)
+      self.Thread = None
+      self.Running = False
+      self.BytesWritten = 0
+      self.Polls = 0
+      self.PollReplies = 0
+      self.ReadRequests = 0
+      self.LateAnswers = 0
+
+   def Write(self, Data):
+      # Returns the time the data was written, before waiting for the line time.
+      Length = len(Data)
+      while Data:
+         Written = os.write(self.Master, Data)
+         Data = Data[Written:]
+         self.BytesWritten += Written
+      Now = time.time()
+      if self.Speed:
+         time.sleep(Length/(NefitEMS.EMSLineRate*self.Speed))
+      return(Now)
+
+   def Poll(self):
+      if select.select([self.Master], [], [], 0)[0]:
+         os.read(self.Master, 1024)
+         self.LateAnswers += 1
+      self.Polls += 1
+      self.Write(bytearray([self.PollID | 0x80])+b'\xff\x00\x00')
+      Answer = bytearray()
+      Deadline = time.time()+self.AnswerWindow
+      while Answer or time.time() < Deadline:
+         Readable = select.select([self.Master], [], [], self.PollTimeout if Answer else max(0.0, Deadline-time.time()))[0]
+         if not Readable:
+            break
+         Answer += os.read(self.Master, 64)
+      if len(Answer) == 1 and Answer[0] == self.PollID:
+         self.PollReplies += 1
+      elif len(Answer) == 6 and Answer[0] == self.PollID and NefitEMS.CRCOK(bytes(Answer)):
+         Destination, Type, Offset, Length = Answer[1] & 0x7f, Answer[2], Answer[3], Answer[4]
+         Latest = self.Generator.Latest.get(Type)
+         if Latest is not None and Destination == ord(Latest[0:1]):
+            self.ReadRequests += 1
+            Reply = bytearray([Destination, self.PollID, Type, Offset])
+            Reply += bytearray(Latest[4+Offset:min(4+Offset+Length, len(Latest)-1)])
+            Reply.append(NefitEMS.CalculateNefitEMSCRC(bytes(Reply)+b'\x00'))
+            self.Write(EscapeTelegram(bytes(Reply)))
+
+   def Run(self, Cycles=None):
+      Cycle = 0
+      while self.Running and (Cycles is None or Cycle < Cycles):
+         Cycle += 1
+         for Telegram, Valid, Break in self.Generator.Telegrams():
+            if not Break:
+               # The next telegram follows right away, as if the BREAK and the
+               # polls in between were not seen.
+               self.Write(Telegram.replace(b'\xff', b'\xff\xff'))
+               continue
+            BreakTime = self.Write(EscapeTelegram(Telegram))
+            if self.OnBreak is not None and Valid:
+               self.OnBreak(Telegram, BreakTime)
+            Polls = self.Generator.Polls()
+            if self.PollID is not None:
+               # Our poll ID is only polled by Poll(), which waits for the answer.
+               Polls = Polls.replace(bytes(bytearray([self.PollID | 0x80]))+b'\xff\x00\x00', b'')
+            self.Write(Polls)
+            if self.PollID is not None:
+               self.Poll()
+         if not self.Burst and self.Speed:
+            time.sleep(0.5/self.Speed)
+      self.Running = False
+
+   def Start(self, Cycles=None):
+      self.Running = True
+      self.Thread = threading.Thread(target=self.Run, args=(Cycles,), name='EMSSimulator')
+      self.Thread.daemon = True
+      self.Thread.start()
+
+   def Stop(self):
+      self.Running = False
+
+   def Close(self):
+      os.close(self.Master)
+      os.close(self.Slave)
+
+#################################################################################
+# Stand-in Domoticz server, answers every request with a Domoticz like OK, over
+# HTTP/1.1 keep-alive connections. OnRequest is called with the path and the
+# time the request arrived. With a Delay it plays a slow Domoticz, every answer
+# takes that many seconds.
+#################################################################################
+class DomoticzStandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+   protocol_version = 'HTTP/1.1'
+
+   def do_GET(self):
+      self.server.Requests += 1
+      if self.server.Delay:
+         time.sleep(self.server.Delay)
+      if self.server.OnRequest is not None:
+         self.server.OnRequest(self.path, time.time())
+      Body = b'{ "status" : "OK", "title" : "Update Device" }'
+      self.send_response(200)
+      self.send_header('Content-Type', 'application/json')
+      self.send_header('Content-Length', str(len(Body)))
+      self.end_headers()
+      self.wfile.write(Body)
+
+   def log_message(self, *Arguments):
+      pass
+
+class DomoticzStandIn(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+   daemon_threads = True
+
+   def __init__(self, Address=('127.0.0.1', 0), OnRequest=None, Delay=0.0):
+      BaseHTTPServer.HTTPServer.__init__(self, Address, DomoticzStandInHandler)
+      self.OnRequest = OnRequest
+      self.Delay = Delay
+      self.Requests = 0
+
+   def URL(self):
+      return('http://%s:%d/' % self.server_address)
+
+   def Start(self):
+      Thread = threading.Thread(target=self.serve_forever, name='DomoticzStandIn')
+      Thread.daemon = True
+      Thread.start()
+
+#################################################################################
+# Stand-in MQTT broker, just enough MQTT 3.1.1 for the MQTTSink of NefitEMS.py:
+# it accepts every CONNECT, answers PINGREQ, and keeps the last payload per topic
+# (like retained messages). OnPublish is called with the topic, the payload and
+# the time the PUBLISH arrived. Subscribing is not supported.
+#################################################################################
+class MQTTStandInHandler(SocketServer.BaseRequestHandler):
+   # The complete packets at the start of Buffer as (Type, Body), and the rest.
+   @staticmethod
+   def SplitPackets(Buffer):
+      Packets = []
+      Pos = 0
+      while Pos+2 <= len(Buffer):
+         Length = 0
+         Shift = 0
+         Index = Pos+1
+         while Index < len(Buffer):
+            Byte = ord(Buffer[Index])
+            Length |= (Byte & 0x7f) << Shift
+            Shift += 7
+            Index += 1
+            if not Byte & 0x80:
+               break
+         else:
+            break
+         if Index+Length > len(Buffer):
+            break
+         Packets.append((ord(Buffer[Pos]), Buffer[Index:Index+Length]))
+         Pos = Index+Length
+      return(Packets, Buffer[Pos:])
+
+   def handle(self):
+      Buffer = b''
+      while True:
+         Data = self.request.recv(65536)
+         if not Data:
+            return
+         Packets, Buffer = self.SplitPackets(Buffer+Data)
+         for Type, Body in Packets:
+            if Type >> 4 == 14:
+               return
+            if Type >> 4 == 1:
+               self.server.Connections += 1
+               self.request.sendall(b'\x20\x02\x00\x00')
+            elif Type >> 4 == 3:
+               TopicLength = struct.unpack('>H', Body[0:2])[0]
+               Topic = Body[2:2+TopicLength]
+               # QoS 1 and 2 have a packet identifier after the topic.
+               Payload = Body[2+TopicLength+(2 if Type & 0x06 else 0):]
+               self.server.Published += 1
+               self.server.Topics[Topic] = Payload
+               if self.server.OnPublish is not None:
+                  self.server.OnPublish(Topic, Payload, time.time())
+            elif Type >> 4 == 12:
+               self.request.sendall(b'\xd0\x00')
+
+class MQTTStandIn(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+   daemon_threads = True
+   allow_reuse_address = True
+
+   def __init__(self, Address=('127.0.0.1', 0), OnPublish=None):
+      SocketServer.TCPServer.__init__(self, Address, MQTTStandInHandler)
+      self.OnPublish = OnPublish
+      self.Connections = 0
+      self.Published = 0
+      self.Topics = dict()
+
+   def Start(self):
+      Thread = threading.Thread(target=self.serve_forever, name='MQTTStandIn')
+      Thread.daemon = True
+      Thread.start()
+
+#################################################################################
+# Main Program, runs the simulator and the Domoticz stand-in until Ctrl-C.
+#################################################################################
+if __name__ == '__main__':
+   ArgumentParser = argparse.ArgumentParser(description='Simulate an EMS bus on a pty, with a stand-in Domoticz server.')
+   ArgumentParser.add_argument('--speed', type=float, default=1.0, help='multiple of the 9600 baud line rate, 0 for as fast as possible (default: %(default)s)')
+   ArgumentParser.add_argument('--burst', action='store_true', help='no idle time between bus cycles')
+   ArgumentParser.add_argument('--errors', type=float, default=0.0, help='fraction of telegrams sent with a bad CRC (default: %(default)s)')
+   ArgumentParser.add_argument('--lost-breaks', type=float, default=0.0, help='fraction of telegrams whose BREAK gets lost (default: %(default)s)')
+   ArgumentParser.add_argument('--poll-id', type=lambda Value: int(Value, 0), help='poll this bus ID and answer its read requests, e.g. 0x0b')
+   ArgumentParser.add_argument('--http-port', type=int, default=8080, help='port of the stand-in Domoticz server (default: %(default)s)')
+   ArgumentParser.add_argument('--mqtt-port', type=int, default=0, help='also run a stand-in MQTT broker on this port, e.g. 1883')
+   ArgumentParser.add_argument('--http-delay', type=float, default=0.0, help='seconds the stand-in Domoticz server takes to answer (default: %(default)s)')
+   Arguments = ArgumentParser.parse_args()
+
+   Domoticz = DomoticzStandIn(('127.0.0.1', Arguments.http_port), Delay=Arguments.http_delay)
+   Domoticz.Start()
+   Broker = None
+   if Arguments.mqtt_port:
+      Broker = MQTTStandIn(('127.0.0.1', Arguments.mqtt_port))
+      Broker.Start()
+      print('MQTT broker on 127.0.0.1:'+str(Arguments.mqtt_port)+', use --mqtt 127.0.0.1:'+str(Arguments.mqtt_port))
+   Simulator = EMSSimulator(EMSTrafficGenerator(Arguments.errors, BreakLossRate=Arguments.lost_breaks), Arguments.speed, Arguments.burst, PollID=Arguments.poll_id)
+   Simulator.Start()
+   print('EMS bus on '+Simulator.PortName+', Domoticz on '+Domoticz.URL())
+   print('Run: python NefitEMS.py --port '+Simulator.PortName+' --no-parity-mark --domoticz '+Domoticz.URL())
+   try:
+      while Simulator.Running:
+         time.sleep(10)
+         print('Telegrams sent='+str(sum(Simulator.Generator.Sent.values()))+', corrupted='+str(Simulator.Generator.Corrupted)+', lost BREAKs='+str(Simulator.Generator.LostBreaks)+', Domoticz requests='+str(Domoticz.Requests))
+         if Broker is not None:
+            print('MQTT connections='+str(Broker.Connections)+', published='+str(Broker.Published)+', topics='+str(len(Broker.Topics)))
+         if Simulator.PollID is not None:
+            print('Polls='+str(Simulator.Polls)+', poll replies='+str(Simulator.PollReplies)+', read requests answered='+str(Simulator.ReadRequests)+', late answers='+str(Simulator.LateAnswers))
+   except KeyboardInterrupt:
+      pass
+   Simulator.Stop()
+   Simulator.Close()